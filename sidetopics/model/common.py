@@ -60,7 +60,8 @@ class DataSet:
     def from_files(cls, words_file, feats_file=None, links_file=None, order=None, limit=0):
         '''
         The three matrices that make up our features. Each one is loaded in from
-        the given pickle file.
+        the given file: a scipy sparse .npz file, a dense numpy .npy file, or
+        otherwise a pickle file.
 
         The order specifies the subset of rows to consider (and columns in the
         case that links is square). This subset is extracted and passed to the
@@ -69,20 +70,9 @@ class DataSet:
         If limit is greater than zero, then only the first "limit" documents are
         considered.
         '''
-        with open(words_file, 'rb') as f:
-            words = pkl.load(f)
-
-        if feats_file is not None:
-            with open(feats_file, 'rb') as f:
-                feats = pkl.load(f)
-        else:
-            feats = None
-
-        if links_file is not None:
-            with open(links_file, 'rb') as f:
-                links = pkl.load(f)
-        else:
-            links = None
+        words = load_matrix(words_file)
+        feats = None if feats_file is None else load_matrix(feats_file)
+        links = None if links_file is None else load_matrix(links_file)
 
         result = DataSet(words, feats, links, order=None, limit=limit)
         if order is not None:
@@ -197,7 +187,10 @@ class DataSet:
 
         means = self._feats.mean(axis=0)
         if means.max() < (1-1E-30):
-            self._feats = ssp.hstack((self._feats, np.ones((self.doc_count, 1))), "csr")
+            if ssp.issparse(self._feats):
+                self._feats = ssp.hstack((self._feats, np.ones((self.doc_count, 1))), "csr")
+            else:
+                self._feats = np.hstack((self._feats, np.ones((self.doc_count, 1), dtype=self._feats.dtype)))
             return True
 
         return False
@@ -484,6 +477,22 @@ class DataSet:
                trainDocs
 
 
+def load_matrix(path):
+    '''
+    Loads a matrix from the given path, choosing the format from the file
+    extension. Sparse matrices saved by scipy.sparse.save_npz and dense
+    arrays saved by np.save are loaded directly. Anything else is assumed
+    to be a pickle.
+    '''
+    if path.endswith('.npz'):
+        return ssp.load_npz(path)
+    elif path.endswith('.npy'):
+        return np.load(path)
+    else:
+        with open(path, 'rb') as f:
+            return pkl.load(f)
+
+
 def _split(X, rng):
     '''
     Given a  matrix, splits it into two matrices such that their sum is equal to the
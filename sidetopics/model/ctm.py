@@ -18,19 +18,17 @@ import time
 from collections import namedtuple
 import numpy as np
 import scipy.linalg as la
-import scipy.sparse as ssp
 import numpy.random as rd
 import sys
 
 from sidetopics.util.array_utils import normalizerows_ip
-from sidetopics.util.sigmoid_utils import rowwise_softmax
-from sidetopics.util.sparse_elementwise import sparseScalarQuotientOfDot, \
-    sparseScalarProductOfSafeLnDot, scaledSumOfLnOnePlusExp
+from sidetopics.util.sparse_elementwise import sparseScalarQuotientOfDotWithProducts, \
+    sparseScalarProductOfSafeLnDot, scaledSumOfLnOnePlusExp, csrColumnOrder
 from sidetopics.util.misc import clamp, converged
 
 from sidetopics.model.common import DataSet
 from sidetopics.model.evals import perplexity_from_like
-from sklearn.covariance import oas
+import sidetopics.model.ctm_fast as compiled
     
 # ==============================================================
 # CONSTANTS
@@ -40,12 +38,16 @@ DTYPE=np.float32 # A default, generally we should specify this in the model setu
 
 USE_NIW_PRIOR=True
 
+# If the model is double-precision, read the vocabulary in single-precision
+# when doing the E-Step's sparse inner products.
+USE_LOW_PRECISION_VOCAB=False
+
 LN_OF_2_PI   = log(2 * pi)
 LN_OF_2_PI_E = log(2 * pi * e)
 
 VocabPrior=1.1
 
-DEBUG=True
+DEBUG=False
 
 MODEL_NAME="ctm/bouchard"
 
@@ -134,8 +136,11 @@ def newQueryState(data, modelState):
     docLens = np.squeeze(np.asarray(W.sum(axis=1)))
     
     base     = normalizerows_ip(rd.random((D,K*2)).astype(dtype))
-    means    = base[:,:K]
-    expMeans = base[:,K:]
+    # Copy the means and expMeans out of base rather than taking views, so
+    # their rows are contiguous and not 2K apart, which the compiled E-step
+    # kernels and BLAS calls all traverse faster
+    means    = np.ascontiguousarray(base[:,:K])
+    expMeans = np.ascontiguousarray(base[:,K:])
     varcs    = np.ones((D,K), dtype=dtype)
     
     s = np.ndarray(shape=(D,), dtype=dtype)
@@ -180,6 +185,7 @@ def train (dataset, modelState, queryState, trainPlan):
     iterations, epsilon, logFrequency, diagonalPriorCov, debug = trainPlan.iterations, trainPlan.epsilon, trainPlan.logFrequency, trainPlan.fastButInaccurate, trainPlan.debug
     means, expMeans, varcs, lxi, s, n = queryState.means, queryState.expMeans, queryState.varcs, queryState.lxi, queryState.s, queryState.docLens
     K, topicMean, sigT, vocab, vocabPrior, dtype = modelState.K, modelState.topicMean, modelState.sigT, modelState.vocab, modelState.vocabPrior, modelState.dtype
+    n = n.astype(dtype, copy=False)
     
     # Book-keeping for logs
     boundIters   = np.zeros(shape=(iterations // logFrequency,))
@@ -187,21 +193,37 @@ def train (dataset, modelState, queryState, trainPlan):
     likelyValues = np.zeros(shape=(iterations // logFrequency,))
     bvIdx = 0
     
-    debugFn = _debug_with_bound if debug else _debug_with_nothing
+    updateMeansAndVarcs = compiled.updateMeansAndVarcs_f4 \
+                          if dtype == np.float32 \
+                          else compiled.updateMeansAndVarcs_f8
+    updateApproxParams  = compiled.updateApproxParams_f4 \
+                          if dtype == np.float32 \
+                          else compiled.updateApproxParams_f8
     
-    # Initialize some working variables
-    isigT = la.inv(sigT)
+    # Initialize some working variables. The prior covariance is constrained
+    # to be diagonal, so we only ever work with its diagonal
+    sigT_diag = np.diag(sigT).copy()
     R = W.copy()
+    S  = np.empty_like(means)
+    xi = np.empty_like(means)
+    centredMeans = np.empty_like(means)
+    
+    # The sparse kernels read vocab a column at a time, so they are given a
+    # column-major copy of it
+    vocabF     = np.asfortranarray(vocab, dtype=np.float32 if USE_LOW_PRECISION_VOCAB else dtype)
+    vocabScale = np.empty(vocab.shape, dtype=dtype, order='F')
+    WColOrder  = csrColumnOrder(W)
     
     s.fill(0)
     priorSigt_diag = np.ndarray(shape=(K,), dtype=dtype)
     priorSigt_diag.fill (0.1)
     kappa = K + 2
-
-    expMeans = means.copy()
     
     # Iterate over parameters
     for itr in range(iterations):
+        # In debug mode the bound is checked after every update, but only on
+        # the iterations where it would be logged in any case
+        debugItr = debug and (logFrequency <= 0 or itr % logFrequency == 0)
         
         # We start with the M-Step, so the parameters are consistent with our
         # initialisation of the RVs when we do the E-Step
@@ -211,83 +233,74 @@ def train (dataset, modelState, queryState, trainPlan):
         topicMean = means.sum(axis=0) / (D + kappa) \
                     if USE_NIW_PRIOR \
                     else means.mean(axis=0)
-        debugFn (itr, topicMean, "topicMean", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, lxi, s, n)
+        if debugItr: _debug_with_bound (itr, topicMean, "topicMean", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, lxi, s, n)
 
         # diff = means - topicMean
         # sigT = diff.T.dot(diff) / D
 
-        sigT, _ = oas(means, assume_centered=False)
-        if dtype is not np.float64:
-            sigT = sigT.astype(dtype)
+        sigT_diag = _oasCovDiag(means, work=centredMeans).astype(dtype)
 
-        sigT += np.diag(varcs.mean(axis=0))
+        sigT_diag += varcs.mean(axis=0)
 
         if USE_NIW_PRIOR:
-            sigT.flat[::K+1] += priorSigt_diag
-            sigT += (kappa * D)/(kappa + D) * np.outer(topicMean, topicMean)
+            sigT_diag += priorSigt_diag
+            sigT_diag += (kappa * D)/(kappa + D) * topicMean * topicMean
 
         # Building blocks...
-        # 1/4 Create the precision matrix from the covariance
-        if True or diagonalPriorCov:
-            diag = np.diag(sigT)
-            sigT = np.diag(diag)
-            isigT = np.diag(1. / diag)
-        else:
-            isigT = la.inv(sigT)
+        # 1/4 Create the precision from the covariance
+        isigT_diag = 1. / sigT_diag
+        if debug:
+            sigT = np.diag(sigT_diag)
         
-        debugFn (itr, sigT, "sigT", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, lxi, s, n)
+        if debugItr: _debug_with_bound (itr, sigT, "sigT", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, lxi, s, n)
 #        print ("         Det sigT = " + str(la.det(sigT)))
         
-        # 2/4 temporarily replace means with exp(means)
-        expMeans = np.exp(means - means.max(axis=1)[:,np.newaxis], out=expMeans)
-        R = sparseScalarQuotientOfDot(W, expMeans, vocab, out=R)
-        # S = expMeans * R.dot(vocab.T)
+        # 2/4 temporarily replace means with exp(means). S comes out of this
+        # same pass, so the E-Step below uses the vocabulary from before 3/4
+        expMeans = _shiftedExp(means, out=expMeans)
+        R = sparseScalarQuotientOfDotWithProducts(W, expMeans, vocabF, out=R, scaledB=S, RtB=vocabScale, colOrder=WColOrder)
         
         # 3/4 Update the vocabulary
-        vocab *= (R.T.dot(expMeans)).T # Awkward order to maintain sparsity (R is sparse, expMeans is dense)
+        vocab *= vocabScale # i.e. (R.T.dot(expMeans)).T
         vocab += vocabPrior
         vocab = normalizerows_ip(vocab)
-
-        R = sparseScalarQuotientOfDot(W, expMeans, vocab, out=R)
-        S = expMeans * R.dot(vocab.T)
+        vocabF[:,:] = vocab
         
         # 4/4 Reset the means to their original form, and log effect of vocab update
         #means = np.log(expMeans, out=expMeans)
-        debugFn (itr, vocab, "vocab", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, lxi, s, n)
+        if debugItr: _debug_with_bound (itr, vocab, "vocab", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, lxi, s, n)
         
         # And now this is the E-Step, though it's followed by updates for the
         # parameters also that handle the log-sum-exp approximation.
         
-        # Update the Variances
-        varcs = np.reciprocal(n[:,np.newaxis] * lxi + isigT.flat[::K+1])
-        debugFn (itr, varcs, "varcs", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, lxi, s, n)
-        
-        # Update the Means
-        vMat   = (s[:,np.newaxis] * lxi - 0.5) * n[:,np.newaxis] + S
-        rhsMat = vMat + isigT.dot(topicMean)
-        # for d in range(D):
-        #     means[d,:] = la.inv(isigT + ssp.diags(n[d] * lxi[d,:], 0)).dot(rhsMat[d,:])
-        means = varcs * rhsMat
-
-        means -= (means[:,0])[:,np.newaxis]
-        debugFn (itr, means, "means", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, lxi, s, n)
+        # Update the Variances and the Means. As the prior covariance is
+        # diagonal, for each document these are
+        #
+        # varcs = 1 / (n * lxi + diag(isigT))
+        # means = varcs * ((s * lxi - 0.5) * n + S + isigT.dot(topicMean))
+        #
+        # followed by subtracting the first mean from all means.
+        updateMeansAndVarcs(n, lxi, s, S, isigT_diag, isigT_diag * topicMean, means, varcs)
+        if debugItr: _debug_with_bound (itr, varcs, "varcs", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, lxi, s, n)
+        if debugItr: _debug_with_bound (itr, means, "means", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, lxi, s, n)
         
-        # Update the approximation parameters
-        lxi = 2 * negJakkolaOfDerivedXi(means, varcs, s)
-        debugFn (itr, lxi, "lxi", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, lxi, s, n)
+        # Update the approximation parameters, i.e. xi and twice the
+        # negated Jaakkola function of xi, in a single pass
+        updateApproxParams(means, varcs, s, xi, lxi)
+        if debugItr: _debug_with_bound (itr, lxi, "lxi", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, lxi, s, n)
         
         # s can sometimes grow unboundedly
         # If so Bouchard's suggested approach of fixing it at zero
         #
         #s = (np.sum(lxi * means, axis=1) + 0.25 * K - 0.5) / np.sum(lxi, axis=1)
-        debugFn (itr, s, "s", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, lxi, s, n)
+        if debugItr: _debug_with_bound (itr, s, "s", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, lxi, s, n)
         
         if logFrequency > 0 and itr % logFrequency == 0:
-            modelState = ModelState(K, topicMean, sigT, vocab, vocabPrior, dtype, MODEL_NAME)
+            modelState = ModelState(K, topicMean, np.diag(sigT_diag), vocab, vocabPrior, dtype, MODEL_NAME)
             queryState = QueryState(means, expMeans, varcs, lxi, s, n)
             
-            boundValues[bvIdx]  = var_bound(dataset, modelState, queryState)
-            likelyValues[bvIdx] = log_likelihood(dataset, modelState, queryState)
+            boundValues[bvIdx], likelyValues[bvIdx] = \
+                var_bound(dataset, modelState, queryState, xi=xi, returnLikelihood=True)
             boundIters[bvIdx]   = itr
             perp = perplexity_from_like(likelyValues[bvIdx], n.sum())
             
@@ -306,7 +319,7 @@ def train (dataset, modelState, queryState, trainPlan):
             
     
     return \
-        ModelState(K, topicMean, sigT, vocab, vocabPrior, dtype, MODEL_NAME), \
+        ModelState(K, topicMean, np.diag(sigT_diag), vocab, vocabPrior, dtype, MODEL_NAME), \
         QueryState(means, expMeans, varcs, lxi, s, n), \
         (boundIters, boundValues, likelyValues)
     
@@ -335,41 +348,68 @@ def query(dataset, modelState, queryState, queryPlan):
     
     # Necessary temp variables (notably the count of topic to word assignments
     # per topic per doc)
-    isigT = la.inv(sigT)
-    expMeans = np.exp(means - means.max(axis=1)[:,np.newaxis], out=expMeans)
-    R = sparseScalarQuotientOfDot(W, expMeans, vocab)
-    S = expMeans * R.dot(vocab.T)
+    isigT_isDiag = _isDiagonal(sigT)
+    if isigT_isDiag:
+        isigT = np.diag(1. / np.diag(sigT))
+    else:
+        isigT, _ = _choInverseAndLogDet(sigT)
+    isigT_mu = isigT.dot(topicMean)
+    expMeans = _shiftedExp(means, out=expMeans)
+    S = np.empty_like(means)
+    R = sparseScalarQuotientOfDotWithProducts(W, expMeans, np.asfortranarray(vocab), scaledB=S)
         
-    # Enable logging or not. If enabled, we need the inner product of the feat matrix
-    debugFn = _debug_with_bound if debug else _debug_with_nothing
+    # The variances and approximation parameters are updated in place by a
+    # compiled kernel, so everything it touches must be in the model dtype
+    updateVarcsAndApproxParams = compiled.updateVarcsAndApproxParams_f4 \
+                                 if dtype == np.float32 \
+                                 else compiled.updateVarcsAndApproxParams_f8
+    nDtype     = n.astype(dtype, copy=False)
+    isigT_diag = isigT.diagonal().astype(dtype)
+    varcs, lxi, s = varcs.astype(dtype, copy=False), lxi.astype(dtype, copy=False), s.astype(dtype, copy=False)
+    
+    # Work buffers for the means update, allocated once for all iterations
+    rhsMat = np.empty_like(means)
+    if isigT_isDiag:
+        precs = np.empty_like(means)
+    else:
+        precs = np.empty((D,K,K), dtype=isigT.dtype)
     
     # Iterate over parameters
     lastPerp = 1E+300 if dtype is np.float64 else 1E+30
     for itr in range(iterations):
-        # Update the Means
-        vMat   = (s[:,np.newaxis] * lxi - 0.5) * n[:,np.newaxis] + S
-        rhsMat = vMat + isigT.dot(topicMean)
-        for d in range(D):
-            try:
-                means[d,:] = la.inv(isigT + ssp.diags(n[d] * lxi[d,:], 0)).dot(rhsMat[d,:])
-            except ValueError as e:
-                print(str(e))
-                print ("Ah")
-        debugFn (itr, means, "means", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, lxi, s, n)
-        
-        # Update the Variances
-        varcs = 1./(n[:,np.newaxis] * lxi + isigT.flat[::K+1])
-        debugFn (itr, varcs, "varcs", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, lxi, s, n)
-        
-        # Update the approximation parameters
-        lxi = 2 * negJakkolaOfDerivedXi(means, varcs, s)
-        debugFn (itr, lxi, "lxi", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, lxi, s, n)
+        debugItr = debug and (logFrequency <= 0 or itr % logFrequency == 0)
+        # Update the Means, rhsMat = (s * lxi - 0.5) * n + S + isigT_mu
+        np.multiply(s[:,np.newaxis], lxi, out=rhsMat)
+        rhsMat -= 0.5
+        rhsMat *= n[:,np.newaxis]
+        rhsMat += S
+        rhsMat += isigT_mu
+        if isigT_isDiag:
+            # The per-document precision is diagonal, so its inverse is just
+            # the elementwise reciprocal
+            np.multiply(n[:,np.newaxis], lxi, out=precs)
+            precs += isigT.flat[::K+1]
+            np.divide(rhsMat, precs, out=means)
+        else:
+            # Solve all D systems (isigT + diag(n_d * lxi_d)) m_d = rhs_d at once
+            precs[:,:,:] = isigT
+            precs.reshape((D, K*K))[:,::K+1] += n[:,np.newaxis] * lxi
+            means[:,:] = np.linalg.solve(precs, rhsMat[:,:,np.newaxis])[:,:,0]
+        if debugItr: _debug_with_bound (itr, means, "means", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, lxi, s, n)
         
-        # s can sometimes grow unboundedly
-        # Follow Bouchard's suggested approach of fixing it at zero
+        # Update the Variances, and then the approximation parameters, in a
+        # single pass. For each document these are
         #
-        s = (np.sum(lxi * means, axis=1) + 0.25 * K - 0.5) / np.sum(lxi, axis=1)
-        debugFn (itr, s, "s", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, lxi, s, n)
+        # varcs = 1 / (n * lxi + diag(isigT))
+        # lxi   = 2 * negJakkola(sqrt((means - s)**2 + varcs**2))
+        # s     = (sum(lxi * means) + 0.25 * K - 0.5) / sum(lxi)
+        #
+        # s can sometimes grow unboundedly, in which case Bouchard suggests
+        # fixing it at zero, as we do in training.
+        updateVarcsAndApproxParams(nDtype, isigT_diag, means, varcs, s, lxi)
+        if debugItr: _debug_with_bound (itr, varcs, "varcs", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, lxi, s, n)
+        if debugItr: _debug_with_bound (itr, lxi, "lxi", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, lxi, s, n)
+        if debugItr: _debug_with_bound (itr, s, "s", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, lxi, s, n)
 
         like = log_likelihood(dataset, modelState, QueryState(means, expMeans, varcs, lxi, s, n))
         perp = perplexity_from_like(like, dataset.word_count)
@@ -384,6 +424,8 @@ def verifyProper(X, xName):
     '''
     Checks there's no NaNs or Infs
     '''
+    if np.isfinite(X).all():
+        return
     if np.isnan(X).any():
         print (xName + " contains NaNs")
     if np.isinf(X).any():
@@ -395,20 +437,30 @@ def log_likelihood (data, modelState, queryState):
     Return the log-likelihood of the given data W according to the model
     and the parameters inferred for the entries in W stored in the 
     queryState object.
+    
+    The expMeans matrix in the query state is used as a work buffer.
     '''
-    return np.sum( \
-        sparseScalarProductOfSafeLnDot(\
-            data.words, \
-            rowwise_softmax(queryState.means), \
-            modelState.vocab \
-        ).data \
-    )
+    means, expMeans, docLens = queryState.means, queryState.expMeans, queryState.docLens
+    
+    # log(softmax(means).dot(vocab)) == log(expMeans.dot(vocab)) - log(sum(expMeans)),
+    # so we can avoid normalising expMeans
+    expMeans = _shiftedExp(means, out=expMeans)
+    lnDotSum = np.sum(sparseScalarProductOfSafeLnDot(data.words, expMeans, modelState.vocab).data)
+    
+    return lnDotSum - np.dot(docLens, np.log(expMeans.sum(axis=1)))
     
-def var_bound(data, modelState, queryState):
+def var_bound(data, modelState, queryState, xi=None, returnLikelihood=False):
     '''
     Determines the variational bounds. Values are mutated in place, but are
     reset afterwards to their initial values. So it's safe to call in a serial
     manner.
+    
+    If the caller already has the value of xi derived from the query state
+    it may be passed in to avoid recalculating it.
+    
+    If returnLikelihood is true, a tuple of the bound and the log likelihood
+    (as given by log_likelihood()) is returned. This is cheaper than calling
+    the two functions separately, as both share the same sparse product.
     '''
 
     # Unpack the the structs, for ease of access and efficiency
@@ -418,17 +470,25 @@ def var_bound(data, modelState, queryState):
     K, topicMean, sigT, vocab     = modelState.K, modelState.topicMean, modelState.sigT, modelState.vocab
     
     # Calculate some implicit  variables
-    xi = _deriveXi(means, varcs, s)
-    isigT = la.inv(sigT)
+    if xi is None:
+        xi = _deriveXi(means, varcs, s)
     
     bound = 0
     
     # Distribution over document topics
     bound -= (D*K)/2. * LN_OF_2_PI
-    bound -= D/2. * la.det(sigT)
     diff   = means - topicMean[np.newaxis,:]
-    bound -= 0.5 * np.sum (diff.dot(isigT) * diff)
-    bound -= 0.5 * np.sum (varcs * np.diag(isigT)[np.newaxis,:]) # = -0.5 * sum_d tr(V_d \Sigma^{-1}) when V_d is diagonal only.
+    if _isDiagonal(sigT):
+        sigT_diag  = np.diag(sigT)
+        isigT_diag = 1. / sigT_diag
+        bound -= D/2. * np.sum(np.log(sigT_diag))
+        bound -= 0.5 * np.sum (diff * diff * isigT_diag[np.newaxis,:])
+    else:
+        isigT, logDetSigT = _choInverseAndLogDet(sigT)
+        isigT_diag = np.diag(isigT)
+        bound -= D/2. * logDetSigT
+        bound -= 0.5 * np.sum (diff.dot(isigT) * diff)
+    bound -= 0.5 * np.sum (varcs * isigT_diag[np.newaxis,:]) # = -0.5 * sum_d tr(V_d \Sigma^{-1}) when V_d is diagonal only.
        
     # And its entropy
     bound += 0.5 * D * K * LN_OF_2_PI_E + 0.5 * np.sum(np.log(varcs)) 
@@ -443,8 +503,9 @@ def var_bound(data, modelState, queryState):
     # The last term of line 1 gets cancelled out by part of the first term in line 2
     # so neither are included here
     
-    expMeans = np.exp(means - means.max(axis=1)[:,np.newaxis], out=expMeans)
-    bound -= -np.sum(sparseScalarProductOfSafeLnDot(W, expMeans, vocab).data)
+    expMeans = _shiftedExp(means, out=expMeans)
+    lnDotSum = np.sum(sparseScalarProductOfSafeLnDot(W, expMeans, vocab).data)
+    bound -= -lnDotSum
     
     bound -= np.sum(docLens[:,np.newaxis] * lxi * ((s*s)[:,np.newaxis] - (xi * xi)))
     bound += np.sum(0.5 * docLens[:,np.newaxis] * (s[:,np.newaxis] + xi))
@@ -453,6 +514,10 @@ def var_bound(data, modelState, queryState):
     
     bound -= np.dot(s, docLens)
     
+    if returnLikelihood:
+        # log(softmax(means).dot(vocab)) == log(expMeans.dot(vocab)) - log(sum(expMeans))
+        likely = lnDotSum - np.dot(docLens, np.log(expMeans.sum(axis=1)))
+        return bound, likely
     
     return bound
         
@@ -478,9 +543,10 @@ def negJakkola(vec):
     '''
     
     # COPY AND PASTE BETWEEN THIS AND negJakkolaOfDerivedXi()
-    return 0.5/vec * (1./(1 + np.exp(-vec)) - 0.5)
+    # Note 0.5/x * (sigmoid(x) - 0.5) == 0.25/x * tanh(x/2)
+    return 0.25/vec * np.tanh(0.5 * vec)
 
-def negJakkolaOfDerivedXi(means, varcs, s, d = None):
+def negJakkolaOfDerivedXi(means, varcs, s, d = None, xi = None, out = None):
     '''
     The negated version of the Jakkola expression which was used in Bouchard's NIPS '07
     softmax bound calculated using an estimate of xi derived from lambda, nu, and s
@@ -490,29 +556,39 @@ def negJakkolaOfDerivedXi(means, varcs, s, d = None):
     s       - The Dx1 vector of offsets.
     d       - the document index (for lambda and nu). If not specified we construct
               the full matrix of A(xi_dk)
+    xi      - optionally the DxK matrix of xi values if these have already been
+              derived from lambda, nu and s, in which case they're not recalculated
+    out     - optionally a DxK matrix, distinct from xi, into which the full
+              matrix of results is written. Ignored if d is specified.
     '''
-    err = errorMsg(means)
-    if err is not None:
-        print ("Means " + err)
-        print ("")
-        
-    err = errorMsg(s)
-    if err is not None:
-        print ("s " + err)
-        print ("")
-        
-    err = errorMsg(varcs)
-    if err is not None:
-        print ("lxi " + err)
-        print ("")
+    if DEBUG:
+        err = errorMsg(means)
+        if err is not None:
+            print ("Means " + err)
+            print ("")
+            
+        err = errorMsg(s)
+        if err is not None:
+            print ("s " + err)
+            print ("")
+            
+        err = errorMsg(varcs)
+        if err is not None:
+            print ("lxi " + err)
+            print ("")
     
     # COPY AND PASTE BETWEEN THIS AND negJakkola()
+    # Note 0.5/x * (sigmoid(x) - 0.5) == 0.25/x * tanh(x/2)
     if d is not None:
         vec = (np.sqrt (means[d,:]**2 - 2 * means[d,:] * s[d] + s[d]**2 + varcs[d,:]**2))
-        return 0.5/vec * (1./(1 + np.exp(-vec)) - 0.5)
+        return 0.25/vec * np.tanh(0.5 * vec)
     else:
-        mat = _deriveXi(means, varcs, s)
-        return 0.5/mat * (1./(1 + np.exp(-mat)) - 0.5)
+        mat = _deriveXi(means, varcs, s) if xi is None else xi
+        result = np.multiply(mat, 0.5, out=out)
+        np.tanh(result, out=result)
+        result *= 0.25
+        result /= mat
+        return result
     
 
 def jakkolaOfDerivedXi(means, varcs, s, d = None):
@@ -526,20 +602,21 @@ def jakkolaOfDerivedXi(means, varcs, s, d = None):
     d    - the document index (for lambda and nu). If not specified we construct
            the full matrix of A(xi_dk)
     '''
-    err = errorMsg(means)
-    if err is not None:
-        print ("Means " + err)
-        print ("")
-        
-    err = errorMsg(s)
-    if err is not None:
-        print ("s " + err)
-        print ("")
-        
-    err = errorMsg(varcs)
-    if err is not None:
-        print ("lxi " + err)
-        print ("")
+    if DEBUG:
+        err = errorMsg(means)
+        if err is not None:
+            print ("Means " + err)
+            print ("")
+            
+        err = errorMsg(s)
+        if err is not None:
+            print ("s " + err)
+            print ("")
+            
+        err = errorMsg(varcs)
+        if err is not None:
+            print ("lxi " + err)
+            print ("")
     
     # COPY AND PASTE BETWEEN THIS AND negJakkola()
     if d is not None:
@@ -562,27 +639,89 @@ def vocab(modelState):
 # PRIVATE HELPERS
 # ==============================================================
 
-def _deriveXi (means, varcs, s):
+def _deriveXi (means, varcs, s, out=None):
     '''
     Derives a value for xi. This is not normally needed directly, as we
-    normally just work with the negJakkola() function of it
+    normally just work with the negJakkola() function of it.
+    
+    If out is given, the result is written into it.
+    '''
+    if out is None:
+        out = np.empty_like(means)
+    
+    # sqrt((means - s)**2 + varcs**2), expanded in place
+    np.subtract(means, s[:,np.newaxis], out=out)
+    out *= out
+    out += varcs * varcs
+    return np.sqrt(out, out=out)
+
+def _shiftedExp (means, out=None):
+    '''
+    Returns exp(means - max(means)), where the max is taken over each row,
+    i.e. the row-wise softmax of the means, without the normalisation.
+    
+    If out is given, the result is written into it.
     '''
-    return np.sqrt(means**2 - 2 * means * s[:,np.newaxis] + (s**2)[:,np.newaxis] + varcs**2)   
+    out = np.subtract(means, means.max(axis=1)[:,np.newaxis], out=out)
+    return np.exp(out, out=out)
+
+def _oasCovDiag (X, work=None):
+    '''
+    Returns the diagonal of the Oracle Approximating Shrinkage (OAS) estimate
+    of the covariance of the rows of X, identical to the diagonal of the
+    matrix returned by sklearn.covariance.oas(X, assume_centered=False).
+    
+    The full empirical covariance is still needed to determine the amount
+    of shrinkage, but the shrunk matrix itself is never built.
+    
+    If given, work is a matrix the same shape as X used as scratch space.
+    '''
+    N, P = X.shape
+    diff   = np.subtract(X, X.mean(axis=0), out=work)
+    empCov = diff.T.dot(diff)
+    empCov /= N
+    
+    covDiag = np.diag(empCov).copy()
+    mu      = covDiag.sum() / P
+    alpha   = np.vdot(empCov, empCov) / (P * P)
+    num     = alpha + mu * mu
+    den     = (N + 1) * (alpha - mu * mu / P)
+    shrinkage = 1. if den == 0 else min(num / den, 1.)
+    
+    covDiag *= 1. - shrinkage
+    covDiag += shrinkage * mu
+    return covDiag
+
+def _choInverseAndLogDet (sigT):
+    '''
+    Returns the inverse of the given positive-definite matrix and the log
+    of its determinant, both derived from a single Cholesky factorisation.
+    '''
+    cho = la.cho_factor(sigT, lower=True, check_finite=False)
+    isigT     = la.cho_solve(cho, np.eye(sigT.shape[0], dtype=sigT.dtype), check_finite=False)
+    logDetSig = 2 * np.sum(np.log(np.diag(cho[0])))
+    
+    return isigT, logDetSig
+
+def _isDiagonal (mat):
+    '''
+    Returns true if the given square matrix has no non-zero entries off
+    its diagonal
+    '''
+    return np.count_nonzero(mat - np.diag(np.diag(mat))) == 0
 
 last = 0
 def _debug_with_bound (itr, var_value, var_name, W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, lxi, s, n):
-    if np.isnan(var_value).any():
-        printStderr ("WARNING: " + var_name + " contains NaNs")
-    if np.isinf(var_value).any():
-        printStderr ("WARNING: " + var_name + " contains INFs")
+    if not np.isfinite(var_value).all():
+        printStderr ("WARNING: " + var_name + " contains NaNs or INFs")
     global last
     
     addendum = ""
     if var_name == "sigT":
         try:
-            addendum = "det(sigT) = %g" % (la.det(sigT))
+            addendum = "log det(sigT) = %g" % (_choInverseAndLogDet(sigT)[1])
         except:
-            addendum = "det(sigT) = <undefined>"
+            addendum = "log det(sigT) = <undefined>"
 
     model, query =  ModelState(K, topicMean, sigT, vocab, vocabPrior, dtype, MODEL_NAME), QueryState(means, means.copy(), varcs, lxi, s, n)
     perp  = perplexity_from_like(log_likelihood(DataSet(W), model, query), W.sum())
@@ -598,19 +737,18 @@ def _debug_with_bound (itr, var_value, var_name, W, K, topicMean, sigT, vocab, v
     last = bound
 
 
-def _debug_with_nothing (itr, var_value, var_name, W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, lxi, s, n):
-    pass
-
 def errorMsg(mat):
     '''
     If somethings wrong, return an error message, otherwise return None
     '''
-    if np.isnan(mat).any() and np.isinf(mat).any():
+    if np.isfinite(mat).all():
+        return None
+    
+    hasNans, hasInfs = np.isnan(mat).any(), np.isinf(mat).any()
+    if hasNans and hasInfs:
         return "Matrix has NaNs and INFs"
-    elif np.isnan(mat).any() :
+    elif hasNans:
         return "Matrix has NaNs"
-    elif np.isinf(mat).any():
-        return "Matrix has INFs"
     else:
-        return None
+        return "Matrix has INFs"
     
@@ -18,16 +18,16 @@ import time
 from collections import namedtuple
 import numpy as np
 import scipy.linalg as la
+import scipy.linalg.blas as blas
 import scipy.sparse as ssp
 import scipy.special as fns
 import numpy.random as rd
 
 from sidetopics.util.array_utils import normalizerows_ip
 from sidetopics.util.sigmoid_utils import rowwise_softmax, scaledSelfSoftDot
-from sidetopics.util.sparse_elementwise import sparseScalarQuotientOfDot, \
-    sparseScalarProductOfSafeLnDot
+from sidetopics.util.sparse_elementwise import sparseScalarQuotientOfDotWithProducts, \
+    sparseScalarProductOfSafeLnDot, csrColumnOrder
 from sidetopics.util.misc import printStderr, static_var
-from sidetopics.util.overflow_safe import safe_log_det
 from sidetopics.model.evals import perplexity_from_like
 from sidetopics.model.common import DataSet
 
@@ -39,6 +39,7 @@ from math import isnan
 # ==============================================================
 
 DTYPE=np.float32 # A default, generally we should specify this in the model setup
+                 # Regardless, the KxK prior covariance is always double-precision
 
 LN_OF_2_PI   = log(2 * pi)
 LN_OF_2_PI_E = log(2 * pi * e)
@@ -51,6 +52,11 @@ NIW_MU=0
 
 VocabPrior = 1.1
 
+# If true, the prior covariance is fixed to the identity rather than learnt.
+# This was previously forced by a debugging override, and as learning it
+# currently causes it to collapse towards zero, it remains the default.
+FIX_SIGT_TO_IDENTITY=True
+
 DEBUG=False
 
 MODEL_NAME="ctm/bohning"
@@ -61,7 +67,7 @@ MODEL_NAME="ctm/bohning"
 
 TrainPlan = namedtuple ( \
     'TrainPlan',
-    'iterations epsilon logFrequency fastButInaccurate debug')                            
+    'iterations epsilon logFrequency fastButInaccurate debug batchSize')
 
 QueryState = namedtuple ( \
     'QueryState', \
@@ -81,15 +87,13 @@ def wordDists(model):
     return model.vocab
 
 def topicDists(query):
-    result  = np.exp(query.topicMean - query.topicMean.sum(axis=1))
-    result /= result.sum(axis=1)
-    return result
+    return rowwise_softmax(query.means)
 
 def newModelFromExisting(model):
     '''
     Creates a _deep_ copy of the given model
     '''
-    return ModelState(model.K, model.topicMean.copy(), model.sigT.copy(), model.vocab.copy(), model.vocabPrior, model.A.copy(), model.dtype, model.name)
+    return ModelState(model.K, model.topicMean.copy(), model.sigT.copy(), model.vocab.copy(order='K'), model.vocabPrior, model.A.copy(), model.dtype, model.name)
 
 def newModelAtRandom(data, K, vocabPrior=VocabPrior, dtype=DTYPE):
     '''
@@ -108,17 +112,38 @@ def newModelAtRandom(data, K, vocabPrior=VocabPrior, dtype=DTYPE):
     assert K > 1, "There must be at least two topics"
     
     _,T = data.words.shape
-
-    # Pick some random documents as the vocabulary
-    vocab = np.ones((K,T), dtype=dtype)
+    docLens = np.asarray(data.words.sum(axis=1)).ravel()
+
+    # Pick some random documents as the vocabulary. Rather than drawing
+    # documents one at a time until we have at least 1000 words, we draw
+    # a batch which should usually suffice, and take as many of those as
+    # are needed.
+    # The documents chosen for every topic are recorded in a sparse
+    # (K-1)xD selection matrix, so the word-counts for all topics are
+    # summed in a single sparse product rather than in K-1 separate
+    # row-slices of the document-term matrix.
+    sampleSize = 2 * int(1000 / max(docLens.mean(), 1)) + 1
+    topicIds, docIds = [], []
     for k in range(1, K):
-        docLenSum = 0
-        while docLenSum < 1000:
-            randomDoc  = rd.randint(0, data.doc_count, size=1)
-            sample_doc = data.words[randomDoc, :]
-            vocab[k, sample_doc.indices] += sample_doc.data
-            docLenSum += sample_doc.sum()
-        vocab[k,:] /= vocab[k,:].sum()
+        randomDocs = rd.randint(0, data.doc_count, size=sampleSize)
+        docLenSums = np.cumsum(docLens[randomDocs])
+        while docLenSums[-1] < 1000:
+            moreDocs   = rd.randint(0, data.doc_count, size=sampleSize)
+            randomDocs = np.concatenate((randomDocs, moreDocs))
+            docLenSums = np.concatenate((docLenSums, docLenSums[-1] + np.cumsum(docLens[moreDocs])))
+        
+        docCount = np.searchsorted(docLenSums, 1000) + 1
+        topicIds.append(np.full(docCount, k - 1))
+        docIds.append(randomDocs[:docCount])
+    
+    topicIds, docIds = np.concatenate(topicIds), np.concatenate(docIds)
+    selection = ssp.csr_matrix((np.ones(len(docIds), dtype=dtype), (topicIds, docIds)), shape=(K-1, data.doc_count))
+    
+    # The vocabulary is stored in column-major form, as this is how the
+    # sparse kernels read it.
+    vocab = np.ones((K,T), dtype=dtype, order='F')
+    vocab[1:,:] += selection.dot(data.words).toarray()
+    vocab[1:,:] /= vocab[1:,:].sum(axis=1)[:,np.newaxis]
 
     # stop-word vocab
     vocab[0,:]  = data.words.sum(axis=0)
@@ -129,7 +154,7 @@ def newModelAtRandom(data, K, vocabPrior=VocabPrior, dtype=DTYPE):
     
 #    isigT = np.eye(K)
 #    sigT  = la.inv(isigT)
-    sigT  = np.eye(K, dtype=dtype)
+    sigT  = np.eye(K)
     
     A = 0.5 * (np.eye(K, dtype=dtype) - 1./(K+1))
     
@@ -152,23 +177,29 @@ def newQueryState(data, modelState):
     
     D,T = data.words.shape
     assert T == vocab.shape[1], "The number of terms in the document-term matrix (" + str(T) + ") differs from that in the model-states vocabulary parameter " + str(vocab.shape[1])
-    docLens = np.squeeze(np.asarray(data.words.sum(axis=1)))
+    docLens = np.squeeze(np.asarray(data.words.sum(axis=1))).astype(dtype, copy=False)
 
     base     = normalizerows_ip(rd.random((D,K*2)).astype(dtype))
-    means    = base[:,:K]
-    expMeans = base[:,K:]
+    # Copies rather than views of base, so every row is contiguous
+    means    = np.ascontiguousarray(base[:,:K])
+    expMeans = np.ascontiguousarray(base[:,K:])
     varcs    = np.ones((D,K), dtype=dtype)
     
     return QueryState(means, expMeans, varcs, docLens)
 
 
-def newTrainPlan(iterations=100, epsilon=2, logFrequency=10, fastButInaccurate=False, debug=DEBUG):
+def newTrainPlan(iterations=100, epsilon=2, logFrequency=10, fastButInaccurate=False, debug=DEBUG, batchSize=0):
     '''
     Create a training plan determining how many iterations we
     process, how often we plot the results, how often we log
     the variational bound, etc.
+    
+    If batchSize is positive, training uses incremental variational
+    inference over mini-batches of that many documents, in which case
+    an iteration is a single pass over all the batches. This is
+    ignored by query()
     '''
-    return TrainPlan(iterations, epsilon, logFrequency, fastButInaccurate, debug)
+    return TrainPlan(iterations, epsilon, logFrequency, fastButInaccurate, debug, batchSize)
 
 def train (data, modelState, queryState, trainPlan):
     '''
@@ -189,6 +220,9 @@ def train (data, modelState, queryState, trainPlan):
     updated in place, so make a defensive copy if you want itr)
     A new query object with the update query parameters
     '''
+    if trainPlan.batchSize > 0:
+        return _trainIncremental(data, modelState, queryState, trainPlan)
+    
     W   = data.words
     D,_ = W.shape
     
@@ -200,19 +234,29 @@ def train (data, modelState, queryState, trainPlan):
     # Book-keeping for logs
     boundIters, boundValues, likelyValues = [], [], []
     
-    debugFn = _debug_with_bound if debug else _debug_with_nothing
+    # Initialize some working variables. R has the same non-zero pattern
+    # as W, and only its values are ever overwritten, so it shares W's indices
+    R = ssp.csr_matrix((np.empty_like(W.data), W.indices, W.indptr), shape=W.shape, copy=False)
+    V    = np.empty_like(expMeans)
+    work = np.empty_like(expMeans)
     
-    # Initialize some working variables
-    isigT = la.inv(sigT)
-    R = W.copy()
+    # The sparse kernels read vocab a column at a time, so it should be
+    # column-major, and they walk W in column order when updating it
+    vocab      = np.asfortranarray(vocab)
+    vocabScale = np.empty(vocab.shape, dtype=vocab.dtype, order='F')
+    WColOrder  = csrColumnOrder(W)
     
     pseudoObsMeans = K + NIW_PSEUDO_OBS_MEAN
     pseudoObsVar   = K + NIW_PSEUDO_OBS_VAR
     priorSigT_diag = np.ndarray(shape=(K,), dtype=dtype)
     priorSigT_diag.fill (NIW_PSI)
+    centredMeans = np.empty(means.shape, dtype=np.float64) # sigT is always estimated in double
     
     # Iterate over parameters
     for itr in range(iterations):
+        # In debug mode the bound is checked after every update, but only on
+        # the iterations where it would be logged in any case
+        debugItr = debug and (logFrequency <= 0 or itr % logFrequency == 0)
         
         # We start with the M-Step, so the parameters are consistent with our
         # initialisation of the RVs when we do the E-Step
@@ -221,68 +265,217 @@ def train (data, modelState, queryState, trainPlan):
         topicMean = means.sum(axis = 0) / (D + pseudoObsMeans) \
                   if USE_NIW_PRIOR \
                   else means.mean(axis=0)
-        debugFn (itr, topicMean, "topicMean", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, A, docLens)
+        if debugItr: _debug_with_bound (itr, topicMean, "topicMean", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, A, docLens)
         
-        if USE_NIW_PRIOR:
-            diff = means - topicMean[np.newaxis,:]
-            sigT = diff.T.dot(diff) \
-                 + pseudoObsVar * np.outer(topicMean, topicMean)
-            sigT += np.diag(varcs.mean(axis=0) + priorSigT_diag)
+        if FIX_SIGT_TO_IDENTITY:
+            sigT = np.eye(K)
+        elif USE_NIW_PRIOR:
+            np.subtract(means, topicMean[np.newaxis,:], out=centredMeans, dtype=np.float64)
+            sigT  = _selfInnerProduct(centredMeans)
+            sigT += pseudoObsVar * np.outer(topicMean, topicMean)
+            sigT.flat[::K+1] += varcs.mean(axis=0) + priorSigT_diag
             sigT /= (D + pseudoObsVar - K)
         else:
-            sigT = np.cov(means.T) if sigT.dtype == np.float64 else np.cov(means.T).astype(dtype)
-            sigT += np.diag(varcs.mean(axis=0))
+            # i.e. np.cov(means.T), as topicMean is the mean of the means
+            np.subtract(means, topicMean[np.newaxis,:], out=centredMeans, dtype=np.float64)
+            sigT = _selfInnerProduct(centredMeans, 1. / (D - 1))
+            sigT.flat[::K+1] += varcs.mean(axis=0)
            
         if diagonalPriorCov:
-            diag = np.diag(sigT)
-            sigT = np.diag(diag)
-            isigT = np.diag(1./ diag)
-        else:
-            isigT = la.inv(sigT)
-
-        # FIXME Undo debug
-        sigT  = np.eye(K)
-        isigT = la.inv(sigT)
+            sigT = np.diag(np.diag(sigT))
+        
+        # The prior precision is only ever used via this factorisation
+        sigTCho, isigT_mu, isigT_diag = _factorisePrior(sigT, topicMean, dtype)
         
-        debugFn (itr, sigT, "sigT", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, A, docLens)
+        if debugItr: _debug_with_bound (itr, sigT, "sigT", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, A, docLens)
 #        print("                sigT.det = " + str(la.det(sigT)))
         
         
-        # Building Blocks - temporarily replaces means with exp(means)
-        expMeans = np.exp(means - means.max(axis=1)[:,np.newaxis], out=expMeans)
-        R = sparseScalarQuotientOfDot(W, expMeans, vocab, out=R)
+        # Building Blocks. A single traversal of W gives both the vocabulary
+        # update and V = expMeans * R.dot(vocab.T) for the E-Step, so the
+        # E-Step uses the vocabulary the responsibilities were derived from.
+        expMeans = _shiftedExp(means, out=expMeans)
+        R = sparseScalarQuotientOfDotWithProducts(W, expMeans, vocab, out=R, scaledB=V, RtB=vocabScale, colOrder=WColOrder)
         
         # Update the vocabulary
-        vocab *= (R.T.dot(expMeans)).T # Awkward order to maintain sparsity (R is sparse, expMeans is dense)
+        vocab *= vocabScale # i.e. (R.T.dot(expMeans)).T
         vocab += vocabPrior
         vocab = normalizerows_ip(vocab)
-        
-        # Reset the means to their original form, and log effect of vocab update
-        R = sparseScalarQuotientOfDot(W, expMeans, vocab, out=R)
-        V = expMeans * R.dot(vocab.T)
 
-        debugFn (itr, vocab, "vocab", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, A, docLens)
+        if debugItr: _debug_with_bound (itr, vocab, "vocab", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, A, docLens)
         
         # And now this is the E-Step, though itr's followed by updates for the
         # parameters also that handle the log-sum-exp approximation.
         
         # Update the Variances: var_d = (2 N_d * A + isigT)^{-1}
-        varcs = np.reciprocal(docLens[:,np.newaxis] * (K-1.)/K + np.diagonal(sigT))
-        debugFn (itr, varcs, "varcs", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, A, docLens)
+        np.add(docLens[:,np.newaxis] * (K-1.)/K, isigT_diag, out=varcs)
+        np.reciprocal(varcs, out=varcs)
+        if debugItr: _debug_with_bound (itr, varcs, "varcs", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, A, docLens)
         
         # Update the Means
-        rhs = V.copy()
-        rhs += docLens[:,np.newaxis] * means.dot(A) + isigT.dot(topicMean)
-        rhs -= docLens[:,np.newaxis] * rowwise_softmax(means, out=means)
+        # V is recalculated at the start of every iteration, so it's safe to
+        # overwrite. As means is unchanged since expMeans was derived from it,
+        # we can reuse expMeans to get softmax(means)
+        rhs = _addMeansRhsTerms(V, means, expMeans, docLens, A, isigT_mu, work)
         if diagonalPriorCov:
-            means = varcs * rhs
+            np.multiply(varcs, rhs, out=means)
         else:
-            for d in range(D):
-                means[d, :] = la.inv(isigT + docLens[d] * A).dot(rhs[d, :])
+            means[:,:] = _solveForMeans(sigTCho, A, docLens, rhs, work=work)
         
 #         means -= (means[:,0])[:,np.newaxis]
         
-        debugFn (itr, means, "means", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, A, docLens)
+        if debugItr: _debug_with_bound (itr, means, "means", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, A, docLens)
+        
+        if logFrequency > 0 and itr % logFrequency == 0:
+            modelState = ModelState(K, topicMean, sigT, vocab, vocabPrior, A, dtype, MODEL_NAME)
+            queryState = QueryState(means, expMeans, varcs, docLens)
+            
+            boundValues.append(var_bound(data, modelState, queryState))
+            likelyValues.append(log_likelihood(data, modelState, queryState))
+            boundIters.append(itr)
+            
+            print (time.strftime('%X') + " : Iteration %d: bound %f \t Perplexity: %.2f" % (itr, boundValues[-1], perplexity_from_like(likelyValues[-1], docLens.sum())))
+            if len(boundValues) > 1:
+                if boundValues[-2] > boundValues[-1]:
+                    if debug: printStderr ("ERROR: bound degradation: %f > %f" % (boundValues[-2], boundValues[-1]))
+        
+                # Check to see if the improvement in the bound has fallen below the threshold
+                if itr > 100 and len(likelyValues) > 3 \
+                    and abs(perplexity_from_like(likelyValues[-1], docLens.sum()) - perplexity_from_like(likelyValues[-2], docLens.sum())) < 1.0:
+                    break
+
+    return \
+        ModelState(K, topicMean, sigT, vocab, vocabPrior, A, dtype, MODEL_NAME), \
+        QueryState(means, expMeans, varcs, docLens), \
+        (np.array(boundIters), np.array(boundValues), np.array(likelyValues))
+
+def _trainIncremental (data, modelState, queryState, trainPlan):
+    '''
+    Infers the topic distributions using incremental variational inference,
+    as described by Neal & Hinton for EM, and since applied to LDA.
+    
+    The documents are split into mini-batches of trainPlan.batchSize
+    consecutive documents. After the local parameters of a batch are
+    updated, that batch's old contribution to the global sufficient
+    statistics is swapped for its new one, and the global parameters
+    re-estimated. So the global parameters improve many times per pass
+    over the corpus, rather than once, and training converges in fewer
+    passes.
+    
+    Parameters and return values are as for train(). Note that a KxT
+    matrix of expected word-counts is stored for each batch.
+    '''
+    W   = data.words
+    D,T = W.shape
+    
+    # Unpack the the structs, for ease of access and efficiency
+    iterations, epsilon, logFrequency, diagonalPriorCov, debug, batchSize = trainPlan.iterations, trainPlan.epsilon, trainPlan.logFrequency, trainPlan.fastButInaccurate, trainPlan.debug, trainPlan.batchSize
+    means, expMeans, varcs, docLens = queryState.means, queryState.expMeans, queryState.varcs, queryState.docLens
+    K, topicMean, sigT, vocab, vocabPrior, A, dtype = modelState.K, modelState.topicMean, modelState.sigT, modelState.vocab, modelState.vocabPrior, modelState.A, modelState.dtype
+    
+    # Book-keeping for logs
+    boundIters, boundValues, likelyValues = [], [], []
+    
+    # Split the corpus into batches. Each batch's rows of W, and of the
+    # quotient matrix R, are CSR matrices sharing the arrays of the full
+    # matrices, so only the row pointers are copied.
+    R = ssp.csr_matrix((np.empty_like(W.data), W.indices, W.indptr), shape=W.shape, copy=False)
+    batches = []
+    for start in range(0, D, batchSize):
+        end = min(start + batchSize, D)
+        p, q   = W.indptr[start], W.indptr[end]
+        indptr = W.indptr[start:end+1] - p
+        WB = ssp.csr_matrix((W.data[p:q], W.indices[p:q], indptr), shape=(end - start, T), copy=False)
+        RB = ssp.csr_matrix((R.data[p:q], W.indices[p:q], indptr), shape=(end - start, T), copy=False)
+        batches.append((start, end, WB, RB, csrColumnOrder(WB)))
+    
+    V    = np.empty_like(expMeans)
+    work = np.empty_like(expMeans)
+    vocab      = np.asfortranarray(vocab)
+    vocabScale = np.empty(vocab.shape, dtype=vocab.dtype, order='F')
+    
+    pseudoObsMeans = K + NIW_PSEUDO_OBS_MEAN
+    pseudoObsVar   = K + NIW_PSEUDO_OBS_VAR
+    
+    # The global sufficient statistics. These are repeatedly decremented and
+    # incremented, so are kept in double-precision to limit round-off.
+    meansSum   = means.sum(axis=0, dtype=np.float64)
+    meansOuter = means.T.dot(means).astype(np.float64)
+    varcsSum   = varcs.sum(axis=0, dtype=np.float64)
+    
+    batchCounts = []
+    vocabCounts = np.zeros(vocab.shape, dtype=np.float64, order='F')
+    for start, end, WB, RB, colOrder in batches:
+        expMeansB = _shiftedExp(means[start:end], out=expMeans[start:end])
+        sparseScalarQuotientOfDotWithProducts(WB, expMeansB, vocab, out=RB, RtB=vocabScale, colOrder=colOrder)
+        batchCounts.append(vocab * vocabScale)
+        vocabCounts += batchCounts[-1]
+    
+    vocab[:,:] = vocabCounts
+    vocab += vocabPrior
+    vocab = normalizerows_ip(vocab)
+    
+    # Iterate over parameters, each iteration being a pass over all batches
+    for itr in range(iterations):
+        debugItr = debug and (logFrequency <= 0 or itr % logFrequency == 0)
+        for b, (start, end, WB, RB, colOrder) in enumerate(batches):
+            meansB, varcsB, docLensB = means[start:end], varcs[start:end], docLens[start:end]
+            
+            # Re-estimate the prior from the sufficient statistics
+            topicMean = (meansSum / (D + pseudoObsMeans) \
+                         if USE_NIW_PRIOR \
+                         else meansSum / D).astype(dtype)
+            if FIX_SIGT_TO_IDENTITY:
+                sigT = np.eye(K)
+            elif USE_NIW_PRIOR:
+                sigT = meansOuter - np.outer(topicMean, meansSum) - np.outer(meansSum, topicMean) \
+                     + (D + pseudoObsVar) * np.outer(topicMean, topicMean)
+                sigT.flat[::K+1] += varcsSum / D + NIW_PSI
+                sigT /= (D + pseudoObsVar - K)
+            else:
+                sigT = (meansOuter - np.outer(meansSum, meansSum) / D) / (D - 1)
+                sigT.flat[::K+1] += varcsSum / D
+            
+            if diagonalPriorCov:
+                sigT = np.diag(np.diag(sigT))
+            
+            sigTCho, isigT_mu, isigT_diag = _factorisePrior(sigT, topicMean, dtype)
+            
+            # As in train(), one traversal of the batch gives both its current
+            # word-counts and V for its E-Step. Swap its old word-counts for
+            # these, and re-estimate the vocabulary
+            expMeansB = _shiftedExp(meansB, out=expMeans[start:end])
+            sparseScalarQuotientOfDotWithProducts(WB, expMeansB, vocab, out=RB, scaledB=V[start:end], RtB=vocabScale, colOrder=colOrder)
+            
+            vocabCounts -= batchCounts[b]
+            np.multiply(vocab, vocabScale, out=batchCounts[b])
+            vocabCounts += batchCounts[b]
+            
+            vocab[:,:] = vocabCounts
+            vocab += vocabPrior
+            vocab = normalizerows_ip(vocab)
+            
+            # Remove this batch's contribution to the statistics of the prior
+            meansSum   -= meansB.sum(axis=0)
+            meansOuter -= meansB.T.dot(meansB)
+            varcsSum   -= varcsB.sum(axis=0)
+            
+            # The E-Step for this batch, exactly as in train()
+            np.add(docLensB[:,np.newaxis] * (K-1.)/K, isigT_diag, out=varcsB)
+            np.reciprocal(varcsB, out=varcsB)
+            
+            rhs = _addMeansRhsTerms(V[start:end], meansB, expMeansB, docLensB, A, isigT_mu, work[start:end])
+            if diagonalPriorCov:
+                np.multiply(varcsB, rhs, out=meansB)
+            else:
+                meansB[:,:] = _solveForMeans(sigTCho, A, docLensB, rhs, work=work[start:end])
+            
+            # Add back this batch's new contribution to the statistics of the prior
+            meansSum   += meansB.sum(axis=0)
+            meansOuter += meansB.T.dot(meansB)
+            varcsSum   += varcsB.sum(axis=0)
+        
+        if debugItr: _debug_with_bound (itr, means, "means", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, A, docLens)
         
         if logFrequency > 0 and itr % logFrequency == 0:
             modelState = ModelState(K, topicMean, sigT, vocab, vocabPrior, A, dtype, MODEL_NAME)
@@ -326,36 +519,38 @@ def query(data, modelState, queryState, queryPlan):
     means, expMeans, varcs, n = queryState.means, queryState.expMeans, queryState.varcs, queryState.docLens
     K, topicMean, sigT, vocab, vocabPrior, A, dtype = modelState.K, modelState.topicMean, modelState.sigT, modelState.vocab, modelState.vocabPrior, modelState.A, modelState.dtype
     
-    debugFn = _debug_with_bound if debug else _debug_with_nothing
     W = data.words
     D = W.shape[0]
     
     # Necessary temp variables (notably the count of topic to word assignments
     # per topic per doc)
-    isigT = la.inv(sigT)
+    sigTCho, isigT_mu, isigT_diag = _factorisePrior(sigT, topicMean, dtype)
     
     # Update the Variances
-    varcs = 1./((n * (K-1.)/K)[:,np.newaxis] + isigT.flat[::K+1])
-    debugFn (0, varcs, "varcs", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, A, n)
+    varcs = 1./((n * (K-1.)/K)[:,np.newaxis] + isigT_diag[np.newaxis,:])
+    if debug: _debug_with_bound (0, varcs, "varcs", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, A, n)
     
     lastPerp = 1E+300 if dtype is np.float64 else 1E+30
-    R = W.copy()
+    R = ssp.csr_matrix((np.empty_like(W.data), W.indices, W.indptr), shape=W.shape, copy=False)
+    V    = np.empty_like(expMeans)
+    work = np.empty_like(expMeans)
+    vocabF = np.asfortranarray(vocab)
     for itr in range(iterations):
-        expMeans = np.exp(means - means.max(axis=1)[:,np.newaxis], out=expMeans)
-        R = sparseScalarQuotientOfDot(W, expMeans, vocab, out=R)
-        V = expMeans * R.dot(vocab.T)
+        debugItr = debug and (logFrequency <= 0 or itr % logFrequency == 0)
+        expMeans = _shiftedExp(means, out=expMeans)
+        R = sparseScalarQuotientOfDotWithProducts(W, expMeans, vocabF, out=R, scaledB=V) # V = expMeans * R.dot(vocab.T)
         
         # Update the Means
-        rhs = V.copy()
-        rhs += n[:,np.newaxis] * means.dot(A) + isigT.dot(topicMean)
-        rhs -= n[:,np.newaxis] * rowwise_softmax(means, out=means)
+        # V is recalculated at the start of every iteration, so it's safe to
+        # overwrite. As means is unchanged since expMeans was derived from it,
+        # we can reuse expMeans to get softmax(means)
+        rhs = _addMeansRhsTerms(V, means, expMeans, n, A, isigT_mu, work)
         if diagonalPriorCov:
-            means = varcs * rhs
+            np.multiply(varcs, rhs, out=means)
         else:
-            for d in range(D):
-                means[d,:] = la.inv(isigT + n[d] * A).dot(rhs[d,:])
+            means[:,:] = _solveForMeans(sigTCho, A, n, rhs, work=work)
         
-        debugFn (itr, means, "means", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, A, n)
+        if debugItr: _debug_with_bound (itr, means, "means", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, A, n)
         
         like = log_likelihood(data, modelState, QueryState(means, expMeans, varcs, n))
         perp = perplexity_from_like(like, data.word_count)
@@ -371,14 +566,17 @@ def log_likelihood (data, modelState, queryState):
     Return the log-likelihood of the given data W according to the model
     and the parameters inferred for the entries in W stored in the 
     queryState object.
+    
+    The expMeans matrix in the query state is used as a work buffer.
     '''
-    return np.sum( \
-        sparseScalarProductOfSafeLnDot(\
-            data.words, \
-            rowwise_softmax(queryState.means), \
-            modelState.vocab \
-        ).data \
-    )
+    docLens  = queryState.docLens
+    
+    # log(softmax(means).dot(vocab)) == log(expMeans.dot(vocab)) - log(sum(expMeans)),
+    # so we can avoid normalising expMeans
+    expMeans = _shiftedExp(queryState.means, out=queryState.expMeans)
+    lnDotSum = np.sum(sparseScalarProductOfSafeLnDot(data.words, expMeans, modelState.vocab).data)
+    
+    return lnDotSum - np.dot(docLens, np.log(expMeans.sum(axis=1)))
     
 def var_bound(data, modelState, queryState):
     '''
@@ -391,10 +589,12 @@ def var_bound(data, modelState, queryState):
     W   = data.words
     D,_ = W.shape
     means, expMeans, varcs, docLens = queryState.means, queryState.expMeans, queryState.varcs, queryState.docLens
-    K, topicMean, sigT, vocab, vocabPrior, A = modelState.K, modelState.topicMean, modelState.sigT, modelState.vocab, modelState.vocabPrior, modelState.A
+    K, topicMean, sigT, vocab, vocabPrior = modelState.K, modelState.topicMean, modelState.sigT, modelState.vocab, modelState.vocabPrior
     
     # Calculate some implicit  variables
-    isigT = la.inv(sigT)
+    sigTCho    = la.cho_factor(sigT, lower=True, check_finite=False)
+    isigT_diag = la.cho_solve(sigTCho, np.eye(K, dtype=sigT.dtype), check_finite=False).diagonal()
+    logDetSigT = 2 * np.sum(np.log(sigTCho[0].diagonal()))
     
     bound = 0
     
@@ -406,26 +606,26 @@ def var_bound(data, modelState, queryState):
         bound -= 0.5 * K * pseudoObsVar * log(NIW_PSI)
         bound -= 0.5 * K * pseudoObsVar * log(2)
         bound -= fns.multigammaln(pseudoObsVar / 2., K)
-        bound -= 0.5 * (pseudoObsVar + K - 1) * safe_log_det(sigT)
-        bound += 0.5 * NIW_PSI * np.trace(isigT)
+        bound -= 0.5 * (pseudoObsVar + K - 1) * logDetSigT
+        bound += 0.5 * NIW_PSI * np.sum(isigT_diag)
 
         # and its entropy
         # is a constant which we skip
         
         # distribution over means
-        bound -= 0.5 * K * log(1./pseudoObsMeans) * safe_log_det(sigT)
-        bound -= 0.5 / pseudoObsMeans * (topicMean).T.dot(isigT).dot(topicMean)
+        bound -= 0.5 * K * log(1./pseudoObsMeans) * logDetSigT
+        bound -= 0.5 / pseudoObsMeans * topicMean.dot(la.cho_solve(sigTCho, topicMean, check_finite=False))
         
         # and its entropy
-        bound += 0.5 * safe_log_det(sigT) # +  a constant
+        bound += 0.5 * logDetSigT # +  a constant
         
     
     # Distribution over document topics
     bound -= (D*K)/2. * LN_OF_2_PI
-    bound -= D/2. * la.det(sigT)
+    bound -= D/2. * logDetSigT
     diff   = means - topicMean[np.newaxis,:]
-    bound -= 0.5 * np.sum (diff.dot(isigT) * diff)
-    bound -= 0.5 * np.sum(varcs * np.diag(isigT)[np.newaxis,:]) # = -0.5 * sum_d tr(V_d \Sigma^{-1}) when V_d is diagonal only.
+    bound -= 0.5 * np.vdot(diff.T, la.cho_solve(sigTCho, diff.T, check_finite=False))
+    bound -= 0.5 * np.sum(varcs * isigT_diag[np.newaxis,:]) # = -0.5 * sum_d tr(V_d \Sigma^{-1}) when V_d is diagonal only.
        
     # And its entropy
 #     bound += 0.5 * D * K * LN_OF_2_PI_E + 0.5 * np.sum(np.log(varcs)) 
@@ -433,20 +633,20 @@ def var_bound(data, modelState, queryState):
     # Distribution over word-topic assignments and words and the formers
     # entropy. This is somewhat jumbled to avoid repeatedly taking the
     # exp and log of the means
-    expMeans = np.exp(means - means.max(axis=1)[:,np.newaxis], out=expMeans)
-    R = sparseScalarQuotientOfDot(W, expMeans, vocab)  # D x V   [W / TB] is the quotient of the original over the reconstructed doc-term matrix
-    V = expMeans * (R.dot(vocab.T)) # D x K
+    expMeans = _shiftedExp(means, out=expMeans)
+    V = np.empty_like(expMeans) # D x K
+    lnDotSum = np.zeros((1,), dtype=np.float64)
+    R = sparseScalarQuotientOfDotWithProducts(W, expMeans, np.asfortranarray(vocab), scaledB=V, lnDotSum=lnDotSum)  # D x V   [W / TB] is the quotient of the original over the reconstructed doc-term matrix
     
     bound += np.sum(docLens * np.log(np.sum(expMeans, axis=1)))
-    bound += np.sum(sparseScalarProductOfSafeLnDot(W, expMeans, vocab).data)
+    bound += lnDotSum[0] # i.e. np.sum(sparseScalarProductOfSafeLnDot(W, expMeans, vocab).data)
     
-    bound += np.sum(means * V)
-    bound += np.sum(2 * ssp.diags(docLens,0) * means.dot(A) * means)
+    # As A = 0.5 * (I - 1/(K+1)), means.dot(A) = 0.5 * (means - rowSums/(K+1))
+    # and every element of diag(A) is 0.5 * K/(K+1), so A itself isn't needed
+    rowSums = means.sum(axis=1)
+    bound += np.dot(docLens, np.einsum('dk,dk->d', means, means) - rowSums * rowSums / (K+1))
     bound -= 2. * scaledSelfSoftDot(means, docLens)
-    bound -= 0.5 * np.sum(docLens[:,np.newaxis] * V * (np.diag(A))[np.newaxis,:])
-    
-    bound -= np.sum(means * V) 
-    
+    bound -= 0.25 * K / (K+1) * np.dot(docLens, V.sum(axis=1))
     
     return bound
         
@@ -455,6 +655,95 @@ def var_bound(data, modelState, queryState):
 # PUBLIC HELPERS
 # ==============================================================
 
+def _shiftedExp (means, out=None):
+    '''
+    Returns exp(means - max(means)), where the max is taken over each row,
+    i.e. the row-wise softmax of the means, without the normalisation.
+    
+    If out is given, the result is written into it.
+    '''
+    out = np.subtract(means, means.max(axis=1)[:,np.newaxis], out=out)
+    return np.exp(out, out=out)
+
+def _selfInnerProduct(X, alpha=1.):
+    '''
+    Returns alpha * X.T.dot(X) as a double-precision matrix. This uses the
+    BLAS symmetric rank-k update, which does half the work of a general
+    matrix product, and reads a row-major double-precision X without
+    copying it. Any other X is converted to double first.
+    '''
+    result = blas.dsyrk(alpha, X.T, trans=0, lower=1) # only the lower triangle is set
+    result += np.tril(result, -1).T
+    return result
+
+def _factorisePrior(sigT, topicMean, dtype):
+    '''
+    Returns the lower Cholesky factorisation of the prior covariance sigT,
+    as returned by la.cho_factor(), the product of the prior precision and
+    the prior mean, and the diagonal of the prior precision.
+    
+    The factorisation is done in double-precision, where the conditioning
+    of sigT matters, but the two vectors are returned in the given dtype, so
+    they don't promote the DxK matrices they're added to.
+    '''
+    K = sigT.shape[0]
+    
+    sigTCho    = la.cho_factor(sigT.astype(np.float64, copy=False), lower=True, check_finite=False)
+    isigT_mu   = la.cho_solve(sigTCho, topicMean, check_finite=False)
+    isigT_diag = la.cho_solve(sigTCho, np.eye(K), check_finite=False).diagonal()
+    
+    return sigTCho, isigT_mu.astype(dtype), isigT_diag.astype(dtype)
+
+def _addMeansRhsTerms(rhs, means, expMeans, docLens, A, isigT_mu, work):
+    '''
+    Adds to rhs, in place, the terms of the right-hand side of the means
+    update that don't depend on the vocabulary, i.e.
+    
+    docLens * means.dot(A) + isigT_mu - docLens * softmax(means)
+    
+    where the softmax is derived from expMeans = exp(means - max(means)).
+    work is a C-contiguous DxK matrix in the dtype of the means, which is
+    used as scratch space. Returns rhs.
+    '''
+    np.dot(means, A, out=work)
+    work *= docLens[:,np.newaxis]
+    work += isigT_mu
+    rhs  += work
+    
+    np.multiply(expMeans, (docLens / expMeans.sum(axis=1))[:,np.newaxis], out=work)
+    rhs  -= work
+    return rhs
+
+def _solveForMeans(sigTCho, A, docLens, rhs, work=None):
+    '''
+    Solves (isigT + docLens[d] * A) means[d,:] = rhs[d,:] for every
+    document d, returning the DxK matrix of means. isigT is the inverse
+    of sigT, which is given by its lower Cholesky factorisation sigTCho,
+    as returned by la.cho_factor()
+    
+    Rather than factorising D different KxK matrices, this does a single
+    eigendecomposition. With L the Cholesky factor of sigT, we have
+    isigT + n A = inv(L.T) (I + n L.T A L) inv(L). So if
+    L.T A L = Q diag(lambda) Q.T and V = L Q then the inverse of every
+    isigT + n A is V diag(1 / (1 + n lambda)) V.T, and the D solves become
+    two matrix products and an elementwise division.
+    
+    The eigendecomposition is done in the precision of sigTCho, and the
+    products in the precision of rhs.
+    
+    If work, a C-contiguous matrix with the same shape and dtype as rhs, is
+    given then it's used as scratch space, and the result is written into
+    rhs, which must also be C-contiguous, to avoid any DxK allocations.
+    '''
+    L = np.tril(sigTCho[0])
+    lmda, Q = la.eigh(L.T.dot(A).dot(L))
+    V = L.dot(Q).astype(rhs.dtype, copy=False)
+    lmda = lmda.astype(rhs.dtype, copy=False)
+    
+    result  = np.dot(rhs, V, out=work)
+    result /= 1. + docLens[:,np.newaxis] * lmda[np.newaxis,:]
+    return np.dot(result, V.T, out=None if work is None else rhs)
+
 
 @static_var("old_bound", 0)
 def _debug_with_bound (itr, var_value, var_name, W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, A, n):
@@ -462,7 +751,7 @@ def _debug_with_bound (itr, var_value, var_name, W, K, topicMean, sigT, vocab, v
         printStderr ("WARNING: " + var_name + " contains NaNs")
     if np.isinf(var_value).any():
         printStderr ("WARNING: " + var_name + " contains INFs")
-    if var_value.dtype != dtype:
+    if var_value.dtype != dtype and var_name != "sigT":
         printStderr ("WARNING: dtype(" + var_name + ") = " + str(var_value.dtype))
     
     old_bound = _debug_with_bound.old_bound
@@ -484,6 +773,4 @@ def _debug_with_bound (itr, var_value, var_name, W, K, topicMean, sigT, vocab, v
     else:
         print ("Iter %3d Update %-15s Bound %22f (%15s)     %s" % (itr, var_name, bound, diff, addendum)) 
 
-def _debug_with_nothing (itr, var_value, var_name, W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, A, n):
-    pass
 
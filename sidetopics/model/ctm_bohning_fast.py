@@ -27,9 +27,9 @@ from sidetopics.util.sigmoid_utils import rowwise_softmax, scaledSelfSoftDot
 from sidetopics.util.sparse_elementwise import sparseScalarQuotientOfDot, \
     sparseScalarProductOfSafeLnDot
 from sidetopics.util.misc import printStderr, static_var
-from sidetopics.util.overflow_safe import safe_log_det
 from sidetopics.model.evals import perplexity_from_like
 from sidetopics.model.common import DataSet
+import sidetopics.model.ctm_fast as compiled
 
 from math import isnan
 
@@ -200,11 +200,10 @@ def train (data, modelState, queryState, trainPlan):
     # Book-keeping for logs
     boundIters, boundValues, likelyValues = [], [], []
     
-    debugFn = _debug_with_bound if debug else _debug_with_nothing
     
-    # Initialize some working variables
-    isigT = la.inv(sigT)
-    R = W.copy()
+    # Initialize some working variables. R has the same non-zero pattern
+    # as W, and only its values are ever overwritten, so it shares W's indices
+    R = ssp.csr_matrix((np.empty_like(W.data), W.indices, W.indptr), shape=W.shape, copy=False)
     
     pseudoObsMeans = K + NIW_PSEUDO_OBS_MEAN
     pseudoObsVar   = K + NIW_PSEUDO_OBS_VAR
@@ -215,6 +214,9 @@ def train (data, modelState, queryState, trainPlan):
 
     # Iterate over parameters
     for itr in range(iterations):
+        # In debug mode the bound is checked after every update, but only on
+        # the iterations where it would be logged in any case
+        debugItr = debug and (logFrequency <= 0 or itr % logFrequency == 0)
         
         # We start with the M-Step, so the parameters are consistent with our
         # initialisation of the RVs when we do the E-Step
@@ -223,7 +225,7 @@ def train (data, modelState, queryState, trainPlan):
         topicMean = means.sum(axis = 0) / (D + pseudoObsMeans) \
                   if USE_NIW_PRIOR \
                   else means.mean(axis=0)
-        debugFn (itr, topicMean, "topicMean", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, H, docLens)
+        if debugItr: _debug_with_bound (itr, topicMean, "topicMean", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, H, docLens)
         
         if USE_NIW_PRIOR:
             diff = means - topicMean[np.newaxis,:]
@@ -236,17 +238,18 @@ def train (data, modelState, queryState, trainPlan):
             sigT += np.diag(varcs.mean(axis=0))
            
         if diagonalPriorCov:
-            diag = np.diag(sigT)
-            sigT = np.diag(diag)
-            isigT = np.diag(1./ diag)
-        else:
-            isigT = la.inv(sigT)
+            sigT = np.diag(np.diag(sigT))
 
         # FIXME Undo debug
         sigT  = np.eye(K)
-        isigT = la.inv(sigT)
         
-        debugFn (itr, sigT, "sigT", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, H, docLens)
+        # Factorise rather than invert the prior covariance. The explicit
+        # precision is still needed for the batched solve of the means.
+        sigTCho  = la.cho_factor(sigT, lower=True, check_finite=False)
+        isigT    = la.cho_solve(sigTCho, np.eye(K, dtype=sigT.dtype), check_finite=False)
+        isigT_mu = la.cho_solve(sigTCho, topicMean, check_finite=False)
+        
+        if debugItr: _debug_with_bound (itr, sigT, "sigT", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, H, docLens)
 #        print("                sigT.det = " + str(la.det(sigT)))
         
         
@@ -263,34 +266,29 @@ def train (data, modelState, queryState, trainPlan):
         R = sparseScalarQuotientOfDot(W, expMeans, vocab, out=R)
         V = expMeans * R.dot(vocab.T)
 
-        debugFn (itr, vocab, "vocab", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, H, docLens)
+        if debugItr: _debug_with_bound (itr, vocab, "vocab", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, H, docLens)
         
         # And now this is the E-Step, though itr's followed by updates for the
         # parameters also that handle the log-sum-exp approximation.
         
         # Update the Variances: var_d = (2 N_d * A + isigT)^{-1}
         varcs = np.reciprocal(docLens[:,np.newaxis] * (K-1.)/K + np.diagonal(sigT))
-        debugFn (itr, varcs, "varcs", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, H, docLens)
+        if debugItr: _debug_with_bound (itr, varcs, "varcs", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, H, docLens)
         
         # Update the Means
         rhs[:,:] = V.copy()
-        rhs += docLens[:,np.newaxis] * means.dot(H) + isigT.dot(topicMean)
+        rhs += docLens[:,np.newaxis] * means.dot(H) + isigT_mu
         rhs -= docLens[:,np.newaxis] * rowwise_softmax(means, out=means)
 
 
         if diagonalPriorCov:
             means = varcs * rhs
         else:
-            means = isigT.dot(rhs)
-            rhsSum = rhs.sum(axis=1)
-
-
-            for d in range(D):
-                means[d, :] = la.inv(isigT + docLens[d] * H).dot(rhs[d, :])
+            means[:,:] = _solveForMeans(isigT, H, docLens, rhs)
         
 #         means -= (means[:,0])[:,np.newaxis]
         
-        debugFn (itr, means, "means", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, H, docLens)
+        if debugItr: _debug_with_bound (itr, means, "means", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, H, docLens)
         
         if logFrequency > 0 and itr % logFrequency == 0:
             modelState = ModelState(K, topicMean, sigT, vocab, vocabPrior, H, dtype, MODEL_NAME)
@@ -334,36 +332,37 @@ def query(data, modelState, queryState, queryPlan):
     means, expMeans, varcs, n = queryState.means, queryState.expMeans, queryState.varcs, queryState.docLens
     K, topicMean, sigT, vocab, vocabPrior, A, dtype = modelState.K, modelState.topicMean, modelState.sigT, modelState.vocab, modelState.vocabPrior, modelState.A, modelState.dtype
     
-    debugFn = _debug_with_bound if debug else _debug_with_nothing
     W = data.words
     D = W.shape[0]
     
     # Necessary temp variables (notably the count of topic to word assignments
     # per topic per doc)
-    isigT = la.inv(sigT)
+    sigTCho  = la.cho_factor(sigT, lower=True, check_finite=False)
+    isigT    = la.cho_solve(sigTCho, np.eye(K, dtype=sigT.dtype), check_finite=False)
+    isigT_mu = la.cho_solve(sigTCho, topicMean, check_finite=False)
     
     # Update the Variances
     varcs = 1./((n * (K-1.)/K)[:,np.newaxis] + isigT.flat[::K+1])
-    debugFn (0, varcs, "varcs", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, A, n)
+    if debug: _debug_with_bound (0, varcs, "varcs", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, A, n)
     
     lastPerp = 1E+300 if dtype is np.float64 else 1E+30
-    R = W.copy()
+    R = ssp.csr_matrix((np.empty_like(W.data), W.indices, W.indptr), shape=W.shape, copy=False)
     for itr in range(iterations):
+        debugItr = debug and (logFrequency <= 0 or itr % logFrequency == 0)
         expMeans = np.exp(means - means.max(axis=1)[:,np.newaxis], out=expMeans)
         R = sparseScalarQuotientOfDot(W, expMeans, vocab, out=R)
         V = expMeans * R.dot(vocab.T)
         
         # Update the Means
         rhs = V.copy()
-        rhs += n[:,np.newaxis] * means.dot(A) + isigT.dot(topicMean)
+        rhs += n[:,np.newaxis] * means.dot(A) + isigT_mu
         rhs -= n[:,np.newaxis] * rowwise_softmax(means, out=means)
         if diagonalPriorCov:
             means = varcs * rhs
         else:
-            for d in range(D):
-                means[d,:] = la.inv(isigT + n[d] * A).dot(rhs[d,:])
+            means[:,:] = _solveForMeans(isigT, A, n, rhs)
         
-        debugFn (itr, means, "means", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, A, n)
+        if debugItr: _debug_with_bound (itr, means, "means", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, A, n)
         
         like = log_likelihood(data, modelState, QueryState(means, expMeans, varcs, n))
         perp = perplexity_from_like(like, data.word_count)
@@ -399,10 +398,12 @@ def var_bound(data, modelState, queryState):
     W   = data.words
     D,_ = W.shape
     means, expMeans, varcs, docLens = queryState.means, queryState.expMeans, queryState.varcs, queryState.docLens
-    K, topicMean, sigT, vocab, vocabPrior, A = modelState.K, modelState.topicMean, modelState.sigT, modelState.vocab, modelState.vocabPrior, modelState.A
+    K, topicMean, sigT, vocab, vocabPrior = modelState.K, modelState.topicMean, modelState.sigT, modelState.vocab, modelState.vocabPrior
     
     # Calculate some implicit  variables
-    isigT = la.inv(sigT)
+    sigTCho    = la.cho_factor(sigT, lower=True, check_finite=False)
+    isigT_diag = la.cho_solve(sigTCho, np.eye(K, dtype=sigT.dtype), check_finite=False).diagonal()
+    logDetSigT = 2 * np.sum(np.log(sigTCho[0].diagonal()))
     
     bound = 0
     
@@ -414,26 +415,26 @@ def var_bound(data, modelState, queryState):
         bound -= 0.5 * K * pseudoObsVar * log(NIW_PSI)
         bound -= 0.5 * K * pseudoObsVar * log(2)
         bound -= fns.multigammaln(pseudoObsVar / 2., K)
-        bound -= 0.5 * (pseudoObsVar + K - 1) * safe_log_det(sigT)
-        bound += 0.5 * NIW_PSI * np.trace(isigT)
+        bound -= 0.5 * (pseudoObsVar + K - 1) * logDetSigT
+        bound += 0.5 * NIW_PSI * np.sum(isigT_diag)
 
         # and its entropy
         # is a constant which we skip
         
         # distribution over means
-        bound -= 0.5 * K * log(1./pseudoObsMeans) * safe_log_det(sigT)
-        bound -= 0.5 / pseudoObsMeans * (topicMean).T.dot(isigT).dot(topicMean)
+        bound -= 0.5 * K * log(1./pseudoObsMeans) * logDetSigT
+        bound -= 0.5 / pseudoObsMeans * topicMean.dot(la.cho_solve(sigTCho, topicMean, check_finite=False))
         
         # and its entropy
-        bound += 0.5 * safe_log_det(sigT) # +  a constant
+        bound += 0.5 * logDetSigT # +  a constant
         
     
     # Distribution over document topics
     bound -= (D*K)/2. * LN_OF_2_PI
-    bound -= D/2. * la.det(sigT)
+    bound -= D/2. * logDetSigT
     diff   = means - topicMean[np.newaxis,:]
-    bound -= 0.5 * np.sum (diff.dot(isigT) * diff)
-    bound -= 0.5 * np.sum(varcs * np.diag(isigT)[np.newaxis,:]) # = -0.5 * sum_d tr(V_d \Sigma^{-1}) when V_d is diagonal only.
+    bound -= 0.5 * np.vdot(diff.T, la.cho_solve(sigTCho, diff.T, check_finite=False))
+    bound -= 0.5 * np.sum(varcs * isigT_diag[np.newaxis,:]) # = -0.5 * sum_d tr(V_d \Sigma^{-1}) when V_d is diagonal only.
        
     # And its entropy
 #     bound += 0.5 * D * K * LN_OF_2_PI_E + 0.5 * np.sum(np.log(varcs)) 
@@ -449,9 +450,12 @@ def var_bound(data, modelState, queryState):
     bound += np.sum(sparseScalarProductOfSafeLnDot(W, expMeans, vocab).data)
     
     bound += np.sum(means * V)
-    bound += np.sum(2 * ssp.diags(docLens,0) * means.dot(A) * means)
+    # As A = 0.5 * (I - 1/(K+1)), means.dot(A) = 0.5 * (means - rowSums/(K+1))
+    # and every element of diag(A) is 0.5 * K/(K+1), so A itself isn't needed
+    rowSums = means.sum(axis=1)
+    bound += np.dot(docLens, np.einsum('dk,dk->d', means, means) - rowSums * rowSums / (K+1))
     bound -= 2. * scaledSelfSoftDot(means, docLens)
-    bound -= 0.5 * np.sum(docLens[:,np.newaxis] * V * (np.diag(A))[np.newaxis,:])
+    bound -= 0.25 * K / (K+1) * np.dot(docLens, V.sum(axis=1))
     
     bound -= np.sum(means * V) 
     
@@ -463,6 +467,21 @@ def var_bound(data, modelState, queryState):
 # PUBLIC HELPERS
 # ==============================================================
 
+def _solveForMeans(isigT, A, docLens, rhs):
+    '''
+    Solves (isigT + docLens[d] * A) means[d,:] = rhs[d,:] for every
+    document d, returning the DxK matrix of means.
+    
+    The systems are built and solved by a compiled kernel, in parallel
+    over documents, in the precision of rhs.
+    '''
+    dtype = np.float64 if rhs.dtype == np.float64 else np.float32
+    solve = compiled.solveForMeans_f8 if dtype == np.float64 else compiled.solveForMeans_f4
+    
+    means = np.empty(rhs.shape, dtype=dtype)
+    solve(docLens.astype(dtype, copy=False), isigT.astype(dtype, copy=False), \
+          A.astype(dtype, copy=False), rhs.astype(dtype, copy=False), means)
+    return means
 
 @static_var("old_bound", 0)
 def _debug_with_bound (itr, var_value, var_name, W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, A, n):
@@ -492,6 +511,3 @@ def _debug_with_bound (itr, var_value, var_name, W, K, topicMean, sigT, vocab, v
     else:
         print ("Iter %3d Update %-15s Bound %22f (%15s)     %s" % (itr, var_name, bound, diff, addendum)) 
 
-def _debug_with_nothing (itr, var_value, var_name, W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, A, n):
-    pass
-
@@ -0,0 +1,419 @@
+'''
+Contains a number of functions required to implement the CTM (with the
+Bouchard bound) in a fast manner. See the ctm module for more information
+on the algorithm.
+
+As is typically the case, there are multiple implementations for multiple
+different datatypes.
+
+Compilation Notes
+=================
+This code expects a compiler with OpenMP support, and will multi-thread
+certain operations where it offers benefit. On GCC this means you must
+link to the "gomp" library.
+'''
+
+cimport cython
+import numpy as np
+cimport numpy as np
+
+from cython.parallel cimport prange, parallel
+from libc.stdlib cimport malloc, free
+from libc.math cimport sqrt, tanh, sqrtf, tanhf
+from scipy.linalg.cython_lapack cimport dposv, sposv
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def updateMeansAndVarcs_f8(double[:] docLens, double[:,:] lxi, double[:] s, double[:,:] S, \
+                           double[:] isigT_diag, double[:] isigT_mu, \
+                           double[:,:] means, double[:,:] varcs):
+    '''
+    The E-Step update of the posterior variances and means of the
+    per-document topic distributions, for a diagonal prior covariance.
+    For every document d this sets
+
+    varcs[d,:] = 1 / (docLens[d] * lxi[d,:] + isigT_diag)
+    means[d,:] = varcs[d,:] * ((s[d] * lxi[d,:] - 0.5) * docLens[d] + S[d,:] + isigT_mu)
+
+    less the value of means[d,0], so that the first topic's mean is always
+    zero. This is all done in a single pass over the data. Documents are
+    processed in parallel.
+
+    Params
+    docLens    - the D-dim vector of document lengths
+    lxi        - the DxK matrix of (twice the negated) Jaakkola terms
+    s          - the D-dim vector of Bouchard offsets
+    S          - the DxK matrix of expected topic-word counts
+    isigT_diag - the diagonal of the prior precision matrix
+    isigT_mu   - the product of the prior precision and the prior mean
+    means      - the DxK matrix of means, overwritten with the result
+    varcs      - the DxK matrix of variances, overwritten with the result
+    '''
+    cdef:
+        int D = means.shape[0]
+        int K = means.shape[1]
+        int d, k
+        double firstMean
+
+    with nogil:
+        for d in prange(D):
+            # The first topic's mean is computed up front so that every other
+            # mean can be stored relative to it as it is calculated.
+            varcs[d,0] = 1. / (docLens[d] * lxi[d,0] + isigT_diag[0])
+            firstMean  = varcs[d,0] * ((s[d] * lxi[d,0] - 0.5) * docLens[d] + S[d,0] + isigT_mu[0])
+            means[d,0] = 0
+
+            for k in range(1, K):
+                varcs[d,k] = 1. / (docLens[d] * lxi[d,k] + isigT_diag[k])
+                means[d,k] = varcs[d,k] * ((s[d] * lxi[d,k] - 0.5) * docLens[d] + S[d,k] + isigT_mu[k]) - firstMean
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def updateMeansAndVarcs_f4(float[:] docLens, float[:,:] lxi, float[:] s, float[:,:] S, \
+                           float[:] isigT_diag, float[:] isigT_mu, \
+                           float[:,:] means, float[:,:] varcs):
+    '''
+    The E-Step update of the posterior variances and means of the
+    per-document topic distributions, for a diagonal prior covariance.
+    For every document d this sets
+
+    varcs[d,:] = 1 / (docLens[d] * lxi[d,:] + isigT_diag)
+    means[d,:] = varcs[d,:] * ((s[d] * lxi[d,:] - 0.5) * docLens[d] + S[d,:] + isigT_mu)
+
+    less the value of means[d,0], so that the first topic's mean is always
+    zero. This is all done in a single pass over the data. Documents are
+    processed in parallel.
+
+    Params
+    docLens    - the D-dim vector of document lengths
+    lxi        - the DxK matrix of (twice the negated) Jaakkola terms
+    s          - the D-dim vector of Bouchard offsets
+    S          - the DxK matrix of expected topic-word counts
+    isigT_diag - the diagonal of the prior precision matrix
+    isigT_mu   - the product of the prior precision and the prior mean
+    means      - the DxK matrix of means, overwritten with the result
+    varcs      - the DxK matrix of variances, overwritten with the result
+    '''
+    cdef:
+        int D = means.shape[0]
+        int K = means.shape[1]
+        int d, k
+        float firstMean
+
+    with nogil:
+        for d in prange(D):
+            # The first topic's mean is computed up front so that every other
+            # mean can be stored relative to it as it is calculated.
+            varcs[d,0] = 1. / (docLens[d] * lxi[d,0] + isigT_diag[0])
+            firstMean  = varcs[d,0] * ((s[d] * lxi[d,0] - 0.5) * docLens[d] + S[d,0] + isigT_mu[0])
+            means[d,0] = 0
+
+            for k in range(1, K):
+                varcs[d,k] = 1. / (docLens[d] * lxi[d,k] + isigT_diag[k])
+                means[d,k] = varcs[d,k] * ((s[d] * lxi[d,k] - 0.5) * docLens[d] + S[d,k] + isigT_mu[k]) - firstMean
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def solveForMeans_f8(double[:] docLens, double[:,:] isigT, double[:,:] A, \
+                     double[:,:] rhs, double[:,:] means):
+    '''
+    Solves (isigT + docLens[d] * A) means[d,:] = rhs[d,:] for every
+    document d, for a full (symmetric, positive-definite) prior precision
+    and Bohning matrix.
+
+    Each thread builds every one of its documents' KxK systems in its own
+    scratch buffer and solves it in place with LAPACK's Cholesky-based
+    dposv. Documents are processed in parallel. If any document's system
+    is not positive-definite a LinAlgError is raised once all are done.
+
+    Params
+    docLens - the D-dim vector of document lengths
+    isigT   - the KxK prior precision matrix
+    A       - the KxK Bohning matrix
+    rhs     - the DxK matrix of right-hand sides
+    means   - the DxK matrix of means, overwritten with the result
+    '''
+    cdef:
+        int D = rhs.shape[0]
+        int K = rhs.shape[1]
+        int nrhs = 1
+        int d, i, j, info
+        int noMemory = 0, failed = 0
+        char uplo = b'L'
+        double *prec
+        double *x
+
+    with nogil, parallel():
+        prec = <double *> malloc(K * K * sizeof(double))
+        x    = <double *> malloc(K * sizeof(double))
+        try:
+            for d in prange(D):
+                if prec == NULL or x == NULL:
+                    noMemory += 1
+                    continue
+
+                for i in range(K):
+                    x[i] = rhs[d,i]
+                    for j in range(K):
+                        prec[i * K + j] = isigT[i,j] + docLens[d] * A[i,j]
+
+                # Assigning info here makes it private to each thread
+                info = 0
+                dposv(&uplo, &K, &nrhs, prec, &K, x, &K, &info)
+                if info != 0:
+                    failed += 1
+                    continue
+
+                for i in range(K):
+                    means[d,i] = x[i]
+        finally:
+            free(prec)
+            free(x)
+
+    if noMemory > 0:
+        raise MemoryError("Could not allocate the per-thread buffers to solve for the means")
+    if failed > 0:
+        raise np.linalg.LinAlgError( \
+            "dposv failed to solve for the means of %d of the %d documents" % (failed, D))
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def solveForMeans_f4(float[:] docLens, float[:,:] isigT, float[:,:] A, \
+                     float[:,:] rhs, float[:,:] means):
+    '''
+    Solves (isigT + docLens[d] * A) means[d,:] = rhs[d,:] for every
+    document d, for a full (symmetric, positive-definite) prior precision
+    and Bohning matrix.
+
+    Each thread builds every one of its documents' KxK systems in its own
+    scratch buffer and solves it in place with LAPACK's Cholesky-based
+    sposv. Documents are processed in parallel. If any document's system
+    is not positive-definite a LinAlgError is raised once all are done.
+
+    Params
+    docLens - the D-dim vector of document lengths
+    isigT   - the KxK prior precision matrix
+    A       - the KxK Bohning matrix
+    rhs     - the DxK matrix of right-hand sides
+    means   - the DxK matrix of means, overwritten with the result
+    '''
+    cdef:
+        int D = rhs.shape[0]
+        int K = rhs.shape[1]
+        int nrhs = 1
+        int d, i, j, info
+        int noMemory = 0, failed = 0
+        char uplo = b'L'
+        float *prec
+        float *x
+
+    with nogil, parallel():
+        prec = <float *> malloc(K * K * sizeof(float))
+        x    = <float *> malloc(K * sizeof(float))
+        try:
+            for d in prange(D):
+                if prec == NULL or x == NULL:
+                    noMemory += 1
+                    continue
+
+                for i in range(K):
+                    x[i] = rhs[d,i]
+                    for j in range(K):
+                        prec[i * K + j] = isigT[i,j] + docLens[d] * A[i,j]
+
+                # Assigning info here makes it private to each thread
+                info = 0
+                sposv(&uplo, &K, &nrhs, prec, &K, x, &K, &info)
+                if info != 0:
+                    failed += 1
+                    continue
+
+                for i in range(K):
+                    means[d,i] = x[i]
+        finally:
+            free(prec)
+            free(x)
+
+    if noMemory > 0:
+        raise MemoryError("Could not allocate the per-thread buffers to solve for the means")
+    if failed > 0:
+        raise np.linalg.LinAlgError( \
+            "sposv failed to solve for the means of %d of the %d documents" % (failed, D))
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def updateApproxParams_f8(double[:,:] means, double[:,:] varcs, double[:] s, \
+                          double[:,:] xi, double[:,:] lxi):
+    '''
+    Updates the parameters of the Bouchard bound given new means and
+    variances, holding the offsets s fixed. For every document d this sets
+
+    xi[d,:]  = sqrt((means[d,:] - s[d])**2 + varcs[d,:]**2)
+    lxi[d,:] = 0.5 / xi[d,:] * tanh(0.5 * xi[d,:])
+
+    i.e. lxi is twice the negated Jaakkola term of xi. This is done in a
+    single pass over the data, with documents processed in parallel.
+
+    Params
+    means - the DxK matrix of means
+    varcs - the DxK matrix of variances
+    s     - the D-dim vector of Bouchard offsets
+    xi    - the DxK matrix of xi values, overwritten with the result
+    lxi   - the DxK matrix of Jaakkola terms, overwritten with the result
+    '''
+    cdef:
+        int D = means.shape[0]
+        int K = means.shape[1]
+        int d, k
+        double diff, x
+
+    with nogil:
+        for d in prange(D):
+            for k in range(K):
+                diff = means[d,k] - s[d]
+                x    = sqrt(diff * diff + varcs[d,k] * varcs[d,k])
+                xi[d,k]  = x
+                lxi[d,k] = 0.5 / x * tanh(0.5 * x)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def updateApproxParams_f4(float[:,:] means, float[:,:] varcs, float[:] s, \
+                          float[:,:] xi, float[:,:] lxi):
+    '''
+    Updates the parameters of the Bouchard bound given new means and
+    variances, holding the offsets s fixed. For every document d this sets
+
+    xi[d,:]  = sqrt((means[d,:] - s[d])**2 + varcs[d,:]**2)
+    lxi[d,:] = 0.5 / xi[d,:] * tanh(0.5 * xi[d,:])
+
+    i.e. lxi is twice the negated Jaakkola term of xi. This is done in a
+    single pass over the data, with documents processed in parallel.
+
+    Params
+    means - the DxK matrix of means
+    varcs - the DxK matrix of variances
+    s     - the D-dim vector of Bouchard offsets
+    xi    - the DxK matrix of xi values, overwritten with the result
+    lxi   - the DxK matrix of Jaakkola terms, overwritten with the result
+    '''
+    cdef:
+        int D = means.shape[0]
+        int K = means.shape[1]
+        int d, k
+        float diff, x
+
+    with nogil:
+        for d in prange(D):
+            for k in range(K):
+                diff = means[d,k] - s[d]
+                x    = sqrtf(diff * diff + varcs[d,k] * varcs[d,k])
+                xi[d,k]  = x
+                lxi[d,k] = 0.5 / x * tanhf(0.5 * x)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def updateVarcsAndApproxParams_f8(double[:] docLens, double[:] isigT_diag, \
+                                  double[:,:] means, double[:,:] varcs, double[:] s, double[:,:] lxi):
+    '''
+    The query-time update of the variances and of all the parameters of
+    the Bouchard bound, for a diagonal prior precision. For every
+    document d this sets, in order,
+
+    varcs[d,:] = 1 / (docLens[d] * lxi[d,:] + isigT_diag)
+    lxi[d,:]   = 0.5 / xi * tanh(0.5 * xi)
+                 where xi = sqrt((means[d,:] - s[d])**2 + varcs[d,:]**2)
+    s[d]       = (sum(lxi[d,:] * means[d,:]) + K/4 - 1/2) / sum(lxi[d,:])
+
+    This is done in a single pass over the data, without any temporary
+    DxK matrices. Documents are processed in parallel.
+
+    Params
+    docLens    - the D-dim vector of document lengths
+    isigT_diag - the diagonal of the prior precision matrix
+    means      - the DxK matrix of means
+    varcs      - the DxK matrix of variances, overwritten with the result
+    s          - the D-dim vector of Bouchard offsets, overwritten with the result
+    lxi        - the DxK matrix of Jaakkola terms, overwritten with the result
+    '''
+    cdef:
+        int D = means.shape[0]
+        int K = means.shape[1]
+        int d, k
+        double diff, x, lxiSum, lxiMeanSum
+
+    with nogil:
+        for d in prange(D):
+            lxiSum     = 0
+            lxiMeanSum = 0
+            for k in range(K):
+                varcs[d,k] = 1. / (docLens[d] * lxi[d,k] + isigT_diag[k])
+
+                diff = means[d,k] - s[d]
+                x    = sqrt(diff * diff + varcs[d,k] * varcs[d,k])
+                lxi[d,k] = 0.5 / x * tanh(0.5 * x)
+
+                lxiSum     = lxiSum + lxi[d,k]
+                lxiMeanSum = lxiMeanSum + lxi[d,k] * means[d,k]
+
+            s[d] = (lxiMeanSum + 0.25 * K - 0.5) / lxiSum
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def updateVarcsAndApproxParams_f4(float[:] docLens, float[:] isigT_diag, \
+                                  float[:,:] means, float[:,:] varcs, float[:] s, float[:,:] lxi):
+    '''
+    The query-time update of the variances and of all the parameters of
+    the Bouchard bound, for a diagonal prior precision. For every
+    document d this sets, in order,
+
+    varcs[d,:] = 1 / (docLens[d] * lxi[d,:] + isigT_diag)
+    lxi[d,:]   = 0.5 / xi * tanh(0.5 * xi)
+                 where xi = sqrt((means[d,:] - s[d])**2 + varcs[d,:]**2)
+    s[d]       = (sum(lxi[d,:] * means[d,:]) + K/4 - 1/2) / sum(lxi[d,:])
+
+    This is done in a single pass over the data, without any temporary
+    DxK matrices. Documents are processed in parallel.
+
+    Params
+    docLens    - the D-dim vector of document lengths
+    isigT_diag - the diagonal of the prior precision matrix
+    means      - the DxK matrix of means
+    varcs      - the DxK matrix of variances, overwritten with the result
+    s          - the D-dim vector of Bouchard offsets, overwritten with the result
+    lxi        - the DxK matrix of Jaakkola terms, overwritten with the result
+    '''
+    cdef:
+        int D = means.shape[0]
+        int K = means.shape[1]
+        int d, k
+        float diff, x, lxiSum, lxiMeanSum
+
+    with nogil:
+        for d in prange(D):
+            lxiSum     = 0
+            lxiMeanSum = 0
+            for k in range(K):
+                varcs[d,k] = 1. / (docLens[d] * lxi[d,k] + isigT_diag[k])
+
+                diff = means[d,k] - s[d]
+                x    = sqrtf(diff * diff + varcs[d,k] * varcs[d,k])
+                lxi[d,k] = 0.5 / x * tanhf(0.5 * x)
+
+                lxiSum     = lxiSum + lxi[d,k]
+                lxiMeanSum = lxiMeanSum + lxi[d,k] * means[d,k]
+
+            s[d] = (lxiMeanSum + 0.25 * K - 0.5) / lxiSum
@@ -200,11 +200,11 @@ def train (data, modelState, queryState, trainPlan):
     # Book-keeping for logs
     boundIters, boundValues, likelyValues = [], [], []
     
-    debugFn = _debug_with_bound if debug else _debug_with_nothing
     
-    # Initialize some working variables
+    # Initialize some working variables. R has the same non-zero pattern
+    # as W, and only its values are ever overwritten, so it shares W's indices
     isigT = la.inv(sigT)
-    R = W.copy()
+    R = ssp.csr_matrix((np.empty_like(W.data), W.indices, W.indptr), shape=W.shape, copy=False)
     
     pseudoObsMeans = K + NIW_PSEUDO_OBS_MEAN
     pseudoObsVar   = K + NIW_PSEUDO_OBS_VAR
@@ -213,6 +213,9 @@ def train (data, modelState, queryState, trainPlan):
     
     # Iterate over parameters
     for itr in range(iterations):
+        # In debug mode the bound is checked after every update, but only on
+        # the iterations where it would be logged in any case
+        debugItr = debug and (logFrequency <= 0 or itr % logFrequency == 0)
         
         # We start with the M-Step, so the parameters are consistent with our
         # initialisation of the RVs when we do the E-Step
@@ -221,7 +224,7 @@ def train (data, modelState, queryState, trainPlan):
         topicMean = means.sum(axis = 0) / (D + pseudoObsMeans) \
                   if USE_NIW_PRIOR \
                   else means.mean(axis=0)
-        debugFn (itr, topicMean, "topicMean", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, A, docLens)
+        if debugItr: _debug_with_bound (itr, topicMean, "topicMean", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, A, docLens)
         
         if USE_NIW_PRIOR:
             diff = means - topicMean[np.newaxis,:]
@@ -244,7 +247,7 @@ def train (data, modelState, queryState, trainPlan):
         sigT  = np.eye(K)
         isigT = la.inv(sigT)
         
-        debugFn (itr, sigT, "sigT", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, A, docLens)
+        if debugItr: _debug_with_bound (itr, sigT, "sigT", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, A, docLens)
 #        print("                sigT.det = " + str(la.det(sigT)))
         
         
@@ -261,14 +264,14 @@ def train (data, modelState, queryState, trainPlan):
         R = sparseScalarQuotientOfDot(W, expMeans, vocab, out=R)
         V = expMeans * R.dot(vocab.T)
 
-        debugFn (itr, vocab, "vocab", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, A, docLens)
+        if debugItr: _debug_with_bound (itr, vocab, "vocab", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, A, docLens)
         
         # And now this is the E-Step, though itr's followed by updates for the
         # parameters also that handle the log-sum-exp approximation.
         
         # Update the Variances: var_d = (2 N_d * A + isigT)^{-1}
         varcs = np.reciprocal(docLens[:,np.newaxis] * (K-1.)/K + np.diagonal(sigT))
-        debugFn (itr, varcs, "varcs", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, A, docLens)
+        if debugItr: _debug_with_bound (itr, varcs, "varcs", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, A, docLens)
         
         # Update the Means
         rhs = V.copy()
@@ -282,7 +285,7 @@ def train (data, modelState, queryState, trainPlan):
         
 #         means -= (means[:,0])[:,np.newaxis]
         
-        debugFn (itr, means, "means", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, A, docLens)
+        if debugItr: _debug_with_bound (itr, means, "means", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, A, docLens)
         
         if logFrequency > 0 and itr % logFrequency == 0:
             modelState = ModelState(K, topicMean, sigT, vocab, vocabPrior, A, dtype, MODEL_NAME)
@@ -326,7 +329,6 @@ def query(data, modelState, queryState, queryPlan):
     means, expMeans, varcs, n = queryState.means, queryState.expMeans, queryState.varcs, queryState.docLens
     K, topicMean, sigT, vocab, vocabPrior, A, dtype = modelState.K, modelState.topicMean, modelState.sigT, modelState.vocab, modelState.vocabPrior, modelState.A, modelState.dtype
     
-    debugFn = _debug_with_bound if debug else _debug_with_nothing
     W = data.words
     D = W.shape[0]
     
@@ -336,11 +338,12 @@ def query(data, modelState, queryState, queryPlan):
     
     # Update the Variances
     varcs = 1./((n * (K-1.)/K)[:,np.newaxis] + isigT.flat[::K+1])
-    debugFn (0, varcs, "varcs", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, A, n)
+    if debug: _debug_with_bound (0, varcs, "varcs", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, A, n)
     
     lastPerp = 1E+300 if dtype is np.float64 else 1E+30
-    R = W.copy()
+    R = ssp.csr_matrix((np.empty_like(W.data), W.indices, W.indptr), shape=W.shape, copy=False)
     for itr in range(iterations):
+        debugItr = debug and (logFrequency <= 0 or itr % logFrequency == 0)
         expMeans = np.exp(means - means.max(axis=1)[:,np.newaxis], out=expMeans)
         R = sparseScalarQuotientOfDot(W, expMeans, vocab, out=R)
         V = expMeans * R.dot(vocab.T)
@@ -355,7 +358,7 @@ def query(data, modelState, queryState, queryPlan):
             for d in range(D):
                 means[d,:] = la.inv(isigT + n[d] * A).dot(rhs[d,:])
         
-        debugFn (itr, means, "means", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, A, n)
+        if debugItr: _debug_with_bound (itr, means, "means", W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, A, n)
         
         like = log_likelihood(data, modelState, QueryState(means, expMeans, varcs, n))
         perp = perplexity_from_like(like, data.word_count)
@@ -391,7 +394,7 @@ def var_bound(data, modelState, queryState):
     W   = data.words
     D,_ = W.shape
     means, expMeans, varcs, docLens = queryState.means, queryState.expMeans, queryState.varcs, queryState.docLens
-    K, topicMean, sigT, vocab, vocabPrior, A = modelState.K, modelState.topicMean, modelState.sigT, modelState.vocab, modelState.vocabPrior, modelState.A
+    K, topicMean, sigT, vocab, vocabPrior = modelState.K, modelState.topicMean, modelState.sigT, modelState.vocab, modelState.vocabPrior
     
     # Calculate some implicit  variables
     isigT = la.inv(sigT)
@@ -441,9 +444,12 @@ def var_bound(data, modelState, queryState):
     bound += np.sum(sparseScalarProductOfSafeLnDot(W, expMeans, vocab).data)
     
     bound += np.sum(means * V)
-    bound += np.sum(2 * ssp.diags(docLens,0) * means.dot(A) * means)
+    # As A = 0.5 * (I - 1/(K+1)), means.dot(A) = 0.5 * (means - rowSums/(K+1))
+    # and every element of diag(A) is 0.5 * K/(K+1), so A itself isn't needed
+    rowSums = means.sum(axis=1)
+    bound += np.dot(docLens, np.einsum('dk,dk->d', means, means) - rowSums * rowSums / (K+1))
     bound -= 2. * scaledSelfSoftDot(means, docLens)
-    bound -= 0.5 * np.sum(docLens[:,np.newaxis] * V * (np.diag(A))[np.newaxis,:])
+    bound -= 0.25 * K / (K+1) * np.dot(docLens, V.sum(axis=1))
     
     bound -= np.sum(means * V) 
     
@@ -484,6 +490,3 @@ def _debug_with_bound (itr, var_value, var_name, W, K, topicMean, sigT, vocab, v
     else:
         print ("Iter %3d Update %-15s Bound %22f (%15s)     %s" % (itr, var_name, bound, diff, addendum)) 
 
-def _debug_with_nothing (itr, var_value, var_name, W, K, topicMean, sigT, vocab, vocabPrior, dtype, means, varcs, A, n):
-    pass
-
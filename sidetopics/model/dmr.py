@@ -379,7 +379,7 @@ def log_likelihood (data, model, query):
     queryState object.
     
     '''
-    W = data.words if data.words.dtype is model.dtype else data.words.astype(model.dtype)
+    W = data.words if data.words.dtype == model.dtype else data.words.astype(model.dtype)
     return sparseScalarProductOfSafeLnDot(W, topicDists(query), wordDists(model)).sum()
 
 
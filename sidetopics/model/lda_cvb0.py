@@ -362,7 +362,7 @@ def log_likelihood_point(data, modelState, queryState):
 
     if type(a) is float or np.isscalar(a):
         a = constantArray((modelState.K,), a, modelState.dtype)
-    W = data.words if data.words.dtype is modelState.dtype \
+    W = data.words if data.words.dtype == modelState.dtype \
         else data.words.astype(modelState.dtype)
 
     n_dk += a[np.newaxis, :]
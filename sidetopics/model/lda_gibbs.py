@@ -283,7 +283,7 @@ def log_likelihood (data, model, query, topicDistOverride=None):
     queryState object.
 
     '''
-    W = data.words if data.words.dtype is model.dtype else data.words.astype(model.dtype)
+    W = data.words if data.words.dtype == model.dtype else data.words.astype(model.dtype)
     tops = topicDistOverride \
         if topicDistOverride is not None \
         else topicDists(query)
@@ -610,13 +610,14 @@ def var_bound(data, model, query, z_dnk = None):
     prob_words, prob_links = 0, 0
     prob_z, ent_z = 0, 0
     prob_y, ent_y   = 0, 0
+    lse_at_d = fns.logsumexp(topics, axis=1)
     for d in range(D):
         # First the word-topic assignments, note this is a KxV matrix
         wordIdx, z = _infer_word_topics_at_d(d, W, topics, diWordDists, diWordDistSums)
 
         # E[ln p(Z|topics) = sum_d sum_n sum_k E[z_dnk] E[ln topicDist_dk]
         prob_z += topics[d, :].dot(z * W[d, :].data[np.newaxis, :]).sum()
-        prob_z -= docLens[d] * lse(topics[d, :])
+        prob_z -= docLens[d] * lse_at_d[d]
 
         # E[ln p(W|Z)] = sum_d sum_n sum_k sum_t E[z_dnk] w_dnt E[ln vocab_kt]
         prob_words += np.sum(W[d, :].data[np.newaxis, :] * z * (diWordDists[:, wordIdx] - diWordDistSums[:, np.newaxis]))
@@ -633,7 +634,7 @@ def var_bound(data, model, query, z_dnk = None):
         # E[ln p(Y|topics) = sum_d sum_m sum_k E[y_dmk] E[ln topicDist_dk]
         y *= L[d, :].data[:, np.newaxis]
         prob_y += y.dot(topics[d, :].T).sum()
-        prob_y -= out_counts[d] * lse(topics[d, :])
+        prob_y -= out_counts[d] * lse_at_d[d]
 
         # E[ln p(L|Y)] = sum_d sum_m sum_k sum_t E[y_dmk] l_dmp E[ln topics_pk]
         prob_links += y.dot(topics[linkIdx, :].T).sum()
@@ -646,14 +647,6 @@ def var_bound(data, model, query, z_dnk = None):
     return bound
 
 
-def lse(x):
-    '''
-    Return the log-sum-exp of the vector x
-    '''
-    sum = np.sum(np.exp(x))
-    return log(sum) if sum > 1E-300 else -1E+300
-
-
 def _dirichletEntropy (P):
     '''
     Entropy of D Dirichlet distributions, with dimension K, whose parameters
@@ -501,7 +501,7 @@ def var_bound(data, modelState, queryState):
     #means = safe_log(expMeansOut, out=means)
     
     bound += np.sum(means * w_top_sums)
-    bound += np.sum(2 * ssp.diags(docLens,0) * means.dot(A) * means)
+    bound += 2 * np.einsum('d,dk,dk->', docLens, means.dot(A), means)
     bound -= 2. * scaledSelfSoftDot(means, docLens)
     bound -= 0.5 * np.sum(docLens[:,np.newaxis] * w_top_sums * (np.diag(A))[np.newaxis,:])
     
@@ -26,7 +26,8 @@ from sidetopics.model.sidetopic_uyv import DTYPE, LOG_2PI, LOG_2PI_E,\
     newVbModelState as newVbModelStateUyv, varBound as varBoundUyv, newInferencePlan
 from numba import autojit
 from sidetopics.util.array_utils import normalizerows_ip
-from sidetopics.util.overflow_safe import safe_log, safe_log_one_plus_exp_of
+from sidetopics.util.overflow_safe import safe_log, safe_log_one_plus_exp_of, safe_log_det
+from sidetopics.util.sparse_elementwise import sparseDenseProduct
 from sidetopics.util.vectrans import vec, vec_transpose, vec_transpose_csr, \
     sp_vec_trans_matrix
 import numpy as np
@@ -35,6 +36,7 @@ import scipy.linalg as la
 import scipy.sparse as ssp
 
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 
 
@@ -87,8 +89,12 @@ def train(modelState, X, W, plan):
     iterations, epsilon, logCount, plot, plotFile, plotIncremental, fastButInaccurate = plan.iterations, plan.epsilon, plan.logFrequency, plan.plot, plan.plotFile, plan.plotIncremental, plan.fastButInaccurate
     queryPlan = newInferencePlan(1, epsilon, logFrequency = 0, plot=False)
     
-    if W.dtype.kind == 'i':      # for the sparseScalorQuotientOfDot() method to work
+    # The sparse kernels require W, expLmda and vocab to share a dtype, and
+    # all the working variables below are allocated with DTYPE, so make
+    # sure the inputs and model parameters match it too.
+    if W.dtype != DTYPE:
         W = W.astype(DTYPE)
+    A, Y, U, vocab, sigT = (M.astype(DTYPE, copy=False) for M in (A, Y, U, vocab, sigT))
     
     # Get ready to plot the evolution of the likelihood, with multiplicative updates (e.g. 1, 2, 4, 8, 16, 32, ...)
     if logCount > 0:
@@ -102,12 +108,23 @@ def train(modelState, X, W, plan):
     lastVarBoundValue = -sys.float_info.max
     verify_and_log = _quickPrintElbo if DEBUG else _doNothing
     
+    # The variational bound is evaluated on a worker thread, overlapping
+    # with the iterations that follow, and collected at the next logging
+    # step. Hence convergence is judged one logging step late.
+    boundJob = None
+    
     # Prior covariances and mean
     overSsq, overAsq, overKsq, overTsq = 1./sigmaSq, 1./alphaSq, 1./kappaSq, 1./tauSq
     
-    # We'll need the total word count per doc, and total count of docs
-    docLen = np.squeeze(np.asarray (W.sum(axis=1))) # Force to a one-dimensional array for np.newaxis trick to work
-    D      = len(docLen)
+    # We'll need the total word count per doc, and total count of docs. The
+    # former is summed directly from W's values. As reduceat() would return
+    # the next row's first value for an empty row, only non-empty rows are
+    # summed in this manner.
+    D        = W.shape[0]
+    docLen   = np.zeros((D,), dtype=DTYPE)
+    nonEmpty = np.diff(W.indptr) > 0
+    if nonEmpty.any():
+        docLen[nonEmpty] = np.add.reduceat(W.data, W.indptr[:-1][nonEmpty])
     print ("Training %d topic model with %d x %d word-matrix W, %d x %d feature matrix X, and latent feature and topics spaces of size %d and %d respectively" % (K, D, T, D, F, P, Q))
     
     # No need to recompute X'X every time
@@ -115,132 +132,172 @@ def train(modelState, X, W, plan):
         X = X.astype (DTYPE)
     XTX = X.T.dot(X)
     
+    # X' is used every iteration, and as X is CSR, X.T is a CSC view. So we
+    # store it explicitly in CSR form, making products with it row-wise
+    XT = X.T.tocsr()
+    
     # Identity matrices that occur
-    I_P  = ssp.eye(P,P, 0, DTYPE)
+    I_P  = np.eye(P, dtype=DTYPE)
     I_F  = ssp.eye(F,F, 0, DTYPE, "csc") # X is CSR, XTX is consequently CSC, sparse inverse requires CSC
     
-    # Assign initial values to the query parameters
-    expLmda = np.exp(rd.random((D, K)).astype(DTYPE))
+    # Assign initial values to the query parameters. lmda and exp(lmda) are
+    # kept in separate buffers, rather than converting one buffer back and
+    # forth between the two
+    lmda    = rd.random((D, K)).astype(DTYPE)
+    expLmda = np.exp(lmda)
     nu   = np.ones((D, K), DTYPE)
     s    = np.zeros((D,), DTYPE)
     lxi  = negJakkola (np.ones((D,K), DTYPE))
     
     # the variance of A is an unchanging function of X, assuming
-    # that alphaSq is also unchanging.
-    print ("Inverting gram matrix")
-    aI_XTX = (overAsq * I_F + XTX).todense(); 
-    varA = la.inv (aI_XTX)
+    # that alphaSq is also unchanging. We keep its Cholesky factorisation
+    # for the update of A, and form the inverse once for the bound.
+    print ("Factorising gram matrix")
+    aI_XTX  = (overAsq * I_F + XTX).toarray()
+    varACho = la.cho_factor(aI_XTX)
+    varA    = la.cho_solve(varACho, np.eye(F, dtype=DTYPE))
     
     # Scaled word counts is W / expLmda.dot(vocab). It's going to be exactly
-    # as sparse as W, which is why we initialise it in this manner.
-    scaledWordCounts = W.copy()
-    lmda = np.log(expLmda, out=expLmda)
+    # as sparse as W, so it shares W's indices, and only its values are
+    # ever overwritten.
+    scaledWordCounts = ssp.csr_matrix((np.empty_like(W.data), W.indices, W.indptr), shape=W.shape, copy=False)
+    
+    # Buffers for X A' and for the residuals that make up sigT, which is
+    # accumulated as a sequence of symmetric rank-k updates (only the
+    # upper triangle of which is written). These are reused every iteration
+    A_diff    = np.empty((K, F), dtype=DTYPE)
+    lmda_diff = np.empty((D, K), dtype=DTYPE)
+    XAT       = np.empty((D, K), dtype=DTYPE)
+    syrk      = la.blas.get_blas_funcs('syrk', dtype=DTYPE)
+    
+    # U'U is updated whenever U is, and reused in the bound
+    UTU = _gram(U, trans=True)
     
     print ("Launching inference")
-    for iteration in range(iterations):
+    with ThreadPoolExecutor(max_workers=1) as boundPool:
+        for iteration in range(iterations):
         
-        # =============================================================
-        # E-Step
-        #   Model dists are q(Theta|A;Lambda;nu) q(A|Y) q(Y) and q(Z)....
-        #   Where lambda is the posterior mean of theta.
-        # =============================================================
+            # =============================================================
+            # E-Step
+            #   Model dists are q(Theta|A;Lambda;nu) q(A|Y) q(Y) and q(Z)....
+            #   Where lambda is the posterior mean of theta.
+            # =============================================================
               
       
-        # Y, sigY, omY
-        #
-        UTU = U.T.dot(U)
-        sigY = la.inv(overTsq * I_P + overAsq * UTU)
-        verify_and_log ("E-Step: q(Y) [sigY]", iteration, X, W, K, Q, F, P, T, A, varA, Y, omY, sigY, sigT, U, V, vocab, sigmaSq, alphaSq, kappaSq, tauSq, expLmda, None, nu, lxi, s, docLen)
+            # Y, sigY, omY
+            #
+            isigY = overAsq * UTU
+            isigY.flat[::P+1] += overTsq
+            sigYCho = la.cho_factor(isigY)
+            sigY = la.cho_solve(sigYCho, I_P)
+            verify_and_log ("E-Step: q(Y) [sigY]", iteration, X, W, K, Q, F, P, T, A, varA, Y, omY, sigY, sigT, U, V, vocab, sigmaSq, alphaSq, kappaSq, tauSq, lmda, None, nu, lxi, s, docLen)
         
-        Y = A.dot(U).dot(sigY)
-        verify_and_log ("E-Step: q(Y) [Mean]", iteration, X, W, K, Q, F, P, T, A, varA, Y, omY, sigY, sigT, U, V, vocab, sigmaSq, alphaSq, kappaSq, tauSq, expLmda, None, nu, lxi, s, docLen)
+            Y = la.cho_solve(sigYCho, U.T.dot(A.T)).T # i.e. A.dot(U).dot(sigY)
+            verify_and_log ("E-Step: q(Y) [Mean]", iteration, X, W, K, Q, F, P, T, A, varA, Y, omY, sigY, sigT, U, V, vocab, sigmaSq, alphaSq, kappaSq, tauSq, lmda, None, nu, lxi, s, docLen)
         
-        # A 
-        #
-        A = varA.dot(X.T.dot(lmda) + U.dot(Y.T)).T
-        np.exp(expLmda, out=expLmda) # from here on in we assume we're working with exp(lmda)
-        verify_and_log ("E-Step: q(A)", iteration, X, W, K, Q, F, P, T, A, varA, Y, omY, sigY, sigT, U, V, vocab, sigmaSq, alphaSq, kappaSq, tauSq, None, expLmda, nu, lxi, s, docLen)
+            # A 
+            #
+            A = la.cho_solve(varACho, sparseDenseProduct(XT, lmda) + U.dot(Y.T)).T # i.e. varA.dot(...)
+            verify_and_log ("E-Step: q(A)", iteration, X, W, K, Q, F, P, T, A, varA, Y, omY, sigY, sigT, U, V, vocab, sigmaSq, alphaSq, kappaSq, tauSq, None, expLmda, nu, lxi, s, docLen)
        
-        # lmda_dk, nu_dk, s_d, and xi_dk
-        #
-        XAT = X.dot(A.T)
-#         query (VbSideTopicModelState (K, Q, F, P, T, A, varA, Y, omY, sigY, sigT, U, V, vocab, sigmaSq, alphaSq, kappaSq, tauSq), \
-#                X, W, \
-#                queryPlan, \
-#                VbSideTopicQueryState(expLmda, nu, lxi, s, docLen), \
-#                scaledWordCounts=scaledWordCounts, \
-#                XAT = XAT)
+            # lmda_dk, nu_dk, s_d, and xi_dk
+            #
+            # Note that while this query step is disabled, lmda is unchanged, and
+            # so expLmda stays equal to exp(lmda). Were it re-enabled, expLmda
+            # would need to be updated afterwards.
+            XAT = sparseDenseProduct(X, A.T, out=XAT)
+    #         query (VbSideTopicModelState (K, Q, F, P, T, A, varA, Y, omY, sigY, sigT, U, V, vocab, sigmaSq, alphaSq, kappaSq, tauSq), \
+    #                X, W, \
+    #                queryPlan, \
+    #                VbSideTopicQueryState(expLmda, nu, lxi, s, docLen), \
+    #                scaledWordCounts=scaledWordCounts, \
+    #                XAT = XAT)
        
        
-        # =============================================================
-        # M-Step
-        #    The projection used for A: U
-        #    The vocabulary : vocab
-        #    The topic correlation: sigT
-        # =============================================================
+            # =============================================================
+            # M-Step
+            #    The projection used for A: U
+            #    The vocabulary : vocab
+            #    The topic correlation: sigT
+            # =============================================================
                
-        # U
-        #
-        U = la.solve(np.trace(sigT) * I_P + Y.T.dot(Y), Y.T.dot(A)).T
-        verify_and_log ("M-Step: U", iteration, X, W, K, Q, F, P, T, A, varA, Y, omY, sigY, sigT, U, V, vocab, sigmaSq, alphaSq, kappaSq, tauSq, None, expLmda, nu, lxi, s, docLen)
+            # U
+            #
+            YTY = _gram(Y, trans=True)
+            YTY.flat[::P+1] += np.trace(sigT) # i.e. np.trace(sigT) * I_P + Y.T.dot(Y)
+            U = la.solve(YTY, Y.T.dot(A), assume_a='pos', overwrite_a=True, overwrite_b=True).T
+            UTU = _gram(U, trans=True)
+            verify_and_log ("M-Step: U", iteration, X, W, K, Q, F, P, T, A, varA, Y, omY, sigY, sigT, U, V, vocab, sigmaSq, alphaSq, kappaSq, tauSq, None, expLmda, nu, lxi, s, docLen)
 
-        # vocab
-        #
-#         factor = (scaledWordCounts.T.dot(expLmda)).T # Gets materialized as a dense matrix...
-#         vocab *= factor
-#         normalizerows_ip(vocab)
+            # vocab
+            #
+    #         factor = (scaledWordCounts.T.dot(expLmda)).T # Gets materialized as a dense matrix...
+    #         vocab *= factor
+    #         normalizerows_ip(vocab)
           
-        # A hack to work around the fact that we've got no prior, and thus no
-        # pseudo counts, so some values will collapse to zero
-#         vocab[vocab < sys.float_info.min] = sys.float_info.min
+            # A hack to work around the fact that we've got no prior, and thus no
+            # pseudo counts, so some values will collapse to zero
+    #         vocab[vocab < sys.float_info.min] = sys.float_info.min
         
-#         verify_and_log ("M-Step: vocab", iteration, X, W, K, Q, F, P, T, A, varA, Y, omY, sigY, sigT, U, V, vocab, sigmaSq, alphaSq, kappaSq, tauSq, None, expLmda, nu, lxi, s, docLen)
+    #         verify_and_log ("M-Step: vocab", iteration, X, W, K, Q, F, P, T, A, varA, Y, omY, sigY, sigT, U, V, vocab, sigmaSq, alphaSq, kappaSq, tauSq, None, expLmda, nu, lxi, s, docLen)
         
-        # sigT
-        #
-        lmda = np.log(expLmda, out=expLmda)
-        A_from_U_Y = Y.dot(U.T)
-        topic_from_A_X = X.dot(A.T)
+            # sigT
+            #
+            np.subtract(A, Y.dot(U.T), out=A_diff)
+            np.subtract(lmda, XAT, out=lmda_diff) # A is unchanged since XAT = X.dot(A.T) was computed
         
-        sigT  = 1. / P * (Y.dot(Y.T)) + \
-                1. / F * (A - A_from_U_Y).dot((A - A_from_U_Y).T) + \
-                1. / D * (lmda - topic_from_A_X).T.dot(lmda - topic_from_A_X)
-        sigT.flat[::K+1] += 1./D * nu.sum(axis=0, dtype=DTYPE) 
+            sigT = syrk(1. / P, Y)
+            sigT = syrk(1. / F, A_diff, beta=1., c=sigT, overwrite_c=True)
+            sigT = syrk(1. / D, lmda_diff, beta=1., c=sigT, trans=True, overwrite_c=True)
+            sigT += np.triu(sigT, 1).T
+            sigTDiag  = np.einsum('ii->i', sigT) # a writeable view of the diagonal
+            sigTDiag += 1./D * nu.sum(axis=0, dtype=DTYPE)
         
-        verify_and_log ("M-Step: sigT", iteration, X, W, K, Q, F, P, T, A, varA, Y, omY, sigY, sigT, U, V, vocab, sigmaSq, alphaSq, kappaSq, tauSq, None, expLmda, nu, lxi, s, docLen)
+            verify_and_log ("M-Step: sigT", iteration, X, W, K, Q, F, P, T, A, varA, Y, omY, sigY, sigT, U, V, vocab, sigmaSq, alphaSq, kappaSq, tauSq, None, expLmda, nu, lxi, s, docLen)
         
         
-        # =============================================================
-        # Handle logging of variational bound, likelihood, etc.
-        # =============================================================
-        if iteration == logIter:
-            np.exp(expLmda, out=expLmda)
-            modelState = VbSideTopicModelState (K, Q, F, P, T, A, varA, Y, omY, sigY, sigT, U, V, vocab, sigmaSq, alphaSq, kappaSq, tauSq)
-            queryState = VbSideTopicQueryState(expLmda, nu, lxi, s, docLen)
+            # =============================================================
+            # Handle logging of variational bound, likelihood, etc.
+            # =============================================================
+            if iteration == logIter:
+                # Collect the bound submitted at the previous logging step
+                if boundJob is not None:
+                    elbo, boundJob = boundJob.result(), None
+                    elbos.append (elbo)
+                    print ("\nIteration %5d  ELBO %15f" % (iters[-1], elbo))
                 
-            elbo   = varBound (modelState, queryState, X, W, None, XAT, XTX)
-            likely = log_likelihood(modelState, X, W, queryState) #recons_error(modelState, X, W, queryState)
+                    if abs(elbo - lastVarBoundValue) < epsilon:
+                        break
+                    else:
+                        lastVarBoundValue = elbo
             
-            np.log(expLmda, out=expLmda)
-                
-            elbos.append (elbo)
-            iters.append (iteration)
-            likes.append (likely)
-            print ("\nIteration %5d  ELBO %15f   Log-Likelihood %15f" % (iteration, elbo, likely))
+                modelState = VbSideTopicModelState (K, Q, F, P, T, A, varA, Y, omY, sigY, sigT, U, V, vocab, sigmaSq, alphaSq, kappaSq, tauSq)
+                queryState = VbSideTopicQueryState(expLmda, nu, lxi, s, docLen)
             
-            logIter = min (np.ceil(logIter * multiStepSize), iterations - 1)
+                # The model parameters are replaced, not updated in place, by the
+                # following iterations, but XAT is overwritten, so the bound gets
+                # a copy. So does expLmda, which log_likelihood() below normalises
+                # in place and restores, as does _quickPrintElbo() in debug mode
+                boundState = VbSideTopicQueryState(expLmda.copy(), nu, lxi, s, docLen)
+                boundJob   = boundPool.submit(varBound, modelState, boundState, X, W, None, XAT.copy(), XTX, scaledWordCounts, UTU=UTU)
+                likely     = log_likelihood(modelState, X, W, queryState) #recons_error(modelState, X, W, queryState)
             
-            if abs(elbo - lastVarBoundValue) < epsilon:
-                break
-            else:
-                lastVarBoundValue = elbo
+                iters.append (iteration)
+                likes.append (likely)
+                print ("\nIteration %5d  Log-Likelihood %15f" % (iteration, likely))
             
-            if plot and plotIncremental:
-                plot_bound(plotFile + "-iter-" + str(iteration), np.array(iters), np.array(elbos), np.array(likes))
-        else:
-            print('.', end='')
-            sys.stdout.flush()
+                logIter = min (np.ceil(logIter * multiStepSize), iterations - 1)
             
+                if plot and plotIncremental:
+                    plot_bound(plotFile + "-iter-" + str(iteration), np.array(iters[:len(elbos)]), np.array(elbos), np.array(likes[:len(elbos)]))
+            else:
+                print('.', end='')
+                sys.stdout.flush()
+            
+    
+        # Collect the last bound, if it's still outstanding
+        if boundJob is not None:
+            elbos.append (boundJob.result())
     
     # Right before we end, plot the evolution of the bound and likelihood
     # if we've been asked to do so.
@@ -259,78 +316,20 @@ def _quickPrintElbo (updateMsg, iteration, X, W, K, Q, F, P, T, A, varA, Y, omY,
     
     A tremendously inefficient method for debugging only.
     '''
-    
-    
-    def _has_nans(X):
-        return np.isnan(X.data).any()
-    def _has_infs(X):
-        return np.isinf(X.data).any()
-    def _nan (varName):
-        print (str(varName) + " has NaNs")
-    def _inf (varName):
-        print (str(varName) + " has infs")
-    
     assert not (lmda is not None and expLmda is not None), "We can't have both lmda and expLmda not be none, as we assume we only ever have one."
     
-    # NaN tests
-    if _has_nans(Y):
-        _nan("Y")
-    if omY is not None and _has_nans(omY):
-        _nan("omY")
-    if sigY is not None and _has_nans(sigY):
-        _nan("sigY")
-        
-    if _has_nans(A):
-        _nan("A")
-    if _has_nans(varA):
-        _nan("varA")
-        
-    if expLmda is not None and _has_nans(expLmda):
-        _nan("expLmda")
-    if lmda is not None and _has_nans(lmda):
-        _nan("lmda")
-    if sigT is not None and _has_nans(sigT):
-        _nan("sigT")
-    if _has_nans(nu):
-        _nan("nu")
-        
-    if U is not None and _has_nans(U):
-        _nan("U")
-    if V is not None and _has_nans(V):
-        _nan("V")
-        
-    if _has_nans(vocab):
-        _nan("vocab")
-        
-    # Infs tests
-    if _has_infs(Y):
-        _inf("Y")
-    if omY is not None and _has_infs(omY):
-        _inf("omY")
-    if sigY is not None and _has_infs(sigY):
-        _inf("sigY")
-        
-    if _has_infs(A):
-        _inf("A")
-    if _has_infs(varA):
-        _inf("varA")
-        
-    if expLmda is not None and _has_infs(expLmda):
-        _inf("expLmda")
-    if lmda is not None and _has_infs(lmda):
-        _inf("lmda")
-    if sigT is not None and _has_infs(sigT):
-        _inf("sigT")
-    if _has_infs(nu):
-        _inf("nu")
-        
-    if U is not None and _has_infs(U):
-        _inf("U")
-    if V is not None and _has_infs(V):
-        _inf("V")
-        
-    if _has_infs(vocab):
-        _inf("vocab")
+    # NaN and Inf tests. Each matrix is scanned once, and only if it's
+    # found to have non-finite values do we look for which kind
+    checks = [("Y", Y), ("omY", omY), ("sigY", sigY), ("A", A), ("varA", varA), \
+              ("expLmda", expLmda), ("lmda", lmda), ("sigT", sigT), ("nu", nu), \
+              ("U", U), ("V", V), ("vocab", vocab)]
+    for varName, value in checks:
+        if value is None or np.isfinite(value).all():
+            continue
+        if np.isnan(value).any():
+            print (str(varName) + " has NaNs")
+        if np.isinf(value).any():
+            print (str(varName) + " has infs")
     
     wasPassedExpLmda = expLmda is not None
     if expLmda is None:
@@ -364,8 +363,8 @@ def varBound (modelState, queryState, X, W, lnVocab = None, XAT=None, XTX = None
     (expLmda, nu, lxi, s, docLen) = (queryState.expLmda, queryState.nu, queryState.lxi, queryState.s, queryState.docLen)
     
     lmda      = np.log(expLmda)
-    isigT     = la.inv(sigT)
-    lnDetSigT = la.det(sigT)
+    sigTCho   = la.cho_factor(sigT)
+    lnDetSigT = 2 * np.sum(np.log(np.diag(sigTCho[0])))
     sigmaSq   = 1 # A bit of a hack till hyperparameter handling is standardised
     
     # Get the number of samples from the shape. Ensure that the shapes are consistent
@@ -377,10 +376,6 @@ def varBound (modelState, queryState, X, W, lnVocab = None, XAT=None, XTX = None
     if Dcheck != D: raise ValueError ("Inconsistent sizes between the matrices X and W, X has %d rows but W has %d" % (Dcheck, D))
     if Fcheck != F: raise ValueError ("The shape of the DxF feature matrix X is invalid. F is %d but the matrix X has shape (%d, %d)" % (F, Dcheck, Fcheck)) 
 
-    # We'll need the original xi for this and also Z, the 3D tensor of which for each document D 
-    # and term T gives the strength of topic K. We'll also need the log of the vocab dist
-    xi = deriveXi (lmda, nu, s)
-    
     # If not already provided, we'll also need the following products
     #
     if XAT is None:
@@ -388,9 +383,13 @@ def varBound (modelState, queryState, X, W, lnVocab = None, XAT=None, XTX = None
     if XTX is None:
         XTX = X.T.dot(X)
     if V is not None and VTV is None:
-        VTV = V.T.dot(V)
+        VTV = _gram(V, trans=True)
     if U is not None and UTU is None:
-        UTU = U.T.dot(U)
+        UTU = _gram(U, trans=True)
+    
+    # tr(XTX varA), which as XTX is symmetric is the sum of their elementwise
+    # product. Note that for a sparse XTX, the * operator is a matrix product.
+    trXTXvarA = XTX.multiply(varA).sum() if ssp.issparse(XTX) else np.einsum('ij,ij->', XTX, varA)
         
     # also need one over the usual variances
     overSsq, overAsq, overKsq, overTsq = 1./sigmaSq, 1./alphaSq, 1./kappaSq, 1./tauSq
@@ -401,7 +400,7 @@ def varBound (modelState, queryState, X, W, lnVocab = None, XAT=None, XTX = None
     #
     trSigY = 1 if sigY is None else np.trace(sigY)
     trOmY  = K # Basically it's the trace of the identity matrix as the posterior and prior cancel out
-    lnP_Y = -0.5 * (Q*P * LOG_2PI + P * lnDetSigT + overTkSq * trSigY * trOmY + overTkSq * np.trace(isigT.dot(Y).dot(Y.T)))
+    lnP_Y = -0.5 * (Q*P * LOG_2PI + P * lnDetSigT + overTkSq * trSigY * trOmY + overTkSq * np.einsum('kp,kp->', la.cho_solve(sigTCho, Y), Y))
     
     # <ln P(A|Y)>
     # TODO it looks like I should take the trace of omA \otimes I_K here.
@@ -412,39 +411,47 @@ def varBound (modelState, queryState, X, W, lnVocab = None, XAT=None, XTX = None
     # where sigY is QxQ and one with Y as a multi-varate, where sigY is a QPxQP.
     A_from_Y = Y.dot(U.T) if V is None else U.dot(Y).dot(V.T)
     A_diff = A - A_from_Y
-    varFactorU = np.trace(sigY.dot(np.kron(VTV, UTU))) if sigY.shape[0] == Q*P else np.sum(sigY*UTU)
+    # For the multi-variate case, tr(sigY (VTV kron UTU)) is evaluated by
+    # viewing sigY as a QxPxQxP tensor, rather than by forming the kron.
+    varFactorU = np.einsum('qpsr,sq,rp->', sigY.reshape(Q, P, Q, P), VTV, UTU) if sigY.shape[0] == Q*P else np.sum(sigY*UTU)
     varFactorV = 1 if V is None \
-        else np.sum(omY * V.T.dot(V))
+        else np.sum(omY * VTV)
     lnP_A = -halfKF * LOG_2PI - halfKF * log (alphaSq) -F/2.0 * lnDetSigT \
             -0.5 * (overAsSq * varFactorV * varFactorU \
-                      + np.trace(XTX.dot(varA)) * K \
-                      + np.sum(isigT.dot(A_diff) * A_diff))
+                      + trXTXvarA * K \
+                      + np.einsum('kf,kf->', la.cho_solve(sigTCho, A_diff), A_diff))
             
     # <ln p(Theta|A,X)
     # 
     lmdaDiff = lmda - XAT
     lnP_Theta = -0.5 * D * LOG_2PI -0.5 * D * lnDetSigT \
                 -0.5 / sigmaSq * ( \
-                    np.sum(nu) + D*K * np.sum(XTX * varA) + np.sum(lmdaDiff.dot(isigT) * lmdaDiff))
+                    np.sum(nu) + D*K * trXTXvarA + np.einsum('kd,dk->', la.cho_solve(sigTCho, lmdaDiff.T), lmdaDiff))
     # Why is order of sigT reversed? It's 'cause we've not been consistent. A is KxF but lmda is DxK, and
     # note that the distribution of lmda transpose has the same covariances, just in different positions
     # (i.e. row is col and vice-versa)
     
     # <ln p(Z|Theta)
     # 
-    docLenLmdaLxi = docLen[:, np.newaxis] * lmda * lxi
+    # All the terms scaled by the document length are accumulated in a
+    # single DxK matrix, which is then summed in one pass. We need the
+    # original xi for this, which deriveXi() defines by
+    # xi^2 = (lmda - s)^2 + nu^2, so it's computed here from lmda - s. As
+    # a consequence, the terms scaled by lxi, which sum to
+    # lxi * (xi^2 - nu^2 - (lmda - s)^2), cancel, and are omitted.
+    if scaledWordCounts is None:
+        scaledWordCounts = ssp.csr_matrix((np.empty_like(W.data), W.indices, W.indptr), shape=W.shape, copy=False)
     scaledWordCounts = sparseScalarQuotientOfDot(W, expLmda, vocab, out=scaledWordCounts)
+    
+    lmdaLessS = lmda - s[:, np.newaxis]
+    xi        = np.hypot(lmdaLessS, nu) # i.e. deriveXi (lmda, nu, s)
+    lnP_Z_dk  = xi - lmdaLessS
+    lnP_Z_dk *= 0.5
+    lnP_Z_dk -= safe_log_one_plus_exp_of(xi, out=xi)
 
-    lnP_Z = 0.0
-    lnP_Z -= np.sum(docLenLmdaLxi * lmda)
-    lnP_Z -= np.sum(docLen[:, np.newaxis] * nu * nu * lxi)
-    lnP_Z += 2 * np.sum (s[:, np.newaxis] * docLenLmdaLxi)
-    lnP_Z -= 0.5 * np.sum (docLen[:, np.newaxis] * lmda)
-    lnP_Z += np.sum (lmda * expLmda * (scaledWordCounts.dot(vocab.T))) # n(d,k) = expLmda * (scaledWordCounts.dot(vocab.T))
-    lnP_Z -= np.sum(docLen[:,np.newaxis] * lxi * ((s**2)[:,np.newaxis] - xi**2))
-    lnP_Z += 0.5 * np.sum(docLen[:,np.newaxis] * (s[:,np.newaxis] + xi))
-    lnP_Z -= np.sum(docLen[:,np.newaxis] * safe_log_one_plus_exp_of(xi))
-    lnP_Z -= np.sum (docLen * s)
+    lnP_Z  = np.einsum('d,dk->', docLen, lnP_Z_dk)
+    lnP_Z += np.einsum('dk,dk,dk->', lmda, expLmda, scaledWordCounts.dot(vocab.T)) # n(d,k) = expLmda * (scaledWordCounts.dot(vocab.T))
+    lnP_Z -= np.dot (docLen, s)
         
     # <ln p(W|Z, vocab)>
     # 
@@ -452,8 +459,8 @@ def varBound (modelState, queryState, X, W, lnVocab = None, XAT=None, XTX = None
     lnP_W = np.sum(lnP_w_dt.data)
     
     # H[q(Y)]
-    lnDetOmY  = 0 if omY  is None else log(la.det(omY))
-    lnDetSigY = 0 if sigY is None else log(max(la.det(sigY), sys.float_info.min)) # TODO FIX THIS
+    lnDetOmY  = 0 if omY  is None else _lnDetPosDef(omY)
+    lnDetSigY = 0 if sigY is None else _lnDetPosDef(sigY)
     ent_Y = 0.5 * (P * K * LOG_2PI_E + Q * lnDetOmY + P * lnDetSigY)
     
     # H[q(A|Y)]
@@ -468,7 +475,7 @@ def varBound (modelState, queryState, X, W, lnVocab = None, XAT=None, XTX = None
     ent_A = 0
     
     # H[q(Theta|A)]
-    ent_Theta = 0.5 * (K * LOG_2PI_E + np.sum (np.log(nu * nu)))
+    ent_Theta = 0.5 * (K * LOG_2PI_E + 2 * np.sum (np.log(nu))) # log(nu^2) = 2 log(nu) for positive nu
     
     # H[q(Z|\Theta)
     #
@@ -487,6 +494,32 @@ def varBound (modelState, queryState, X, W, lnVocab = None, XAT=None, XTX = None
     return result
 
 
+def _lnDetPosDef(M):
+    '''
+    Returns the log of the determinant of the symmetric positive-definite
+    matrix M, using its Cholesky factorisation. If M is not numerically
+    positive-definite, this falls back to safe_log_det()
+    '''
+    try:
+        L = la.cholesky(M, lower=True)
+        return 2 * np.sum(np.log(np.diag(L)))
+    except la.LinAlgError:
+        return safe_log_det(M)
+
+
+def _gram(M, trans=False):
+    '''
+    Returns the symmetric matrix M.dot(M.T), or M.T.dot(M) if trans is
+    true. This uses a symmetric rank-k update, which only calculates
+    one triangle of the result, and so does half the work of a general
+    matrix product.
+    '''
+    syrk = la.blas.get_blas_funcs('syrk', (M,))
+    G = syrk(1., M, trans=trans)
+    G += np.triu(G, 1).T
+    return G
+
+
 def newVbModelState(K, Q, F, P, T, featVar = 0.01, topicVar = 0.01, latFeatVar = 1, latTopicVar = 1):
     '''
     Creates a new model state object for a topic model based on side-information. This state
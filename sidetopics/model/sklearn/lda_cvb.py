@@ -32,13 +32,13 @@ logging.basicConfig(level=logging.DEBUG,
                     format="%(filename)s:%(funcName)s:%(lineno)s   :: %(message)s")
 
 
-def dict_without(d: Dict[str, str], key: str) -> Dict[str, str]:
+def dict_without(d: Dict[str, str], *keys: str) -> Dict[str, str]:
     """
-    A copy of the dict with everything except the given key
+    A copy of the dict with everything except the given keys
     """
     r = d.copy()
-    if key in r:
-        r.pop(key)
+    for key in keys:
+        r.pop(key, None)
     return r
 
 
@@ -208,7 +208,8 @@ class TopicModel(BaseEstimator, TransformerMixin):
         ).transform(
             X,
             resume=True,
-            **dict_without(kwargs, 'resume')
+            persist_query_state=True,
+            **dict_without(kwargs, 'resume', 'persist_query_state')
         )
 
     def fit(self,
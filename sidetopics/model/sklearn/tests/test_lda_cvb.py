@@ -5,9 +5,11 @@
 # 2 Test of CVB 0
 
 from typing import NamedTuple
+import functools
+import os
 import numpy as np
 import numpy.testing as nptest
-import numpy.random as rd
+import scipy.sparse as ssp
 import unittest
 
 from sidetopics.model import DataSet
@@ -39,34 +41,42 @@ class TopicModelTestSample:
         self.assignments = assignments
         self.lengths = lengths
 
-        self.sample_documents = np.floor((assignments @ components) * lengths[:, np.newaxis])
+        expected_counts = np.empty((assignments.shape[0], components.shape[1]))
+        np.einsum('dk,kt,d->dt', assignments, components, lengths, optimize='greedy', out=expected_counts)
+        self.sample_documents = np.floor(expected_counts, out=expected_counts).astype(np.int32)
 
-    def as_dataset(self, **kwargs) -> DataSet:
+    def as_dataset(self, debug: bool = True, **kwargs) -> DataSet:
         """
         Converts to a dataset, words only. Passes the extra parameters along to
-        the DataSet constructor if any
+        the DataSet constructor if any.
+
+        Debug mode is the default, as its only effect here is to skip the sanity
+        check that there are more than 100 terms, which this small sample fails.
+
+        The counts are stored as integers, but the models' likelihood code writes
+        its results into a copy of the word matrix, so the dataset holds floats,
+        in double-precision as that's what most of the models use natively.
         """
-        return DataSet(words=self.sample_documents, **kwargs)
+        return DataSet(words=ssp.csr_matrix(self.sample_documents, dtype=np.float64), debug=debug, **kwargs)
 
     @property
     def n_components(self):
         return self.components.shape[0]
 
     @staticmethod
+    @functools.lru_cache(maxsize=8)
     def new_fixed(seed: int = None):
-        if seed is not None:
-            rd.seed(seed)
-
-        components = np.array([
-            [0] * WORDS_PER_TOPIC*0 +  [1] * WORDS_PER_TOPIC + [0] * 4*WORDS_PER_TOPIC,
-            [0] * WORDS_PER_TOPIC*1 + [1] * WORDS_PER_TOPIC + [0] * 3*WORDS_PER_TOPIC,
-            [0] * WORDS_PER_TOPIC*2 + [1] * WORDS_PER_TOPIC + [0] * 2*WORDS_PER_TOPIC,
-            [0] * WORDS_PER_TOPIC*3 + [1] * WORDS_PER_TOPIC + [0] * 1*WORDS_PER_TOPIC,
-            [0] * WORDS_PER_TOPIC*4 + [1] * WORDS_PER_TOPIC + [0] * 0*WORDS_PER_TOPIC
-        ])
-
-        assignments = rd.dirichlet(alpha=[0.1] * TRUE_TOPIC_COUNT, size=DOC_COUNT)
-        lens = rd.poisson(AVG_DOC_LEN, size=DOC_COUNT)
+        """
+        Samples the fixed five-topic test case. The result is a pure function of the
+        seed, so it's cached and shared between callers, who should treat it as
+        read-only.
+        """
+        rng = np.random.default_rng(seed)
+
+        components = np.repeat(np.eye(TRUE_TOPIC_COUNT), WORDS_PER_TOPIC, axis=1)
+
+        assignments = rng.dirichlet(alpha=[0.1] * TRUE_TOPIC_COUNT, size=DOC_COUNT)
+        lens = rng.poisson(AVG_DOC_LEN, size=DOC_COUNT)
         return TopicModelTestSample(components=components,
                                     assignments=assignments,
                                     lengths=lens)
@@ -75,18 +85,61 @@ class TopicModelTestSample:
 class SklearnLdaCvbTest(unittest.TestCase):
     # Add a test to ensure that repeated calls to transform have the same effect (i.e. we're not training by accident)
 
+    @classmethod
+    def setUpClass(cls):
+        cls._testcase = TopicModelTestSample.new_fixed(seed=0xBADB055)
+        cls._dataset = cls._testcase.as_dataset()
+
+    def _fit_with_snapshot(self, kind: TopicModelType, total: int = 100, snapshot_at: int = 90):
+        """
+        Fits one model for the total number of iterations, and another for snapshot_at
+        iterations, which is then resumed for the remainder. Returns the assignments
+        from the full and resumed fits, which should match.
+        """
+        model = TopicModel(kind=kind, n_components=self._testcase.n_components, seed=0xC0FFEE)
+        full = model.fit_transform(self._dataset, iterations=total)
+
+        model = TopicModel(kind=kind, n_components=self._testcase.n_components, seed=0xC0FFEE)
+        _ = model.fit_transform(self._dataset, iterations=snapshot_at)
+        resumed = model.fit_transform(self._dataset, iterations=total - snapshot_at, resume=True)
+
+        return full, resumed
+
+    def test_dataset_debug_invariants(self):
+        words = self._dataset.words
+        self.assertTrue(ssp.isspmatrix_csr(words), "Words should be passed to the models as a CSR matrix")
+        self.assertEqual(np.float64, words.dtype)
+        nptest.assert_array_equal(self._testcase.sample_documents, words.toarray())
+
+        with self.assertRaises(AssertionError, msg="Sample vocabulary should fail the non-debug sanity checks"):
+            self._testcase.as_dataset(debug=False)
+
+    def test_determinism(self):
+        for kind, model_args in [(TopicModelType.LDA_CVB0, {}),
+                                 (TopicModelType.LDA_CVB, {}),
+                                 (TopicModelType.LDA_VB_PYTHON_IMPL, {'iterations': 50}),
+                                 (TopicModelType.MOM_VB, {}),
+                                 (TopicModelType.MOM_GIBBS, {})]:
+            with self.subTest(kind=kind):
+                self._do_determinism_test(kind, **model_args)
+
+    def _do_determinism_test(self, kind: TopicModelType, **model_args):
+        model = TopicModel(kind=kind, n_components=self._testcase.n_components, seed=0xC0FFEE, **model_args)
+        assignments = model.fit_transform(self._dataset)
+
+        model = TopicModel(kind=kind, n_components=self._testcase.n_components, seed=0xC0FFEE, **model_args)
+        assignments_2 = model.fit_transform(self._dataset)
+        np.testing.assert_array_almost_equal(assignments, assignments_2, decimal=3,
+                                             err_msg="Failed to respect initial seed")
+
+        print(f'{assignments}')
+
     def test_lda_cvb0_data(self):
-        testcase = TopicModelTestSample.new_fixed(seed=0xBADB055)
-        dataset = testcase.as_dataset(debug=True)
+        testcase, dataset = self._testcase, self._dataset
 
         model = TopicModel(kind=TopicModelType.LDA_CVB0, n_components=testcase.n_components, seed=0xC0FFEE)
         assignments = model.fit_transform(dataset)
 
-        model = TopicModel(kind=TopicModelType.LDA_CVB0, n_components=testcase.n_components, seed=0xC0FFEE)
-        assignments_2 = model.fit_transform(dataset)
-        np.testing.assert_array_almost_equal(assignments, assignments_2, decimal=3,
-                                             err_msg="Failed to respect initial seed")
-
         perp_2e = model.score(dataset, method=ScoreMethod.PerplexityBoundOrSampled)
         score_0 = model.score(dataset, y=assignments, method=ScoreMethod.LogLikelihoodPoint)
         score_0e = model.score(dataset, y=assignments, method=ScoreMethod.LogLikelihoodBoundOrSampled)
@@ -97,54 +150,18 @@ class SklearnLdaCvbTest(unittest.TestCase):
         print(f'{assignments}')
 
     def test_lda_cvb0_resume_simple_data(self):
-        testcase = TopicModelTestSample.new_fixed(seed=0xBADB055)
-        dataset = testcase.as_dataset(debug=True)
-
-        model = TopicModel(kind=TopicModelType.LDA_CVB0, n_components=testcase.n_components, seed=0xC0FFEE)
-        assignments = model.fit_transform(dataset, iterations=100)
+        assignments, assignments_from_resume = self._fit_with_snapshot(TopicModelType.LDA_CVB0)
 
-        testcase = TopicModelTestSample.new_fixed(seed=0xBADB055)
-        dataset = testcase.as_dataset(debug=True)
-
-        model = TopicModel(kind=TopicModelType.LDA_CVB0, n_components=testcase.n_components, seed=0xC0FFEE)
-        _ = model.fit_transform(dataset, iterations=90)
-        assignments_from_resume = model.fit_transform(dataset, iterations=10, resume=True)
+        np.testing.assert_allclose(assignments, assignments_from_resume, atol=1.5e-3, rtol=0)
 
-        np.testing.assert_array_almost_equal(assignments, assignments_from_resume, decimal=3)
-
-
-    def test_mom_vb_data(self):
-        testcase = TopicModelTestSample.new_fixed(seed=0xBADB055)
-        dataset = testcase.as_dataset(debug=True)
-
-        model = TopicModel(kind=TopicModelType.MOM_VB, n_components=testcase.n_components, seed=0xC0FFEE)
-        assignments = model.fit_transform(dataset)
-
-        model = TopicModel(kind=TopicModelType.MOM_VB, n_components=testcase.n_components, seed=0xC0FFEE)
-        assignments_2 = model.fit_transform(dataset)
-        np.testing.assert_array_almost_equal(assignments, assignments_2, decimal=3)
-
-        print(f'{assignments}')
 
     def test_mom_vb_resume_simple_data(self):
-        testcase = TopicModelTestSample.new_fixed(seed=0xBADB055)
-        dataset = testcase.as_dataset(debug=True)
-
-        model = TopicModel(kind=TopicModelType.MOM_VB, n_components=testcase.n_components, seed=0xC0FFEE)
-        assignments = model.fit_transform(dataset, iterations=100)
+        assignments, assignments_from_resume = self._fit_with_snapshot(TopicModelType.MOM_VB)
 
-        testcase = TopicModelTestSample.new_fixed(seed=0xBADB055)
-        dataset = testcase.as_dataset(debug=True)
-
-        model = TopicModel(kind=TopicModelType.MOM_VB, n_components=testcase.n_components, seed=0xC0FFEE)
-        _ = model.fit_transform(dataset, iterations=90)
-        assignments_from_resume = model.fit_transform(dataset, iterations=10, resume=True)
-
-        np.testing.assert_array_almost_equal(assignments, assignments_from_resume, decimal=3)
+        np.testing.assert_allclose(assignments, assignments_from_resume, atol=1.5e-3, rtol=0)
 
     def test_mom_vb_score_point(self):
-        full_data_raw = TopicModelTestSample.new_fixed(0xBADB055)
-        full_dataset = full_data_raw.as_dataset(debug=True)
+        full_data_raw, full_dataset = self._testcase, self._dataset
         train_data, test_data = full_dataset.cross_valid_split(test_fold_id=0, num_folds=4, debug=True)
         est_data, eval_data = test_data.doc_completion_split(debug=True)
 
@@ -196,8 +213,7 @@ class SklearnLdaCvbTest(unittest.TestCase):
         self.assertTrue(7 < perp_1 < 11, f"Perplexity 1 & 2 is not within the range of sensible values. {perp_1}")
 
     def test_mom_vb_score_bound_or_sampled(self):
-        full_data_raw = TopicModelTestSample.new_fixed(0xBADB055)
-        full_dataset = full_data_raw.as_dataset(debug=True)
+        full_data_raw, full_dataset = self._testcase, self._dataset
         train_data, test_data = full_dataset.cross_valid_split(test_fold_id=0, num_folds=4, debug=True)
         est_data, eval_data = test_data.doc_completion_split(debug=True)
 
@@ -235,116 +251,63 @@ class SklearnLdaCvbTest(unittest.TestCase):
     def test_score_with_point_vs_score_bound_or_samples(self):
         raise NotImplementedError()
 
-    def test_mom_gibbs_data(self):
-        testcase = TopicModelTestSample.new_fixed(seed=0xBADB055)
-        dataset = testcase.as_dataset(debug=True)
-
-        model = TopicModel(kind=TopicModelType.MOM_GIBBS, n_components=testcase.n_components, seed=0xC0FFEE)
-        assignments = model.fit_transform(dataset)
-
-        model = TopicModel(kind=TopicModelType.MOM_GIBBS, n_components=testcase.n_components, seed=0xC0FFEE)
-        assignments_2 = model.fit_transform(dataset)
-        np.testing.assert_array_almost_equal(assignments, assignments_2, decimal=3)
-
-        print(f'{assignments}')
-
     def test_mom_gibbs_resume_simple_data(self):
-        testcase = TopicModelTestSample.new_fixed(seed=0xBADB055)
-        dataset = testcase.as_dataset(debug=True)
-
-        model = TopicModel(kind=TopicModelType.MOM_GIBBS, n_components=testcase.n_components, seed=0xC0FFEE)
-        assignments = model.fit_transform(dataset, iterations=100)
+        assignments, assignments_from_resume = self._fit_with_snapshot(TopicModelType.MOM_GIBBS)
 
-        testcase = TopicModelTestSample.new_fixed(seed=0xBADB055)
-        dataset = testcase.as_dataset(debug=True)
-
-        model = TopicModel(kind=TopicModelType.MOM_GIBBS, n_components=testcase.n_components, seed=0xC0FFEE)
-        _ = model.fit_transform(dataset, iterations=90)
-        assignments_from_resume = model.fit_transform(dataset, iterations=10, resume=True)
-
-        np.testing.assert_array_almost_equal(assignments, assignments_from_resume, decimal=3)
-
-    def test_lda_cvb_data(self):
-        testcase = TopicModelTestSample.new_fixed(seed=0xBADB055)
-        dataset = testcase.as_dataset(debug=True)
-
-        model = TopicModel(kind=TopicModelType.LDA_CVB, n_components=testcase.n_components, seed=0xC0FFEE)
-        assignments = model.fit_transform(dataset)
-        model = TopicModel(kind=TopicModelType.LDA_CVB, n_components=testcase.n_components, seed=0xC0FFEE)
-        assignments_2 = model.fit_transform(dataset)
-        np.testing.assert_array_almost_equal(assignments, assignments_2, decimal=3)
-
-        print(f'{assignments}')
+        np.testing.assert_allclose(assignments, assignments_from_resume, atol=1.5e-3, rtol=0)
 
     def test_lda_cvb_resume_simple_data(self):
-        testcase = TopicModelTestSample.new_fixed(seed=0xBADB055)
-        dataset = testcase.as_dataset(debug=True)
+        assignments, assignments_from_resume = self._fit_with_snapshot(TopicModelType.LDA_CVB)
 
-        model = TopicModel(kind=TopicModelType.LDA_CVB, n_components=testcase.n_components, seed=0xC0FFEE)
-        assignments = model.fit_transform(dataset, iterations=100)
+        np.testing.assert_allclose(assignments, assignments_from_resume, atol=1.5e-3, rtol=0)
 
-        testcase = TopicModelTestSample.new_fixed(seed=0xBADB055)
-        dataset = testcase.as_dataset(debug=True)
 
-        model = TopicModel(kind=TopicModelType.LDA_CVB, n_components=testcase.n_components, seed=0xC0FFEE)
-        _ = model.fit_transform(dataset, iterations=90)
-        assignments_from_resume = model.fit_transform(dataset, iterations=10, resume=True)
+    def test_lda_vb_resume_simple_data(self):
+        assignments, assignments_from_resume = self._fit_with_snapshot(TopicModelType.LDA_VB_PYTHON_IMPL)  # FIXME resume applies to transform rather than fit, which resumed by default
 
-        np.testing.assert_array_almost_equal(assignments, assignments_from_resume, decimal=3)
+        np.testing.assert_allclose(assignments, assignments_from_resume, atol=1.5e-3, rtol=0)
 
 
-    def test_lda_vb_data(self):
-        testcase = TopicModelTestSample.new_fixed(seed=0xBADB055)
-        dataset = testcase.as_dataset(debug=True)
+    def test_lda_gibbs_data(self):
+        testcase, dataset = self._testcase, self._dataset
 
-        model = TopicModel(kind=TopicModelType.LDA_VB_PYTHON_IMPL, n_components=testcase.n_components, iterations=50, seed=0xC0FFEE)
+        model = TopicModel(kind=TopicModelType.LDA_GIBBS, n_components=testcase.n_components, seed=0xC0FFEE)
         assignments = model.fit_transform(dataset)
 
-        model = TopicModel(kind=TopicModelType.LDA_VB_PYTHON_IMPL, n_components=testcase.n_components, iterations=50, seed=0xC0FFEE)
-        assignments_2 = model.fit_transform(dataset)
-        np.testing.assert_array_almost_equal(assignments, assignments_2, decimal=3)
+        self.assertCountEqual([0], [0], "Equal")
 
         print(f'{assignments}')
 
-    def test_lda_vb_resume_simple_data(self):
-        testcase = TopicModelTestSample.new_fixed(seed=0xBADB055)
-        dataset = testcase.as_dataset(debug=True)
+    def test_lda_gibbs_resume_smoke(self):
+        testcase, dataset = self._testcase, self._dataset
 
-        model = TopicModel(kind=TopicModelType.LDA_VB_PYTHON_IMPL, n_components=testcase.n_components, seed=0xC0FFEE)
-        assignments = model.fit_transform(dataset, iterations=100)
-
-        testcase = TopicModelTestSample.new_fixed(seed=0xBADB055)
-        dataset = testcase.as_dataset(debug=True)
-
-        model = TopicModel(kind=TopicModelType.LDA_VB_PYTHON_IMPL, n_components=testcase.n_components, seed=0xC0FFEE)
-        _ = model.fit_transform(dataset, iterations=90)
-        assignments_from_resume = model.fit_transform(dataset, iterations=10, resume=True)  # FIXME resume applies to transform rather than fit, which resumed by default
-
-        np.testing.assert_array_almost_equal(assignments, assignments_from_resume, decimal=3)
-
-
-    def test_lda_gibbs_data(self):
-        testcase = TopicModelTestSample.new_fixed(seed=0xBADB055)
-        dataset = testcase.as_dataset(debug=True)
-
-        model = TopicModel(kind=TopicModelType.LDA_GIBBS, n_components=testcase.n_components, seed=0xC0FFEE)
+        model = TopicModel(kind=TopicModelType.LDA_GIBBS, n_components=testcase.n_components,
+                           iterations=50, burn_in=20, thin=5, query_iterations=10, seed=0xC0FFEE)
         assignments = model.fit_transform(dataset)
 
-        self.assertCountEqual([0], [0], "Equal")
+        model = TopicModel(kind=TopicModelType.LDA_GIBBS, n_components=testcase.n_components,
+                           iterations=50, burn_in=20, thin=5, query_iterations=10, seed=0xC0FFEE)
+        _tmp = model.fit_transform(dataset, iterations=40)
+        persisted = model.query_state_
+        self.assertIsNotNone(persisted, "fit_transform should persist its query state for a later resume")
 
-        print(f'{assignments}')
+        z_before = persisted.z_list.copy()
+        assignments_from_resume = model.fit_transform(dataset, iterations=10, burn_in=0, thin=5, resume=True)
 
+        # The sampler updates the per-token assignments in place, so a resumed chain carries on with the
+        # persisted array, whereas a fresh query state would draw a new one at random
+        self.assertIs(persisted.z_list, model.query_state_.z_list)
+        self.assertFalse(np.array_equal(z_before, model.query_state_.z_list), "The resumed chain never moved")
+        np.testing.assert_allclose(assignments, assignments_from_resume, atol=1.5e-3, rtol=0)
+
+    @unittest.skipUnless(os.environ.get('SIDETOPICS_RUN_SLOW'), 'slow Gibbs test, set SIDETOPICS_RUN_SLOW to run')
     def test_lda_gibbs_resume_simple_data(self):
-        testcase = TopicModelTestSample.new_fixed(seed=0xBADB055)
-        dataset = testcase.as_dataset(debug=True)
+        testcase, dataset = self._testcase, self._dataset
 
         model = TopicModel(kind=TopicModelType.LDA_GIBBS, n_components=testcase.n_components,
                            iterations=500, burn_in=500, thin=10, seed=0xC0FFEE)
         assignments = model.fit_transform(dataset)
 
-        testcase = TopicModelTestSample.new_fixed(seed=0xBADB055 )
-        dataset = testcase.as_dataset(debug=True)
-
         model = TopicModel(kind=TopicModelType.LDA_GIBBS, n_components=testcase.n_components,
                            iterations=500, burn_in=500, thin=10, query_iterations=100, seed=0xC0FFEE)
         _tmp = model.fit_transform(dataset, iterations=400)
@@ -356,9 +319,6 @@ class SklearnLdaCvbTest(unittest.TestCase):
     def test_lda_svb(self):  #using the LDA_VB_PYTHON impl
         pass
 
-    def test_lda_gibbs_resume_simple_data(self):  #using the LDA_VB_PYTHON impl
-        pass
-
     # Aim of the work is to compare MoM with LDA
     # To compare LDA Gibbs with LDA VB with LDA SVB
     # To compare LDA VB with HDP
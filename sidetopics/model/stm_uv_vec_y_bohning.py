@@ -613,7 +613,7 @@ def var_bound(data, modelState, queryState):
         bound += np.sum(sparseScalarProductOfSafeLnDot(W, expMeansBatch, vocab, start=start, end=end).data)
 
         bound += np.sum(meansBatch * VBatch)
-        bound += np.sum(2 * ssp.diags(docLensBatch,0) * meansBatch.dot(H) * meansBatch)
+        bound += 2 * np.einsum('d,dk,dk->', docLensBatch, meansBatch.dot(H), meansBatch)
         bound -= 2. * scaledSelfSoftDot(meansBatch, docLensBatch)
         bound -= 0.5 * np.sum(docLensBatch[:,np.newaxis] * VBatch * (np.diag(H))[np.newaxis,:])
 
@@ -506,7 +506,7 @@ def var_bound(data, modelState, queryState, XTX=None):
     bound += np.sum(sparseScalarProductOfSafeLnDot(W, expMeans, vocab).data)
 
     bound += np.sum(means * S)
-    bound += np.sum(2 * ssp.diags(docLens,0) * means.dot(Ab) * means)
+    bound += 2 * np.einsum('d,dk,dk->', docLens, means.dot(Ab), means)
     bound -= 2. * scaledSelfSoftDot(means, docLens)
     bound -= 0.5 * np.sum(docLens[:,np.newaxis] * S * (np.diag(Ab))[np.newaxis,:])
     
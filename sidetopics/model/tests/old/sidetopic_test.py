@@ -10,6 +10,7 @@ from __future__ import division
 import unittest
 
 from math import sqrt
+from functools import lru_cache
 
 from model.old.sidetopic import newVbModelState, train, rowwise_softmax, normalizerows_ip
 
@@ -178,6 +179,19 @@ def makeSixTopicVocab(T):
     '''
     K = 6
     vocab = rd.random((K, T))
+    vocab *= _sixTopicScales(T)
+    
+    return normalizerows_ip(vocab)
+
+@lru_cache(maxsize=4)
+def _sixTopicScales(T):
+    '''
+    The per-word multipliers that give each of the six topics in 
+    makeSixTopicVocab its pattern. These depend only on T, and the band
+    matrix is slow to build, so they're computed once per T and returned
+    as a read-only KxT matrix.
+    '''
+    K = 6
     side  = int(sqrt(T))
     
     AMPLIFIED = 8
@@ -190,14 +204,16 @@ def makeSixTopicVocab(T):
     innerBand = (bandArr * (AMPLIFIED - LOWERED)) + LOWERED;
     outerBand = -(innerBand - RANGE)
     
-    vocab[0,:] = (vocab[0,:].reshape(side,side) * upperArr[:,np.newaxis]).reshape(1,T)
-    vocab[1,:] = (vocab[1,:].reshape(side,side) * lowerArr[:,np.newaxis]).reshape(1,T)
-    vocab[2,:] = (vocab[2,:].reshape(side,side) * upperArr[np.newaxis,:]).reshape(1,T)
-    vocab[3,:] = (vocab[3,:].reshape(side,side) * lowerArr[np.newaxis,:]).reshape(1,T)
-    vocab[4,:] = (vocab[4,:].reshape(side,side) * innerBand).reshape(1,T)
-    vocab[5,:] = (vocab[5,:].reshape(side,side) * outerBand).reshape(1,T)
+    scales = np.ndarray((K, T))
+    scales[0,:] = np.repeat(upperArr, side)
+    scales[1,:] = np.repeat(lowerArr, side)
+    scales[2,:] = np.tile(upperArr, side)
+    scales[3,:] = np.tile(lowerArr, side)
+    scales[4,:] = innerBand.reshape(T)
+    scales[5,:] = outerBand.reshape(T)
     
-    return normalizerows_ip(vocab)
+    scales.setflags(write=False)
+    return scales
 
 def makeBandMatrix (side):
     '''
@@ -272,7 +288,7 @@ def vec(A):
     (rows, cols) = A.shape
     return A.T.reshape((rows*cols,))
 
-def matrix_normal(mean, rowCov, colCov):
+def matrix_normal(mean, rowCov, colCov, rng=rd):
     '''
     Draw from a matrix-variate normal distribution
     
@@ -280,11 +296,12 @@ def matrix_normal(mean, rowCov, colCov):
     mean the mean matrix, with dimensions PxN
     rowCov the row covariance matrix, with dimensions NxN
     colCov the column covariance matrix, with dimensions PxP
+    rng the random generator to draw from, by default the global numpy one
     
     Return
     a PxN matrix
     '''
-    return rd.multivariate_normal(vec(mean), np.kron(colCov, rowCov)).reshape(mean.shape, order='F')
+    return rng.multivariate_normal(vec(mean), np.kron(colCov, rowCov)).reshape(mean.shape, order='F')
 
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
@@ -10,18 +10,30 @@ from __future__ import division
 import unittest
 
 
-from model.sidetopic_uyv import newVbModelState, train, query, rowwise_softmax, log_likelihood
-from model_test.sidetopic_test import makeSixTopicVocab, matrix_normal
+from model.sidetopic_uyv import newVbModelState, train, query, log_likelihood
+from model_test.sidetopic_test import makeSixTopicVocab
 from util.overflow_safe import safe_log
+from util.sigmoid_utils import rowwise_softmax
 
 import numpy as np
 import scipy.linalg as la
 import numpy.random as rd
 import scipy.sparse as ssp
 from math import ceil
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing as mp
 
 
-def sampleFromModel(D=200, T=100, K=10, Q=6, F=12, P=8, avgWordsPerDoc = 500):
+def _matrix_normal_iid(mean, rowVar, colVar, rng):
+    '''
+    Draw from a matrix-variate normal distribution whose row and column
+    covariances are rowVar * I and colVar * I. In this case every element
+    is an independent normal with variance rowVar * colVar, so no
+    factorisation of the (Kronecker) covariance is needed.
+    '''
+    return mean + np.sqrt(rowVar * colVar) * rng.standard_normal(mean.shape)
+
+def sampleFromModel(D=200, T=100, K=10, Q=6, F=12, P=8, avgWordsPerDoc = 500, rng=None):
     '''
     Create a test dataset according to the model
     
@@ -33,6 +45,7 @@ def sampleFromModel(D=200, T=100, K=10, Q=6, F=12, P=8, avgWordsPerDoc = 500):
         F - Observed features
         D - Sample documents (each with associated features)
         avgWordsPerDoc - average number of words per document generated (Poisson)
+        rng - the random generator to sample from, by default one seeded with 0xBADB055
     
     Returns:
         modelState - a model state object configured for training
@@ -43,13 +56,14 @@ def sampleFromModel(D=200, T=100, K=10, Q=6, F=12, P=8, avgWordsPerDoc = 500):
         W          - The DxW word matrix
     '''
     
+    if rng is None:
+        rng = rd.default_rng(0xBADB055)
+    
     # Generate vocab
     beta = 0.1
     betaVec = np.ndarray((T,))
     betaVec.fill(beta)
-    vocab = np.zeros((K,T))
-    for k in range(K):
-        vocab[k,:] = rd.dirichlet(betaVec)
+    vocab = rng.dirichlet(betaVec, size=K)
     
     # Generate U, then V, then A
     tau = 0.1
@@ -59,31 +73,33 @@ def sampleFromModel(D=200, T=100, K=10, Q=6, F=12, P=8, avgWordsPerDoc = 500):
     (ySdRow, ySdCol) = (5.0, 5.0)
     (aSdRow, aSdCol) = (5.0, tau**2)
     
-    U = np.abs(matrix_normal(np.zeros((K,Q)),   uSdRow * np.eye(Q), uSdCol * np.eye(K)))
-    Y = np.abs(matrix_normal(np.zeros((Q,P)),   ySdRow * np.eye(P), ySdCol * np.eye(Q)))
-    V = np.abs(matrix_normal(np.zeros((F,P)),   vSdRow * np.eye(P), vSdCol * np.eye(F)))
-    A = np.abs(matrix_normal(U.dot(Y).dot(V.T), aSdRow * np.eye(F), aSdCol * np.eye(K)))
+    U = np.abs(_matrix_normal_iid(np.zeros((K,Q)),   uSdRow, uSdCol, rng))
+    Y = np.abs(_matrix_normal_iid(np.zeros((Q,P)),   ySdRow, ySdCol, rng))
+    V = np.abs(_matrix_normal_iid(np.zeros((F,P)),   vSdRow, vSdCol, rng))
+    A = np.abs(_matrix_normal_iid(U.dot(Y).dot(V.T), aSdRow, aSdCol, rng))
     
     # Generate the input features. Assume the features are multinomial and sparse
     # (not quite a perfect match for the twitter example: twitter is binary, this 
-    # may not be)
-    featuresDist  = [1. / P] * P
+    # may not be). With a uniform distribution over features each of the draws is
+    # just a random feature index, and the CSR constructor sums any repeats.
     maxNonZeroFeatures = 3
     
-    X_low = np.zeros((D,P), dtype=np.float32)
-    for d in range(D):
-        X_low[d,:] = rd.multinomial(maxNonZeroFeatures, featuresDist)
-    X = np.round(X_low.dot(V.T))
-    X = ssp.csr_matrix(X)
+    featureIds = rng.integers(P, size=D * maxNonZeroFeatures)
+    docIds     = np.repeat(np.arange(D), maxNonZeroFeatures)
+    X_low = ssp.csr_matrix((np.ones(D * maxNonZeroFeatures, dtype=np.float32), (docIds, featureIds)), shape=(D,P))
+    X = ssp.csr_matrix(np.round(X_low.dot(V.T)))
     
     # Use the features and the matrix A to generate the topics and documents
     tpcs = rowwise_softmax (X.dot(A.T))
     
-    docLens = rd.poisson(avgWordsPerDoc, (D,)).astype(np.float32)
-    W = tpcs.dot(vocab)
-    W *= docLens[:, np.newaxis]
-    W = np.array(W, dtype=np.int32) # truncate word counts to integers
-    W = ssp.csr_matrix(W)
+    docLens = rng.poisson(avgWordsPerDoc, (D,)).astype(np.float32)
+    wordDists = tpcs.dot(vocab)
+    wordDists /= wordDists.sum(axis=1)[:, np.newaxis]
+    counts = rng.multinomial(docLens.astype(np.int64), wordDists)
+    
+    # Build the sparse word matrix directly from the non-zero counts
+    rows, cols = counts.nonzero()
+    W = ssp.csr_matrix((counts[rows, cols].astype(np.int32), (rows, cols)), shape=(D,T))
     
     # Initialise the model
     modelState = newVbModelState(K, Q, F, P, T)
@@ -92,6 +108,39 @@ def sampleFromModel(D=200, T=100, K=10, Q=6, F=12, P=8, avgWordsPerDoc = 500):
     # generated observations
     return modelState, tpcs, vocab, docLens, X, W
 
+def _runFold(fold, X2, W2, dims, start, trainSize, querySize):
+    '''
+    Trains a model on one cross-validation fold and then queries it on the
+    held-out documents.
+    
+    Params:
+        fold      - the index of the fold, used to seed the model's initialisation
+        X2, W2    - the side information and word matrices, each stacked on top of
+                    a copy of itself so that every fold is a contiguous slice
+        dims      - the tuple (K, Q, F, P, T) of model dimensions
+        start     - the row at which this fold's training documents start
+        trainSize - the number of training documents
+        querySize - the number of query documents, which follow the training ones
+    
+    Returns:
+        the log-likelihoods of the training set and of the query set
+    '''
+    K, Q, F, P, T = dims
+    end = start + trainSize
+    
+    X_train, W_train = X2[start:end,:], W2[start:end,:]
+    X_query, W_query = X2[end:end + querySize,:], W2[end:end + querySize,:]
+    
+    rd.seed(0xBADB055 + fold) # The model is initialised from the global state
+    modelState = newVbModelState(K, Q, F, P, T)
+    modelState, queryState = train(modelState, X_train, W_train, iterations=100, logInterval=10, plotInterval=100)
+    trainSetLikely = log_likelihood(modelState, X_train, W_train, queryState)
+    
+    queryState = query(modelState, X_query, W_query, iterations=50, epsilon=0.001, logInterval = 10, plotInterval = 100)
+    querySetLikely = log_likelihood(modelState, X_query, W_query, queryState)
+    
+    return trainSetLikely, querySetLikely
+
 class StUyvTest(unittest.TestCase):
     '''
     Provides basic unit tests for the variational SideTopic inference engine using
@@ -109,8 +158,7 @@ class StUyvTest(unittest.TestCase):
     def testLikelihoodOnModelDerivedExample(self):
         print("Cross-validated likelihoods on model-derived example")
         
-        rd.seed(0xBADB055) # Global init for repeatable test
-        modelState, _, _, _, X, W = sampleFromModel()
+        modelState, _, _, _, X, W = sampleFromModel(rng=rd.default_rng(0xBADB055))
         D, T, K, Q, F, P = X.shape[0], modelState.T, modelState.K, modelState.Q, modelState.F, modelState.P
         
         # Create the cross-validation folds
@@ -119,23 +167,18 @@ class StUyvTest(unittest.TestCase):
         querySize = foldSize
         trainSize = D - querySize
         
-        for fold in range(folds):
-            start = fold * foldSize
-            end   = start + trainSize
-            
-            trainSet = np.arange(start,end) % D
-            querySet = np.arange(end, end + querySize) % D
-            
-            X_train, W_train = X[trainSet,:], W[trainSet,:]
-            X_query, W_query = X[querySet,:], W[querySet,:]
-            
-            modelState = newVbModelState(K, Q, F, P, T)
-            modelState, queryState = train(modelState, X_train, W_train, iterations=100, logInterval=10, plotInterval=100)
-            trainSetLikely = log_likelihood(modelState, X_train, W_train, queryState)
-            
-            queryState = query(modelState, X_query, W_query, iterations=50, epsilon=0.001, logInterval = 10, plotInterval = 100)
-            querySetLikely = log_likelihood(modelState, X_query, W_query, queryState)
-            
+        # The folds wrap around the end of the data, so stack two copies once and
+        # then take every fold's rows as contiguous slices
+        X2, W2 = ssp.vstack((X, X), format='csr'), ssp.vstack((W, W), format='csr')
+        
+        # The folds are independent, so train and query them in parallel. The
+        # workers are spawned, not forked, as this process has already run
+        # OpenMP kernels, and libgomp doesn't survive a fork
+        foldArgs = [(fold, X2, W2, (K, Q, F, P, T), fold * foldSize, trainSize, querySize) for fold in range(folds)]
+        with ProcessPoolExecutor(max_workers=folds, mp_context=mp.get_context('spawn')) as executor:
+            results = list(executor.map(_runFold, *zip(*foldArgs)))
+        
+        for fold, (trainSetLikely, querySetLikely) in enumerate(results):
             print("Fold %d: Train-set Likelihood: %12f \t Query-set Likelihood: %12f" % (fold, trainSetLikely, querySetLikely))
            
         print("End of Test")
@@ -144,8 +187,8 @@ class StUyvTest(unittest.TestCase):
     def _testInferenceOnModelDerivedData(self):
         print("Model derived example")
         
-        rd.seed(0xBADB055) # Global init for repeatable test
-        modelState, tpcs, _, _, X, W = self._sampleFromModel()
+        rd.seed(0xBADB055) # The model is still initialised from the global state
+        modelState, tpcs, _, _, X, W = sampleFromModel(rng=rd.default_rng(0xBADB055))
         D = X.shape[0]
         
         (trainedState, queryState) = train (modelState, X, W, logInterval=1, iterations=1)
@@ -168,7 +211,8 @@ class StUyvTest(unittest.TestCase):
 
     def _testInferenceFromHandcraftedExample(self):
         print ("Partially hand-crafted example")
-        rd.seed(0xC0FFEE) # Global init for repeatable test
+        rd.seed(0xC0FFEE) # The model is still initialised from the global state
+        rng = rd.default_rng(0xC0FFEE)
         
         T = 100 # Vocabulary size, the number of "terms". Must be a square number
         Q = 6   # Topics: This cannot be changed without changing the code that generates the vocabulary
@@ -180,9 +224,9 @@ class StUyvTest(unittest.TestCase):
         avgWordsPerDoc = 500
         
         # Determine what A, U, Y and V should be
-        U = rd.random((K,Q))
-        Y = rd.random((Q,P))
-        V = rd.random((F,P))
+        U = rng.random((K,Q))
+        Y = rng.random((Q,P))
+        V = rng.random((F,P))
         A = U.dot(Y).dot(V.T)
         
         # The vocabulary. Presented graphically there are two with horizontal bands
@@ -192,14 +236,14 @@ class StUyvTest(unittest.TestCase):
         
         # Create our (sparse) features X, then our topic proportions ("tpcs")
         # then our word counts W
-        X_low = np.array([1 if rd.random() < 0.3 else 0 for _ in range(D*P)]).reshape(D,P)
+        X_low = np.array([1 if rng.random() < 0.3 else 0 for _ in range(D*P)]).reshape(D,P)
         X     = ssp.csr_matrix(X_low.dot(V.T))
         
         lmda_low = X_low.dot(Y.T)
         print ("lmda_low.mean() = %f" % (lmda_low.mean()))
         tpcs = rowwise_softmax (lmda_low)
         
-        docLens = rd.poisson(avgWordsPerDoc, (D,))
+        docLens = rng.poisson(avgWordsPerDoc, (D,))
         W = tpcs.dot(vocab)
         W *= docLens[:, np.newaxis]
         W = np.array(W, dtype=np.int32) # truncate word counts to integers
@@ -229,7 +273,8 @@ class StUyvTest(unittest.TestCase):
 
     def _testInferenceFromHandcraftedExampleWithKEqualingQ(self):
         print ("Fully handcrafted example, K=Q")
-        rd.seed(0xC0FFEE) # Global init for repeatable test
+        rd.seed(0xC0FFEE) # The model is still initialised from the global state
+        rng = rd.default_rng(0xC0FFEE)
         
         T = 100 # Vocabulary size, the number of "terms". Must be a square number
         Q = 6   # Topics: This cannot be changed without changing the code that generates the vocabulary
@@ -249,19 +294,17 @@ class StUyvTest(unittest.TestCase):
         # then our word counts W
         lmda = np.zeros((D,K))
         X    = np.zeros((D,F))
-        for d in range(D):
-            for _ in range(3):
-                lmda[d,rd.randint(K)] += 1./3
-            for _ in range(int(F/3)):
-                X[d,rd.randint(F)] += 1
+        # np.add.at rather than fancy-indexed += so that repeated indices accumulate
+        np.add.at(lmda, (np.repeat(np.arange(D), 3), rng.integers(K, size=D*3)), 1./3)
+        np.add.at(X, (np.repeat(np.arange(D), F//3), rng.integers(F, size=D*(F//3))), 1)
         
-        A = rd.random((K,F))
+        A = rng.random((K,F))
         X = lmda.dot(la.pinv(A).T)
         X = ssp.csr_matrix(X)
         
         tpcs = lmda
         
-        docLens = rd.poisson(avgWordsPerDoc, (D,))
+        docLens = rng.poisson(avgWordsPerDoc, (D,))
         W = tpcs.dot(vocab)
         W *= docLens[:, np.newaxis]
         W = np.array(W, dtype=np.int32) # truncate word counts to integers
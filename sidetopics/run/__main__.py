@@ -12,7 +12,7 @@ import sys
 import time
 import traceback
 
-from sidetopics.model.common import DataSet
+from sidetopics.model.common import DataSet, load_matrix
 from sidetopics.model.evals import perplexity_from_like, mean_average_prec, \
     mean_reciprocal_rank, mean_prec_rec_at, \
     EvalNames, Perplexity, MeanAveragePrecAllDocs,  \
@@ -78,6 +78,19 @@ def run(args):
 
     Returns the list of files created.
     '''
+    paths = parse_args(args)
+    words = load_matrix(paths.words)
+    feats = None if paths.feats is None else load_matrix(paths.feats)
+    links = None if paths.links is None else load_matrix(paths.links)
+
+    return run_with_data(args, words, feats, links)
+
+
+def parse_args(args):
+    '''
+    Parses the command-line arguments (excluding the application name portion)
+    and returns the resulting namespace.
+    '''
 
     #
     # Enumerate all possible arguments
@@ -146,13 +159,27 @@ def run(args):
                          "in the dictionary, and what proportion of them should be (randomly), moved out of the query set and into " + \
                          "the validation set, when performing a tag-based precision-at-m evaluation")
 
+    return parser.parse_args(args)
+
+
+def run_with_data(args, words, feats=None, links=None):
+    '''
+    Executes a cross-validation run, as run() does, on the given word-count,
+    feature and link matrices rather than on those named in the command-line
+    arguments, which are otherwise parsed as by run(). Returns the list of
+    files created.
+
+    The given matrices are not altered, so they can be loaded once and then
+    shared across many runs, e.g. a sweep over hyperparameters.
+    '''
+    #
     # Initialization of the app: first parse the arguments
     #
     print("Random seed is 0xC0FFEE")
     rd.seed(0xC0FFEE)
 
     print("Args are : " + str(args))
-    args = parser.parse_args(args)
+    args = parse_args(args)
     K, P, Q = args.K, args.P, args.Q
 
     features_mask = parse_features_mask(args)
@@ -163,7 +190,7 @@ def run(args):
     #
     #  Load and prune the data
     #
-    data = DataSet.from_files(args.words, args.feats, args.links, limit=args.limit)
+    data = DataSet(words, feats, links, limit=args.limit)
     data.convert_to_dtype(input_dtype)
     data.prune_and_shuffle(min_doc_len=MinDocLen, min_link_count=MinLinkCountPrune)
 
@@ -5,15 +5,20 @@ Created on 27 Nov 2013
 '''
 import unittest
 import pickle as pkl
+import scipy.sparse as ssp
 import tempfile as tmp
 import cProfile
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing as mp
+import os
 
 from model_test.stm_yv_test import sampleFromModel
-from run.main import run, ModelNames, \
+from run.main import run_with_data, ModelNames, \
     Rtm, LdaGibbs, LdaVb, Mtm, Mtm2, StmYvBohning, StmYvBouchard, \
     CtmBohning, CtmBouchard, Dmr, StmYvBohningFakeOnline, Lro, \
     SimLda, SimTfIdf, LdaSvb, StmUyvBohning, MomEm, MomGibbs, LdaCvb, LdaCvbZero
 
+from model.common import load_matrix
 from model.evals import Perplexity, MeanAveragePrecAllDocs, \
     MeanPrecRecAtMAllDocs, HashtagPrecAtM, TagPrecAtM, \
     LroMeanPrecRecAtMAllDocs, LroMeanPrecRecAtMFeatSplit
@@ -140,7 +145,52 @@ def tmpFiles():
     details, and the file containing a plot of the variational bounds.
     '''
     tmpDir = tmp.gettempdir()
-    return tmpDir + '/words.pkl', tmpDir + '/feats.pkl', tmpDir
+    return tmpDir + '/words.npz', tmpDir + '/feats.npz', tmpDir
+
+_SharedData = None
+
+def _shareData(words, feats, links):
+    '''
+    Stores the given matrices in this process, so that each run executed in
+    it can use them without their being sent over again, or reloaded.
+    '''
+    global _SharedData
+    _SharedData = (words, feats, links)
+
+def _runWithSharedData(cmdline):
+    '''
+    Executes a run with the given command-line on the matrices stored by
+    _shareData(), returning the list of files created.
+    '''
+    return run_with_data(cmdline, *_SharedData)
+
+def _runInParallel(cmdlines, words, feats, links):
+    '''
+    Executes a run for each of the given command-lines on the given matrices
+    in a pool of worker processes, returning the list of lists of files
+    created.
+
+    The workers are spawned, not forked, as this process may already have
+    run OpenMP kernels (e.g. in sampleFromModel), and libgomp doesn't
+    survive a fork. The cores are divided between the workers, rather
+    than each starting an OpenMP team as large as the machine. As libgomp
+    reads OMP_NUM_THREADS when it's loaded, this is set in the environment
+    the workers inherit.
+    '''
+    cpuCount = os.cpu_count() or 1
+    workers  = max(1, min(len(cmdlines), cpuCount))
+
+    oldThreads = os.environ.get('OMP_NUM_THREADS')
+    os.environ['OMP_NUM_THREADS'] = str(max(1, cpuCount // workers))
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context('spawn'), \
+                                 initializer=_shareData, initargs=(words, feats, links)) as pool:
+            return list(pool.map(_runWithSharedData, cmdlines))
+    finally:
+        if oldThreads is None:
+            del os.environ['OMP_NUM_THREADS']
+        else:
+            os.environ['OMP_NUM_THREADS'] = oldThreads
 
 class Test(unittest.TestCase):
 
@@ -158,10 +208,8 @@ class Test(unittest.TestCase):
         tpcs, vocab, docLens, X, W = sampleFromModel(D, T, K, F, P, avgWordsPerDoc)
         
         wordsFile, featsFile, modelFileDir = tmpFiles()
-        with open(wordsFile, 'wb') as f:
-            pkl.dump(W, f)
-        with open(featsFile, 'wb') as f:
-            pkl.dump(X, f)
+        ssp.save_npz(wordsFile, W.tocsr())
+        ssp.save_npz(featsFile, X.tocsr())
         
         print ("New Version")
 
@@ -181,6 +229,7 @@ class Test(unittest.TestCase):
 
         modelFileses = []
         for DataSetName in [TweetsFreq]:
+            cmdlines = []
             for k in [K]: # [10, 25, 50, 100]:
                 for p in [P]: #, [50, 100, 250, 500]:
                     #for (BatchSize, RetardationRate, ForgettingRate) in sgd_setups:
@@ -188,7 +237,7 @@ class Test(unittest.TestCase):
                         cmdline = '' \
                                 +(' --debug '          + str(Debug) if Debug else "") \
                                 + ' --model '          + modelName \
-                                + ' --dtype '          + 'f8'      \
+                                + ' --dtype '          + 'f4'      \
                                 + ' --num-topics '     + str(k)    \
                                 + ' --num-lat-feats '  + str(p) \
                                 + ' --num-lat-topics ' + str(Q) \
@@ -202,9 +251,6 @@ class Test(unittest.TestCase):
                                 + ' --folds '          + str(Folds)      \
                                 + ' --truncate-folds ' + str(ExecutedFoldCount)      \
                                 + (' --word-dict '     + DictsPath[DataSetName] if DictsPath[DataSetName] is not None else "") \
-                                + ' --words '          + WordsPath[DataSetName] \
-                                + (' --feats '         + FeatsPath[DataSetName] if FeatsPath[DataSetName] is not None else "") \
-                                + (' --links '         + CitesPath[DataSetName] if CitesPath[DataSetName] is not None else "") \
                                 + ' --topic-var '      + str(PriorCov) \
                                 + ' --feat-var '       + str(PriorCov) \
                                 + ' --lat-topic-var '  + str(PriorCov) \
@@ -222,11 +268,19 @@ class Test(unittest.TestCase):
             #                    + ' --feats '          + featsFile
             #                    + ' --words '          + '/Users/bryanfeeney/Desktop/Tweets600/words-by-author.pkl' \
 
-                        modelFileses.extend (run(cmdline.strip().split(' ')))
+                        cmdlines.append(cmdline.strip().split(' '))
+
+            # Load the data once, and share it with every run in the sweep,
+            # each of which is independent of the others.
+            words = load_matrix(WordsPath[DataSetName])
+            feats = None if FeatsPath[DataSetName] is None else load_matrix(FeatsPath[DataSetName])
+            links = None if CitesPath[DataSetName] is None else load_matrix(CitesPath[DataSetName])
+            for modelFiles in _runInParallel(cmdlines, words, feats, links):
+                modelFileses.extend(modelFiles)
 
-                    modelFileses.insert(0, wordsFile)
-                    modelFileses.insert(1, featsFile)
-                    print ("Files can be found in:" + "\n\t".join(modelFileses))
+        modelFileses.insert(0, wordsFile)
+        modelFileses.insert(1, featsFile)
+        print ("Files can be found in:" + "\n\t".join(modelFileses))
         
     
     def _testLoadResult(self):
@@ -58,27 +58,21 @@ def safe_log_det(X):
     
     return d
 
-# TODO This works, but how and why does it work?
-def safe_log_one_plus_exp_of (x):
+def safe_log_one_plus_exp_of (x, out=None):
     '''
     Avoids overflow and underflow when calculating log(1+exp(x)).
-    Taken from Guillaume Bouchard's CTM code
-    '''
-    LOWER = -17
-    UPPER =  33
-    
-    out = np.ndarray(x.shape)
-    out[x <= LOWER] = np.exp(x[x <= LOWER])
-    
-    selection      = np.all([x > LOWER, x <= 0], axis=0)
-    out[selection] = np.log (1 + np.exp(x[selection]))
     
-    selection      = np.all([x > 0, x <= UPPER], axis=0)
-    out[selection] = x[selection] + np.log (1 + np.exp(-x[selection]))
-        
-    out[x > UPPER] = x[x > UPPER]
+    This used to follow Guillaume Bouchard's CTM code, which evaluated
+    the function separately over four ranges of x. np.logaddexp(0, x)
+    is the same function, evaluated stably over the whole range in a
+    single pass, without the range masks and the copies they entail.
     
-    return out
+    If out is given, the result is written into it. Otherwise a new
+    double-precision array is returned.
+    '''
+    if out is None:
+        out = np.ndarray(x.shape)
+    return np.logaddexp(0, x, out=out)
     
     
 
@@ -10,6 +10,13 @@ cimport numpy as np
 from libc.math cimport log, exp
 from libc.float cimport FLT_MIN, DBL_MIN
 
+from cython.parallel cimport prange
+
+# The rows of a sparse document-term matrix vary in length with the documents,
+# and its columns with the Zipfian word frequencies, so loops over either use
+# guided rather than static scheduling, lest one thread be handed all the long
+# documents or all the frequent words.
+
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
@@ -269,25 +276,16 @@ def sparseScalarQuotientOfDot_f8(double[:] A_data, int[:] A_indices, int[:] A_pt
     out_data, though note that this is the same parameter passed in and overwritten.
     '''
     cdef:
-        int A_row = 0
-        int B_row = 0
+        int row = 0
         int col = 0
-        int elemCount =0
-        int e = 0
         int i = 0
+        int offset = A_ptr[start]
 
     with nogil:
-        while A_row < end:
-            elemCount = A_ptr[A_row+1] - A_ptr[A_row]
-            e = 0
-            if A_row >= start:
-                while e < elemCount:
-                    col = A_indices[i]
-                    out_data[i] = A_data[i] / dotProduct_f8(B_row,col,B,C)
-                    i += 1
-                    e += 1
-                B_row += 1
-            A_row += 1
+        for row in prange(start, end, schedule='guided'):
+            for i in range(A_ptr[row], A_ptr[row+1]):
+                col = A_indices[i]
+                out_data[i - offset] = A_data[i] / dotProduct_f8(row - start,col,B,C)
     
     return out_data
 
@@ -316,25 +314,337 @@ def sparseScalarQuotientOfDot_f4(float[:] A_data, int[:] A_indices, int[:] A_ptr
     out_data, though note that this is the same parameter passed in and overwritten.
     '''
     cdef:
-        int A_row = 0
-        int B_row = 0
+        int row = 0
         int col = 0
-        int elemCount =0
-        int e = 0
         int i = 0
+        int offset = A_ptr[start]
 
     with nogil:
-        while A_row < end:
-            elemCount = A_ptr[A_row+1] - A_ptr[A_row]
-            e = 0
-            if A_row >= start:
-                while e < elemCount:
-                    col = A_indices[i]
-                    out_data[i] = A_data[i] / dotProduct_f4(B_row,col,B,C)
-                    i += 1
-                    e += 1
-                B_row += 1
-            A_row += 1
+        for row in prange(start, end, schedule='guided'):
+            for i in range(A_ptr[row], A_ptr[row+1]):
+                col = A_indices[i]
+                out_data[i - offset] = A_data[i] / dotProduct_f4(row - start,col,B,C)
+    
+    return out_data
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def sparseScalarQuotientOfDotWithProducts_f8(double[:] A_data, int[:] A_indices, int[:] A_ptr, double[:,:] B, double[:,:] C, double[:] out_data, double[:,:] scaledB, double[:,:] RtB, int[:] AT_ptr, int[:] AT_rows, int[:] AT_pos, double[:] lnDotSum):
+    '''
+    Sets R = A / np.dot(B, C), calculating values only where A is non-zero,
+    and in the same pass over A accumulates
+    
+    scaledB = B * R.dot(C.T)
+    RtB     = R.T.dot(B).T
+    
+    Either of the two dense outputs may be None, in which case it is skipped.
+    If the three AT_* buffers are given, RtB is accumulated a column at a
+    time, which avoids contention between threads. If in addition scaledB
+    is None, R is also calculated a column at a time.
+     
+    Params
+    A_data    - the values buffer of the sparse CSR matrix A
+    A_indices - the indices buffer of the sparse CSR matrix A
+    A_ptr     - the index pointer buffer of the sparse CSR matrix A
+    B         - a dense matrix
+    C         - a dense matrix
+    out_data  - the values buffer into which R will be placed.
+    scaledB   - a dense matrix shaped like B which is overwritten, or None
+    RtB       - a dense matrix shaped like C which is overwritten, or None
+    AT_ptr    - the index pointer buffer of A in CSC form, or None
+    AT_rows   - the row indices of A in CSC form, or None
+    AT_pos    - the position of each of the CSC non-zeros of A in A_data,
+                or None
+    lnDotSum  - a one-element vector into which the sum of
+                A * np.log(np.dot(B, C)) is written, or None. As with
+                sparseScalarProductOfSafeLnDot() zero-valued dot-products
+                are replaced with the minimum non-zero value.
+    
+    Returns
+    out_data, though note that this is the same parameter passed in and overwritten.
+    '''
+    cdef:
+        int rowCount = A_ptr.shape[0] - 1
+        int innerDim = B.shape[1]
+        int row = 0
+        int col = 0
+        int i = 0
+        int k = 0
+        int j = 0
+        int colCount = C.shape[1]
+        double quot = 0.0
+        double dot  = 0.0
+        double lnTotal  = 0.0
+        double logOfMin = log(DBL_MIN)
+        bint doScaledB = scaledB is not None
+        bint doRtB     = RtB is not None
+        bint byColumn  = AT_ptr is not None
+        bint doLnDot   = lnDotSum is not None
+    
+    if doScaledB:
+        scaledB[:,:] = 0
+    if doRtB:
+        RtB[:,:] = 0
+
+    with nogil:
+        if byColumn and not doScaledB:
+            # With no row-wise output, R and RtB are both calculated a column
+            # at a time, so each column of C is read once for all the rows
+            # of A which use it
+            for col in prange(colCount, schedule='guided'):
+                for j in range(AT_ptr[col], AT_ptr[col+1]):
+                    row  = AT_rows[j]
+                    i    = AT_pos[j]
+                    dot  = dotProduct_f8(row,col,B,C)
+                    quot = A_data[i] / dot
+                    out_data[i] = quot
+                    if doLnDot:
+                        lnTotal += A_data[i] * (log(dot) if dot > DBL_MIN else logOfMin)
+                    
+                    if doRtB:
+                        for k in range(innerDim):
+                            RtB[k,col] += B[row,k] * quot
+        else:
+            # Every row of R and scaledB depends only on the matching row of A
+            # and B, so rows are processed in parallel
+            for row in prange(rowCount, schedule='guided'):
+                for i in range(A_ptr[row], A_ptr[row+1]):
+                    col  = A_indices[i]
+                    dot  = dotProduct_f8(row,col,B,C)
+                    quot = A_data[i] / dot
+                    out_data[i] = quot
+                    if doLnDot:
+                        lnTotal += A_data[i] * (log(dot) if dot > DBL_MIN else logOfMin)
+                
+                    if doScaledB:
+                        for k in range(innerDim):
+                            scaledB[row,k] += B[row,k] * C[k,col] * quot
+        
+            # Columns of RtB are shared across rows of A, so either each thread
+            # accumulates whole columns of RtB using the CSC form of A or, failing
+            # that, its own contiguous block of the rows of RtB. Either way this
+            # is done from the stored quotients.
+            if doRtB and byColumn:
+                for col in prange(colCount, schedule='guided'):
+                    for j in range(AT_ptr[col], AT_ptr[col+1]):
+                        row  = AT_rows[j]
+                        quot = out_data[AT_pos[j]]
+                        for k in range(innerDim):
+                            RtB[k,col] += B[row,k] * quot
+            elif doRtB:
+                for k in prange(innerDim, schedule='static'):
+                    for row in range(rowCount):
+                        for i in range(A_ptr[row], A_ptr[row+1]):
+                            RtB[k,A_indices[i]] += B[row,k] * out_data[i]
+    
+    if doLnDot:
+        lnDotSum[0] = lnTotal
+    
+    return out_data
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def sparseScalarQuotientOfDotWithProducts_f8_f4(double[:] A_data, int[:] A_indices, int[:] A_ptr, double[:,:] B, float[:,:] C, double[:] out_data, double[:,:] scaledB, double[:,:] RtB, int[:] AT_ptr, int[:] AT_rows, int[:] AT_pos, double[:] lnDotSum):
+    '''
+    As sparseScalarQuotientOfDotWithProducts_f8, except that C is held in
+    single precision, halving the memory traffic of reading it. All
+    arithmetic and all outputs are in double precision.
+    '''
+    cdef:
+        int rowCount = A_ptr.shape[0] - 1
+        int innerDim = B.shape[1]
+        int row = 0
+        int col = 0
+        int i = 0
+        int k = 0
+        int j = 0
+        int colCount = C.shape[1]
+        double quot = 0.0
+        double dot  = 0.0
+        double lnTotal  = 0.0
+        double logOfMin = log(DBL_MIN)
+        bint doScaledB = scaledB is not None
+        bint doRtB     = RtB is not None
+        bint byColumn  = AT_ptr is not None
+        bint doLnDot   = lnDotSum is not None
+    
+    if doScaledB:
+        scaledB[:,:] = 0
+    if doRtB:
+        RtB[:,:] = 0
+
+    with nogil:
+        if byColumn and not doScaledB:
+            # With no row-wise output, R and RtB are both calculated a column
+            # at a time, so each column of C is read once for all the rows
+            # of A which use it
+            for col in prange(colCount, schedule='guided'):
+                for j in range(AT_ptr[col], AT_ptr[col+1]):
+                    row  = AT_rows[j]
+                    i    = AT_pos[j]
+                    dot  = dotProduct_f8_f4(row,col,B,C)
+                    quot = A_data[i] / dot
+                    out_data[i] = quot
+                    if doLnDot:
+                        lnTotal += A_data[i] * (log(dot) if dot > DBL_MIN else logOfMin)
+                    
+                    if doRtB:
+                        for k in range(innerDim):
+                            RtB[k,col] += B[row,k] * quot
+        else:
+            # Every row of R and scaledB depends only on the matching row of A
+            # and B, so rows are processed in parallel
+            for row in prange(rowCount, schedule='guided'):
+                for i in range(A_ptr[row], A_ptr[row+1]):
+                    col  = A_indices[i]
+                    dot  = dotProduct_f8_f4(row,col,B,C)
+                    quot = A_data[i] / dot
+                    out_data[i] = quot
+                    if doLnDot:
+                        lnTotal += A_data[i] * (log(dot) if dot > DBL_MIN else logOfMin)
+                
+                    if doScaledB:
+                        for k in range(innerDim):
+                            scaledB[row,k] += B[row,k] * C[k,col] * quot
+        
+            # Columns of RtB are shared across rows of A, so either each thread
+            # accumulates whole columns of RtB using the CSC form of A or, failing
+            # that, its own contiguous block of the rows of RtB. Either way this
+            # is done from the stored quotients.
+            if doRtB and byColumn:
+                for col in prange(colCount, schedule='guided'):
+                    for j in range(AT_ptr[col], AT_ptr[col+1]):
+                        row  = AT_rows[j]
+                        quot = out_data[AT_pos[j]]
+                        for k in range(innerDim):
+                            RtB[k,col] += B[row,k] * quot
+            elif doRtB:
+                for k in prange(innerDim, schedule='static'):
+                    for row in range(rowCount):
+                        for i in range(A_ptr[row], A_ptr[row+1]):
+                            RtB[k,A_indices[i]] += B[row,k] * out_data[i]
+    
+    if doLnDot:
+        lnDotSum[0] = lnTotal
+    
+    return out_data
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def sparseScalarQuotientOfDotWithProducts_f4(float[:] A_data, int[:] A_indices, int[:] A_ptr, float[:,:] B, float[:,:] C, float[:] out_data, float[:,:] scaledB, float[:,:] RtB, int[:] AT_ptr, int[:] AT_rows, int[:] AT_pos, double[:] lnDotSum):
+    '''
+    Sets R = A / np.dot(B, C), calculating values only where A is non-zero,
+    and in the same pass over A accumulates
+    
+    scaledB = B * R.dot(C.T)
+    RtB     = R.T.dot(B).T
+    
+    Either of the two dense outputs may be None, in which case it is skipped.
+    If the three AT_* buffers are given, RtB is accumulated a column at a
+    time, which avoids contention between threads. If in addition scaledB
+    is None, R is also calculated a column at a time.
+     
+    Params
+    A_data    - the values buffer of the sparse CSR matrix A
+    A_indices - the indices buffer of the sparse CSR matrix A
+    A_ptr     - the index pointer buffer of the sparse CSR matrix A
+    B         - a dense matrix
+    C         - a dense matrix
+    out_data  - the values buffer into which R will be placed.
+    scaledB   - a dense matrix shaped like B which is overwritten, or None
+    RtB       - a dense matrix shaped like C which is overwritten, or None
+    AT_ptr    - the index pointer buffer of A in CSC form, or None
+    AT_rows   - the row indices of A in CSC form, or None
+    AT_pos    - the position of each of the CSC non-zeros of A in A_data,
+                or None
+    lnDotSum  - a one-element vector into which the sum of
+                A * np.log(np.dot(B, C)) is written, or None. As with
+                sparseScalarProductOfSafeLnDot() zero-valued dot-products
+                are replaced with the minimum non-zero value.
+    
+    Returns
+    out_data, though note that this is the same parameter passed in and overwritten.
+    '''
+    cdef:
+        int rowCount = A_ptr.shape[0] - 1
+        int innerDim = B.shape[1]
+        int row = 0
+        int col = 0
+        int i = 0
+        int k = 0
+        int j = 0
+        int colCount = C.shape[1]
+        float quot = 0.0
+        float dot  = 0.0
+        double lnTotal  = 0.0
+        double logOfMin = log(FLT_MIN)
+        bint doScaledB = scaledB is not None
+        bint doRtB     = RtB is not None
+        bint byColumn  = AT_ptr is not None
+        bint doLnDot   = lnDotSum is not None
+    
+    if doScaledB:
+        scaledB[:,:] = 0
+    if doRtB:
+        RtB[:,:] = 0
+
+    with nogil:
+        if byColumn and not doScaledB:
+            # With no row-wise output, R and RtB are both calculated a column
+            # at a time, so each column of C is read once for all the rows
+            # of A which use it
+            for col in prange(colCount, schedule='guided'):
+                for j in range(AT_ptr[col], AT_ptr[col+1]):
+                    row  = AT_rows[j]
+                    i    = AT_pos[j]
+                    dot  = dotProduct_f4(row,col,B,C)
+                    quot = A_data[i] / dot
+                    out_data[i] = quot
+                    if doLnDot:
+                        lnTotal += A_data[i] * (log(dot) if dot > FLT_MIN else logOfMin)
+                    
+                    if doRtB:
+                        for k in range(innerDim):
+                            RtB[k,col] += B[row,k] * quot
+        else:
+            # Every row of R and scaledB depends only on the matching row of A
+            # and B, so rows are processed in parallel
+            for row in prange(rowCount, schedule='guided'):
+                for i in range(A_ptr[row], A_ptr[row+1]):
+                    col  = A_indices[i]
+                    dot  = dotProduct_f4(row,col,B,C)
+                    quot = A_data[i] / dot
+                    out_data[i] = quot
+                    if doLnDot:
+                        lnTotal += A_data[i] * (log(dot) if dot > FLT_MIN else logOfMin)
+                
+                    if doScaledB:
+                        for k in range(innerDim):
+                            scaledB[row,k] += B[row,k] * C[k,col] * quot
+        
+            # Columns of RtB are shared across rows of A, so either each thread
+            # accumulates whole columns of RtB using the CSC form of A or, failing
+            # that, its own contiguous block of the rows of RtB. Either way this
+            # is done from the stored quotients.
+            if doRtB and byColumn:
+                for col in prange(colCount, schedule='guided'):
+                    for j in range(AT_ptr[col], AT_ptr[col+1]):
+                        row  = AT_rows[j]
+                        quot = out_data[AT_pos[j]]
+                        for k in range(innerDim):
+                            RtB[k,col] += B[row,k] * quot
+            elif doRtB:
+                for k in prange(innerDim, schedule='static'):
+                    for row in range(rowCount):
+                        for i in range(A_ptr[row], A_ptr[row+1]):
+                            RtB[k,A_indices[i]] += B[row,k] * out_data[i]
+    
+    if doLnDot:
+        lnDotSum[0] = lnTotal
     
     return out_data
 
@@ -480,6 +790,74 @@ def sparseScalarProductOfDot_f4(float[:] A_data, int[:] A_indices, int[:] A_ptr,
     
     return out_data
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def sparseDenseProduct_f8(double[:] A_data, int[:] A_indices, int[:] A_ptr, double[:,:] B, double[:,:] out):
+    '''
+    Returns A.dot(B) where A is sparse and B is dense, writing the result
+    into the dense matrix out. Rows of A are processed in parallel.
+     
+    Params
+    A_data    - the values buffer of the sparse CSR matrix A
+    A_indices - the indices buffer of the sparse CSR matrix A
+    A_ptr     - the index pointer buffer of the sparse CSR matrix A
+    B         - a dense row-major matrix
+    out       - the dense row-major matrix into which the result will be placed.
+    
+    Returns
+    out, though note that this is the same parameter passed in and overwitten.
+    '''
+    cdef int rowCount = len(A_ptr) - 1
+    cdef int innerDim = B.shape[1]
+    cdef int row, i, k, col
+    cdef double a
+    with nogil:
+        for row in prange(rowCount, schedule='guided'):
+            for k in range(innerDim):
+                out[row,k] = 0
+            for i in range(A_ptr[row], A_ptr[row+1]):
+                a   = A_data[i]
+                col = A_indices[i]
+                for k in range(innerDim):
+                    out[row,k] += a * B[col,k]
+    
+    return out
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def sparseDenseProduct_f4(float[:] A_data, int[:] A_indices, int[:] A_ptr, float[:,:] B, float[:,:] out):
+    '''
+    Returns A.dot(B) where A is sparse and B is dense, writing the result
+    into the dense matrix out. Rows of A are processed in parallel.
+     
+    Params
+    A_data    - the values buffer of the sparse CSR matrix A
+    A_indices - the indices buffer of the sparse CSR matrix A
+    A_ptr     - the index pointer buffer of the sparse CSR matrix A
+    B         - a dense row-major matrix
+    out       - the dense row-major matrix into which the result will be placed.
+    
+    Returns
+    out, though note that this is the same parameter passed in and overwitten.
+    '''
+    cdef int rowCount = len(A_ptr) - 1
+    cdef int innerDim = B.shape[1]
+    cdef int row, i, k, col
+    cdef float a
+    with nogil:
+        for row in prange(rowCount, schedule='guided'):
+            for k in range(innerDim):
+                out[row,k] = 0
+            for i in range(A_ptr[row], A_ptr[row+1]):
+                a   = A_data[i]
+                col = A_indices[i]
+                for k in range(innerDim):
+                    out[row,k] += a * B[col,k]
+    
+    return out
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
@@ -504,28 +882,19 @@ def sparseScalarProductOfSafeLnDot_f8(double[:] A_data, int[:] A_indices, int[:]
     out_data, though note that this is the same parameter passed in and overwritten.
     '''
     cdef:
-        int A_row = 0
-        int B_row = 0
+        int row = 0
         int col = 0
-        int elemCount =0
-        int e = 0
         int i = 0
+        int offset = A_ptr[start]
         double dotProd = 0.0
         double logOfMin = log (DBL_MIN)
-    
+
     with nogil:
-        while A_row < end:
-            elemCount = A_ptr[A_row+1] - A_ptr[A_row]
-            e = 0
-            if A_row >= start:
-                while e < elemCount:
-                    col         = A_indices[i]
-                    dotProd     = dotProduct_f8(B_row,col,B,C)
-                    out_data[i] = A_data[i] * (log(dotProd) if dotProd > DBL_MIN else logOfMin)
-                    i += 1
-                    e += 1
-                B_row += 1
-            A_row += 1
+        for row in prange(start, end, schedule='guided'):
+            for i in range(A_ptr[row], A_ptr[row+1]):
+                col     = A_indices[i]
+                dotProd = dotProduct_f8(row - start,col,B,C)
+                out_data[i - offset] = A_data[i] * (log(dotProd) if dotProd > DBL_MIN else logOfMin)
     
     return out_data
 
@@ -579,28 +948,19 @@ def sparseScalarProductOfSafeLnDot_f4(float[:] A_data, int[:] A_indices, int[:]
     out_data, though note that this is the same parameter passed in and overwritten.
     '''
     cdef:
-        int A_row = 0
-        int B_row = 0
+        int row = 0
         int col = 0
-        int elemCount =0
-        int e = 0
         int i = 0
+        int offset = A_ptr[start]
         float dotProd = 0.0
         float logOfMin = log (FLT_MIN)
 
     with nogil:
-        while A_row < end:
-            elemCount = A_ptr[A_row+1] - A_ptr[A_row]
-            e = 0
-            if A_row >= start:
-                while e < elemCount:
-                    col         = A_indices[i]
-                    dotProd     = dotProduct_f4(B_row,col,B,C)
-                    out_data[i] = A_data[i] * (log(dotProd) if dotProd > FLT_MIN else logOfMin)
-                    i += 1
-                    e += 1
-                B_row += 1
-            A_row += 1
+        for row in prange(start, end, schedule='guided'):
+            for i in range(A_ptr[row], A_ptr[row+1]):
+                col     = A_indices[i]
+                dotProd = dotProduct_f4(row - start,col,B,C)
+                out_data[i - offset] = A_data[i] * (log(dotProd) if dotProd > FLT_MIN else logOfMin)
     
     return out_data
 
@@ -625,6 +985,25 @@ cdef double dotProduct_f8 (int r, int c, double[:,:] B, double[:,:] C) nogil:
     return result
 
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef double dotProduct_f8_f4 (int r, int c, double[:,:] B, float[:,:] C) nogil:
+    '''
+    As dotProduct_f8, with C held in single precision. The sum is
+    accumulated in double precision.
+    '''
+    cdef double result = 0
+    cdef int innerDim = B.shape[1]
+    
+    cdef int i = 0
+    while i < innerDim:
+        result += B[r,i] * C[i,c]
+        i += 1
+    
+    return result
+
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
@@ -9,6 +9,7 @@ import numpy as np
 cimport numpy as np
 from libc.math cimport log, exp
 from libc.float cimport FLT_MIN, DBL_MIN
+from cython.parallel cimport prange
 
 
 @cython.boundscheck(False)
@@ -223,3 +224,72 @@ def selfSoftDot_f4_f4(float[:,:] mat, float[:] scale):
     
     return total
 
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def rowwise_softmax_f8(double[:,:] mat, double[:,:] out):
+    '''
+    Writes the soft-max of each row of the given matrix into the corresponding
+    row of out, subtracting the row's maximum first so that it never
+    overflows. Each row is done in three passes over just that row (max,
+    exponentiate and sum, then normalize), with rows processed in parallel.
+    out may be the same matrix as mat.
+    '''
+    cdef:
+        double expSum = 0.0
+        double max    = 0.0
+        int rows = mat.shape[0]
+        int cols = mat.shape[1]
+        int row = 0
+        int col = 0
+    
+    with nogil:
+        for row in prange(rows):
+            max = mat[row,0]
+            for col in range(1, cols):
+                if mat[row,col] > max:
+                    max = mat[row,col]
+            
+            expSum = 0.0
+            for col in range(cols):
+                out[row,col] = exp(mat[row,col] - max)
+                expSum = expSum + out[row,col]
+            
+            for col in range(cols):
+                out[row,col] = out[row,col] / expSum
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def rowwise_softmax_f4(float[:,:] mat, float[:,:] out):
+    '''
+    Writes the soft-max of each row of the given matrix into the corresponding
+    row of out, subtracting the row's maximum first so that it never
+    overflows. Each row is done in three passes over just that row (max,
+    exponentiate and sum, then normalize), with rows processed in parallel.
+    out may be the same matrix as mat.
+    '''
+    cdef:
+        float expSum = 0.0
+        float max    = 0.0
+        int rows = mat.shape[0]
+        int cols = mat.shape[1]
+        int row = 0
+        int col = 0
+    
+    with nogil:
+        for row in prange(rows):
+            max = mat[row,0]
+            for col in range(1, cols):
+                if mat[row,col] > max:
+                    max = mat[row,col]
+            
+            expSum = 0.0
+            for col in range(cols):
+                out[row,col] = exp(mat[row,col] - max)
+                expSum = expSum + out[row,col]
+            
+            for col in range(cols):
+                out[row,col] = out[row,col] / expSum
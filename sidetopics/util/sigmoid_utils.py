@@ -6,6 +6,7 @@ Created on 1 Dec 2013
 
 import os
 import numpy as np
+import scipy.special as fns
 import sidetopics.util.sig_fast as compiled
 import sys
 
@@ -20,6 +21,14 @@ def rowwise_softmax (matrix, out=None):
     if out is None:
         out = np.ndarray(shape=matrix.shape, dtype=matrix.dtype)
     
+    if matrix.dtype == out.dtype and matrix.ndim == 2 and matrix.shape[1] > 0 and matrix.flags.writeable:
+        if matrix.dtype == np.float64:
+            compiled.rowwise_softmax_f8(matrix, out)
+            return out
+        elif matrix.dtype == np.float32:
+            compiled.rowwise_softmax_f4(matrix, out)
+            return out
+    
     row_maxes = matrix.max(axis=1) # Underflow makes sense i.e. Pr(K=k) = 0. Overflow doesn't, i.e Pr(K=k) = \infty
     np.exp(matrix - row_maxes[:, np.newaxis], out=out)
     out /= out.sum(axis=1)[:,np.newaxis]
@@ -48,10 +57,10 @@ def lse(matrix):
     
     The result is a vector of log-sum-exp values. 
     
-    Note that unlike rowwise_softmax, this DOES NOT uses any scaling
-    tricks to avoid overflow.
+    Like rowwise_softmax, this subtracts the row maximum before exponentiating,
+    so it never overflows.
     '''
-    return np.log(np.sum(np.exp(matrix), axis=1))
+    return fns.logsumexp(matrix, axis=1)
 
 def selfSoftDot(matrix):
     '''
@@ -7,6 +7,7 @@ import os
 
 import numpy as np
 import scipy.sparse as ssp
+import scipy.special as fns
 import sidetopics.util.se_fast as compiled
 from math import log
 import sys
@@ -41,10 +42,11 @@ def lse(matrix):
     
     log(sum exp(X[d,:]) for d in range(X.shape[0]))
     
-    albeit a bit more efficiently than that code would suggest.
+    albeit a bit more efficiently than that code would suggest, and with the
+    row maximum subtracted first so that it never overflows.
     '''
     assert not np.isfortran(matrix), "Matrix is not stored in row-major form"
-    return np.log(np.sum(np.exp(matrix), axis=1))
+    return fns.logsumexp(matrix, axis=1)
 
 def selfSoftDot(matrix):
     '''
@@ -164,6 +166,84 @@ def sparseScalarQuotientOfDot (A, B, C, out=None, start=None, end=None):
         _sparseScalarQuotientOfDot_py(A,B,C, out)
     return out
 
+def sparseScalarQuotientOfDotWithProducts (A, B, C, out=None, scaledB=None, RtB=None, colOrder=None, lnDotSum=None):
+    '''
+    Returns R = A / np.dot(B, C) exactly as sparseScalarQuotientOfDot()
+    does, but in the same traversal of A also calculates the two
+    dense products of R that usually follow it, i.e.
+
+    scaledB = B * R.dot(C.T)
+    RtB     = R.T.dot(B).T
+
+    This avoids materialising np.dot(B, C) and avoids re-reading the
+    non-zero pattern of A for each product.
+
+    Unlike the other functions in this module, C (and RtB) may be stored
+    in column-major form. As C is read a column at a time, this is the
+    faster layout when C has many columns.
+
+    If A and B are double-precision, C may be single-precision, which
+    halves the cost of reading it. All arithmetic and outputs remain in
+    double-precision.
+
+    Params
+    A         - a sparse CSR matrix
+    B         - a dense matrix
+    C         - a dense matrix, in either row or column-major form
+    out       - if specified, must be a sparse CSR matrix with identical
+                non-zero pattern to A (i.e. same indices and indptr)
+    scaledB   - if specified, a dense row-major matrix with the same shape
+                as B, which is overwritten with B * R.dot(C.T)
+    RtB       - if specified, a dense matrix with the same shape as C,
+                which is overwritten with R.T.dot(B).T
+    colOrder  - if specified, the result of csrColumnOrder(A), in which
+                case RtB is accumulated a column at a time. This is
+                fastest when RtB is column-major.
+    lnDotSum  - if specified, a one-element double-precision vector into
+                which is written np.sum(A * np.log(np.dot(B, C))), with
+                the same handling of zeros as sparseScalarProductOfSafeLnDot()
+
+    Returns
+    out, though note that this is the same parameter passed in and overwitten.
+    '''
+    assert ssp.isspmatrix_csr(A), "A matrix is not a CSR matrix"
+    assert not np.isfortran(B), "B matrix is not stored in row-major form"
+    assert scaledB is None or scaledB.shape == B.shape, "scaledB matrix has a different shape to B"
+    assert RtB is None or RtB.shape == C.shape, "RtB matrix has a different shape to C"
+
+    if out is None:
+        out = A.copy()
+    AT_ptr, AT_rows, AT_pos = (None, None, None) if colOrder is None else colOrder
+
+    if A.dtype == np.float64 and C.dtype == np.float32:
+        compiled.sparseScalarQuotientOfDotWithProducts_f8_f4(A.data, A.indices, A.indptr, B, C, out.data, scaledB, RtB, AT_ptr, AT_rows, AT_pos, lnDotSum)
+    elif A.dtype == np.float64:
+        compiled.sparseScalarQuotientOfDotWithProducts_f8(A.data, A.indices, A.indptr, B, C, out.data, scaledB, RtB, AT_ptr, AT_rows, AT_pos, lnDotSum)
+    elif A.dtype == np.float32:
+        compiled.sparseScalarQuotientOfDotWithProducts_f4(A.data, A.indices, A.indptr, B, C, out.data, scaledB, RtB, AT_ptr, AT_rows, AT_pos, lnDotSum)
+    else:
+        raise ValueError ("No native Cython implementation for dtype " + str(A.dtype))
+    return out
+
+def csrColumnOrder (A):
+    '''
+    Returns the non-zero pattern of the CSR matrix A in CSC order, for
+    use with sparseScalarQuotientOfDotWithProducts(). This is a tuple of
+
+    ptr  - the column index pointer
+    rows - the row index of each non-zero, ordered by column
+    pos  - the position of each non-zero, ordered by column, in A.data
+
+    This only depends on the non-zero pattern of A, so it need only be
+    calculated once for any number of matrices sharing that pattern.
+    '''
+    assert ssp.isspmatrix_csr(A), "A matrix is not a CSR matrix"
+    
+    positions = ssp.csr_matrix((np.arange(A.nnz, dtype=np.int32), A.indices, A.indptr), shape=A.shape)
+    AT = positions.tocsc()
+    
+    return AT.indptr.astype(np.int32), AT.indices.astype(np.int32), AT.data
+
 def sparseScalarQuotientOfNormedDot (A, B, C, d, out=None):
     '''
     Returns A / np.dot(B, C/D), however it does so keeping in  mind
@@ -224,6 +304,36 @@ def sparseScalarProductOfDot (A, B, C, out=None):
         _sparseScalarProductOfDot_py(A,B,C, out)
     return out
 
+def sparseDenseProduct (A, B, out=None):
+    '''
+    Returns A.dot(B) where A is sparse and B is dense, as a dense matrix.
+    Unlike the scipy implementation, this is multi-threaded, and can
+    write the result into an existing matrix.
+     
+    Params
+    A         - a sparse CSR matrix
+    B         - a dense matrix
+    out       - if specified, a dense row-major matrix with as many rows
+                as A and as many columns as B, which is overwritten with
+                the result
+    
+    Returns
+    out, though note that this is the same parameter passed in and overwitten.
+    '''
+    assert ssp.isspmatrix_csr(A), "A matrix is not a CSR matrix"
+    
+    if out is None:
+        out = np.empty((A.shape[0], B.shape[1]), dtype=A.dtype)
+    if A.dtype == np.float64:
+        compiled.sparseDenseProduct_f8(A.data, A.indices, A.indptr, np.ascontiguousarray(B, dtype=A.dtype), out)
+    elif A.dtype == np.float32:
+        compiled.sparseDenseProduct_f4(A.data, A.indices, A.indptr, np.ascontiguousarray(B, dtype=A.dtype), out)
+    else:
+        if WarnIfSlow:
+            sys.stderr.write("WARNING: Slow code path triggered (sparseDenseProduct)")
+        out[:,:] = A.dot(B)
+    return out
+
 def _sparseScalarProductOfDot_py(A,B,C, out=None):
     '''
     Calculates A * B.dot(C) where A is a sparse matrix
@@ -257,7 +367,7 @@ def sparseScalarProductOfSafeLnDot (A, B, C, out=None, start=None, end=None):
     Params
     A         - a sparse CSR matrix
     B         - a dense matrix
-    C         - a dense matrix
+    C         - a dense matrix, in either row or column-major form
     out       - if specified, must be a sparse CSR matrix with identical
                 non-zero pattern to A (i.e. same indices and indptr)
     start     - where to start indexing A
@@ -268,7 +378,6 @@ def sparseScalarProductOfSafeLnDot (A, B, C, out=None, start=None, end=None):
     '''
     assert ssp.isspmatrix_csr(A), "A matrix is not a CSR matrix"
     assert not np.isfortran(B), "B matrix is not stored in row-major form"
-    assert not np.isfortran(C), "C matrix is not stored in row-major form"
 
     if start is None:
         start = 0
@@ -277,16 +386,7 @@ def sparseScalarProductOfSafeLnDot (A, B, C, out=None, start=None, end=None):
     if out is None:
         out = A[start:end,:].copy()
 
-    if (start, end) == (0, A.shape[0]) and A.dtype == np.float64:
-        out = A.copy()
-        oldWay = np.sum(compiled.sparseScalarProductOfSafeLnDot_f8_full(
-             A.data, A.indices, A.indptr, B, C, out.data))
-        out = A.copy()
-        newWay = np.sum(compiled.sparseScalarProductOfSafeLnDot_f8(
-             A.data, A.indices, A.indptr, B, C, out.data, 0, A.shape[0]))
-
-        #print ("The old way was " + str(oldWay) + " and the new way was " + str(newWay))
-    elif A.dtype == np.float64:
+    if A.dtype == np.float64:
         compiled.sparseScalarProductOfSafeLnDot_f8(A.data, A.indices, A.indptr, B, C, out.data, start, end)
     elif A.dtype == np.float32:
         compiled.sparseScalarProductOfSafeLnDot_f4(A.data, A.indices, A.indptr, B, C, out.data, start, end)
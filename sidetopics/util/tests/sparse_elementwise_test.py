@@ -12,7 +12,8 @@ import scipy.sparse as ssp
 import scipy.linalg as la
 import scipy.sparse.linalg as sla
 
-from sidetopics.util.sparse_elementwise import sparseScalarProductOfDot, sparseScalarProductOfSafeLnDot, sparseScalarQuotientOfDot
+from sidetopics.util.sparse_elementwise import sparseScalarProductOfDot, sparseScalarProductOfSafeLnDot, sparseScalarQuotientOfDot, \
+    sparseScalarQuotientOfDotWithProducts, csrColumnOrder, sparseDenseProduct
 
 class Test(unittest.TestCase):
 
@@ -47,7 +48,71 @@ class Test(unittest.TestCase):
         
         print (str(diff))
         
+    def testQuotientOfDotWithProducts(self):
+        rd.seed(0xC0FFEE)
+        
+        D = 100
+        T = 200
+        K = 16
+        
+        for dtype in [np.float32, np.float64]:
+            W_d = np.floor(rd.random((D,T)) * 1.4).astype(dtype)
+            
+            W_s = ssp.csr_matrix(W_d)
+            topics = rd.random((D,K)).astype(dtype)
+            vocab  = rd.random((K,T)).astype(dtype)
+            
+            R_exp = W_d / topics.dot(vocab)
+            
+            scaledB  = np.empty_like(topics)
+            RtB      = np.empty_like(vocab)
+            lnDotSum = np.empty((1,))
+            R = sparseScalarQuotientOfDotWithProducts(W_s, topics, vocab, scaledB=scaledB, RtB=RtB, lnDotSum=lnDotSum)
+            
+            decimal = 3 if dtype == np.float32 else 10
+            np.testing.assert_array_almost_equal(R_exp, R.toarray(), decimal=decimal)
+            np.testing.assert_almost_equal(np.sum(W_d * np.log(topics.dot(vocab))) / W_d.sum(), lnDotSum[0] / W_d.sum(), decimal=decimal)
+            np.testing.assert_array_almost_equal(topics * R_exp.dot(vocab.T), scaledB, decimal=decimal)
+            np.testing.assert_array_almost_equal(R_exp.T.dot(topics).T, RtB, decimal=decimal)
+            
+            # Column-major inputs and outputs should give the same result
+            RtB_F = np.empty_like(vocab, order='F')
+            R_F = sparseScalarQuotientOfDotWithProducts(W_s, topics, np.asfortranarray(vocab), RtB=RtB_F)
+            np.testing.assert_array_almost_equal(R.toarray(), R_F.toarray(), decimal=decimal)
+            np.testing.assert_array_almost_equal(RtB, RtB_F, decimal=decimal)
+            
+            # As should accumulating RtB a column at a time
+            R_C = sparseScalarQuotientOfDotWithProducts(W_s, topics, np.asfortranarray(vocab), RtB=RtB_F, colOrder=csrColumnOrder(W_s))
+            np.testing.assert_array_almost_equal(R.toarray(), R_C.toarray(), decimal=decimal)
+            np.testing.assert_array_almost_equal(RtB, RtB_F, decimal=decimal)
+        
+        # Double-precision inputs with a single-precision C
+        R_lp = sparseScalarQuotientOfDotWithProducts(W_s, topics, vocab.astype(np.float32), scaledB=scaledB, RtB=RtB)
+        np.testing.assert_array_almost_equal(R_exp, R_lp.toarray(), decimal=3)
+        np.testing.assert_array_almost_equal(topics * R_exp.dot(vocab.T), scaledB, decimal=3)
+        np.testing.assert_array_almost_equal(R_exp.T.dot(topics).T, RtB, decimal=3)
+        
+        
+
+    def testSparseDenseProduct(self):
+        rd.seed(0xC0FFEE)
+        
+        D = 100
+        T = 200
+        K = 16
         
+        for dtype in [np.float32, np.float64]:
+            W_d = np.floor(rd.random((D,T)) * 1.4).astype(dtype)
+            W_s = ssp.csr_matrix(W_d)
+            vocab = rd.random((K,T)).astype(dtype)
+            
+            decimal = 3 if dtype == np.float32 else 10
+            np.testing.assert_array_almost_equal(W_d.dot(vocab.T), sparseDenseProduct(W_s, vocab.T), decimal=decimal)
+            
+            # The output buffer should be entirely overwritten
+            out = np.ones((D,K), dtype=dtype)
+            sparseDenseProduct(W_s, vocab.T, out=out)
+            np.testing.assert_array_almost_equal(W_d.dot(vocab.T), out, decimal=decimal)
         
 
 